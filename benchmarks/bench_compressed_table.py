@@ -0,0 +1,50 @@
+"""
+bench_compressed_table.py
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Compare the size and the load and dump times of plain, gzip and xz
+compressed json lookup tables.
+
+Usage: python benchmarks/bench_compressed_table.py [n_entries]
+
+:copyright: (c) 2018 Leiden University Medical Center
+:license: MIT
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from array_as_vcf.lookup import RSLookup, deserialize_result
+
+ALLELES = ["A", "C", "G", "T"]
+
+
+def random_entry(rng: random.Random) -> str:
+    ref, *alts = rng.sample(ALLELES, rng.choice([2, 2, 2, 3]))
+    return "{0}:{1}:{2}".format(ref, ",".join(alts), rng.choice("TFU"))
+
+
+def main():
+    n_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rng = random.Random(42)
+    lookup = RSLookup("GRCh37", {
+        f"rs{rng.randrange(1, 10 ** 9)}": deserialize_result(random_entry(rng))
+        for _ in range(n_entries)}, ensembl_lookup=False)
+    print(f"{n_entries} entries")
+    print(f"{'table':<14}{'MiB':>10}{'dump s':>10}{'load s':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ("lookup.json", "lookup.json.gz", "lookup.json.xz"):
+            path = os.path.join(tmp, name)
+            start = time.perf_counter()
+            lookup.dump(path)
+            dumped = time.perf_counter()
+            RSLookup.from_path(path, "GRCh37", ensembl_lookup=False)
+            loaded = time.perf_counter()
+            print(f"{name:<14}{os.path.getsize(path) / 2 ** 20:>10.1f}"
+                  f"{dumped - start:>10.2f}{loaded - dumped:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
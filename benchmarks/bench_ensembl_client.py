@@ -0,0 +1,75 @@
+"""
+bench_ensembl_client.py
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Compare the per-lookup latency of `query_ensembl`, which connects for
+every request, with `EnsemblClient`, which keeps its connection alive.
+Runs against a local stand-in server, so only the TCP handshake is saved;
+against ensembl the TLS handshake is saved as well.
+
+Usage: python benchmarks/bench_ensembl_client.py [n_lookups]
+
+:copyright: (c) 2018 Leiden University Medical Center
+:license: MIT
+"""
+import json
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from array_as_vcf.ensembl import EnsemblClient
+from array_as_vcf.lookup import query_ensembl
+
+VARIATION = json.dumps({"mappings": [{"allele_string": "A/G"}],
+                        "minor_allele": "G"}).encode("utf-8")
+
+
+class StandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # headers and body are written separately; avoid delayed ACK stalls
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(VARIATION)))
+        self.end_headers()
+        self.wfile.write(VARIATION)
+
+    def log_message(self, *args):
+        pass
+
+
+def timed(name, function, n_lookups):
+    start = time.perf_counter()
+    for i in range(n_lookups):
+        function(f"rs{i}")
+    per_lookup = (time.perf_counter() - start) / n_lookups
+    print(f"{name:<16}{per_lookup * 1000:>10.3f}")
+
+
+def main():
+    n_lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    print(f"{n_lookups} lookups")
+    print(f"{'method':<16}{'ms/lookup':>10}")
+    timed("query_ensembl",
+          lambda rs_id: query_ensembl(rs_id, "GRCh37", server=url),
+          n_lookups)
+    client = EnsemblClient("GRCh37", server=url)
+    timed("EnsemblClient", client.query, n_lookups)
+    client.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+bench_json_table.py
+~~~~~~~~~~~~~~~~~~~
+
+Compare the peak memory of loading and dumping a json lookup table as a
+whole document and entry by entry.
+
+Usage: python benchmarks/bench_json_table.py [n_entries]
+
+:copyright: (c) 2018 Leiden University Medical Center
+:license: MIT
+"""
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from array_as_vcf.lookup import (deserialize_query_results,
+                                 deserialize_result, read_query_results,
+                                 serialize_query_results, write_query_results)
+
+ALLELES = ["A", "C", "G", "T"]
+
+
+def random_entry(rng: random.Random) -> str:
+    ref, *alts = rng.sample(ALLELES, rng.choice([2, 2, 2, 3]))
+    return "{0}:{1}:{2}".format(ref, ",".join(alts), rng.choice("TFU"))
+
+
+def measure(name, func, *args):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    duration = time.perf_counter() - start
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<14}{size / 2 ** 20:>10.1f}{peak / 2 ** 20:>10.1f}"
+          f"{duration:>10.2f}")
+    return result
+
+
+def load_whole(path):
+    with open(path) as handle:
+        return deserialize_query_results(handle.read())
+
+
+def load_stream(path):
+    with open(path) as handle:
+        return dict(read_query_results(handle))
+
+
+def dump_whole(table, path):
+    with open(path, "w") as handle:
+        handle.write(serialize_query_results(table))
+
+
+def dump_stream(table, path):
+    with open(path, "w") as handle:
+        write_query_results(table, handle)
+
+
+def main():
+    n_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rng = random.Random(42)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "lookup.json")
+        dump_stream({f"rs{rng.randrange(1, 10 ** 9)}":
+                     deserialize_result(random_entry(rng))
+                     for _ in range(n_entries)}, path)
+        print(f"{n_entries} entries")
+        print(f"{'operation':<14}{'MiB':>10}{'peak MiB':>10}{'s':>10}")
+        measure("load whole", load_whole, path)
+        table = measure("load stream", load_stream, path)
+        measure("dump whole", dump_whole, table, path)
+        measure("dump stream", dump_stream, table, path)
+
+
+if __name__ == "__main__":
+    main()
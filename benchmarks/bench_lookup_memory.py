@@ -0,0 +1,56 @@
+"""
+bench_lookup_memory.py
+~~~~~~~~~~~~~~~~~~~~~~
+
+Compare the memory used by the in-memory lookup table representations.
+
+Usage: python benchmarks/bench_lookup_memory.py [n_entries]
+
+:copyright: (c) 2018 Leiden University Medical Center
+:license: MIT
+"""
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from array_as_vcf.lookup import deserialize_query_results
+from array_as_vcf.stores import InternedStore, LazyStore
+
+ALLELES = ["A", "C", "G", "T"]
+
+
+def random_entry(rng: random.Random) -> str:
+    ref, *alts = rng.sample(ALLELES, rng.choice([2, 2, 2, 3]))
+    return "{0}:{1}:{2}".format(ref, ",".join(alts), rng.choice("TFU"))
+
+
+def measure(name, build, js):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    table = build(js)
+    duration = time.perf_counter() - start
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<14}{size / 2 ** 20:>10.1f}{peak / 2 ** 20:>10.1f}"
+          f"{duration:>10.2f}")
+    return table
+
+
+def main():
+    n_entries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rng = random.Random(42)
+    js = json.dumps({f"rs{rng.randrange(1, 10 ** 9)}": random_entry(rng)
+                     for _ in range(n_entries)})
+    print(f"{n_entries} entries")
+    print(f"{'store':<14}{'MiB':>10}{'peak MiB':>10}{'load s':>10}")
+    measure("dict", deserialize_query_results, js)
+    measure("LazyStore", lambda x: LazyStore(json.loads(x)), js)
+    measure("InternedStore", lambda x: InternedStore(json.loads(x)), js)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+bench_openarray_reader.py
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measure the time per row of OpenArrayReader on a synthetic multi-sample
+OpenArray export, for rows of the selected sample and of other samples,
+and with a sample index of the multi-sample export. The best of 5 runs
+is reported.
+
+Usage: python benchmarks/bench_openarray_reader.py [n_samples] [n_assays]
+
+:copyright: (c) 2018 Leiden University Medical Center
+:license: MIT
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Optional
+
+from array_as_vcf.index import SampleIndex
+from array_as_vcf.lookup import QueryResult, RSLookup
+from array_as_vcf.readers import OpenArrayReader
+
+HEADER = [
+    "Assay Name", "Assay ID", "Gene Symbol", "NCBI SNP Reference",
+    "Sample ID", "Call", "Manual", "Quality", "VIC(Rn)", "FAM(Rn)", "ROX",
+    "Task", "Gender", "Population", "Well", "Omit", "Experiment Name",
+    "Plate Barcode", "Annotation", "Low ROX Intensity",
+    "NTC FAM Intensity High", "NTC VIC Intensity High", "Chromosome #",
+    "Position"
+]
+CALLS = ["A/A", "A/G", "G/G", "UND", "NOAMP"]
+
+
+def write_export(path: str, n_samples: int, n_assays: int):
+    rng = random.Random(42)
+    with open(path, "w") as handle:
+        handle.write("# Exported By : bench\n" * 15 + "\n\t\n")
+        handle.write("\t".join(HEADER) + "\n")
+        for sample in range(n_samples):
+            for assay in range(n_assays):
+                row = [""] * len(HEADER)
+                row[:6] = [f"hCV{assay}", f"C__{assay}_10", "GENE",
+                           f"rs{assay + 1}", f"sample{sample}",
+                           rng.choice(CALLS)]
+                row[-2:] = [str(assay % 22 + 1), str(assay * 100 + 1)]
+                handle.write("\t".join(row) + "\n")
+
+
+def best_time(path: str, lookup: RSLookup, sample: str,
+              index: Optional[SampleIndex] = None) -> float:
+    durations = []
+    for _ in range(5):
+        reader = OpenArrayReader(path, lookup, sample=sample, index=index)
+        start = time.perf_counter()
+        for _ in reader:
+            pass
+        durations.append(time.perf_counter() - start)
+        reader.handle.close()
+    return min(durations)
+
+
+def main():
+    n_samples = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    n_assays = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    lookup = RSLookup("GRCh37", {
+        f"rs{x + 1}": QueryResult("A", ["G"], False) for x in range(n_assays)
+    }, ensembl_lookup=False)
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, samples in (("multi-sample", n_samples),
+                              ("single sample", 1)):
+            path = os.path.join(tmp, "openarray.txt")
+            write_export(path, samples, n_assays)
+            n_rows = samples * n_assays
+            duration = best_time(path, lookup, "sample0")
+            print(f"{name}: {n_rows} rows in {duration:.2f} s, "
+                  f"{duration / n_rows * 1e6:.2f} us per row")
+            if samples > 1:
+                start = time.perf_counter()
+                index = SampleIndex.build(path)
+                print(f"indexing: {time.perf_counter() - start:.2f} s")
+                duration = best_time(path, lookup, "sample0", index)
+                print(f"indexed {name}: {duration:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
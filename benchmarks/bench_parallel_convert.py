@@ -0,0 +1,54 @@
+"""
+bench_parallel_convert.py
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Compare the conversion of a sample of a synthetic OpenArray export by a
+single reader with `convert_parallel` for increasing numbers of
+processes. Speedups require as many CPUs as processes.
+
+Usage: python benchmarks/bench_parallel_convert.py [n_samples] [n_assays]
+
+:copyright: (c) 2018 Leiden University Medical Center
+:license: MIT
+"""
+import os
+import sys
+import tempfile
+import time
+
+from array_as_vcf.lookup import QueryResult, RSLookup
+from array_as_vcf.parallel import convert_parallel
+from array_as_vcf.readers import OpenArrayReader
+
+from bench_openarray_reader import write_export
+
+
+def main():
+    n_samples = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    n_assays = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    lookup = RSLookup("GRCh37", {
+        f"rs{x + 1}": QueryResult("A", ["G"], False) for x in range(n_assays)
+    }, ensembl_lookup=False)
+    print(f"{os.cpu_count()} CPUs")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "openarray.txt")
+        write_export(path, n_samples, n_assays)
+        print(f"{n_samples * n_assays} rows, "
+              f"{os.path.getsize(path) / 2 ** 20:.0f} MiB")
+
+        start = time.perf_counter()
+        reader = OpenArrayReader(path, lookup, sample="sample0")
+        expected = [x.vcf_line for x in sorted(reader)]
+        print(f"single reader: {time.perf_counter() - start:.2f} s")
+
+        for processes in (1, 2, 4, 8):
+            start = time.perf_counter()
+            lines = convert_parallel(OpenArrayReader, path, lookup,
+                                     processes=processes, sample="sample0")
+            duration = time.perf_counter() - start
+            assert lines == expected
+            print(f"{processes} processes: {duration:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
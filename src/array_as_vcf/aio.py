@@ -0,0 +1,240 @@
+"""
+aav.aio
+~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+:license: MIT
+"""
+import asyncio
+import http.client
+import io
+import json
+import logging
+import socket
+import time
+import urllib.parse
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.error import HTTPError, URLError
+
+from .ensembl import JSON_HEADERS
+from .lookup import (ENSEMBL_BATCH_SIZE, LookupResult, MissingReason,
+                     MissingResult, NotFoundError, QueryResult, RSLookup,
+                     UnmappedError, ensembl_server, parse_variation,
+                     parse_variations)
+from .readers import Reader
+from .variation import Variant
+
+logger = logging.getLogger('RSLookup')
+
+
+class AsyncRSLookup(object):
+    """
+    Resolves rs ids for an RSLookup on an asyncio event loop, without
+    blocking the loop.
+
+    Results are stored in the table of the RSLookup, with the same
+    negative caching, retries, circuit breaker and lookup budget. Readers
+    can then run on the RSLookup without waiting on the network.
+
+    Every request is done on a new connection. At most `max_in_flight`
+    requests are done at the same time.
+    """
+
+    def __init__(self, lookup: RSLookup, max_in_flight: int = 10):
+        """
+        :param lookup: RSLookup to resolve rs ids for
+        :param max_in_flight: maximum number of concurrent requests
+        """
+        self.lookup = lookup
+        self.max_in_flight = max_in_flight
+        if lookup.server is not None:
+            self.server = lookup.server
+        else:
+            self.server = ensembl_server(lookup.build)
+        url = urllib.parse.urlsplit(self.server)
+        self._ssl = url.scheme == "https"
+        self._netloc = url.netloc
+        self._host = url.hostname
+        self._port = url.port or (443 if self._ssl else 80)
+        self._base_path = url.path.rstrip("/")
+
+    async def request(self, method: str, path: str,
+                      body: Optional[bytes] = None,
+                      timeout: Optional[float] = None) -> bytes:
+        """
+        Perform a request, and return the body of the response.
+        :raises: HTTPError for responses with an error status,
+        URLError if the request could not be completed
+        """
+        path = self._base_path + path
+        try:
+            status, reason, headers, data = await asyncio.wait_for(
+                self._request(method, path, body), timeout)
+        except asyncio.TimeoutError as e:
+            raise URLError(socket.timeout("timed out")) from e
+        except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+            raise URLError(e) from e
+        if status >= 400:
+            raise HTTPError(self.server + path, status, reason, headers,
+                            io.BytesIO(data))
+        return data
+
+    async def _request(self, method: str, path: str, body: Optional[bytes]
+                       ) -> Tuple[int, str, http.client.HTTPMessage, bytes]:
+        reader, writer = await asyncio.open_connection(
+            self._host, self._port, ssl=True if self._ssl else None)
+        try:
+            head = [f"{method} {path} HTTP/1.1", f"Host: {self._netloc}",
+                    "Connection: close"]
+            head.extend(f"{k}: {v}" for k, v in JSON_HEADERS.items())
+            if body is not None:
+                head.append(f"Content-Length: {len(body)}")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+            if body is not None:
+                writer.write(body)
+            await writer.drain()
+
+            status_line = (await reader.readline()).decode("latin-1")
+            _, status, reason = status_line.rstrip("\r\n").split(" ", 2)
+            header_lines = await reader.readuntil(b"\r\n\r\n")
+            headers = http.client.parse_headers(io.BytesIO(header_lines))
+            if headers.get("Transfer-Encoding", "").lower() == "chunked":
+                data = await _read_chunked(reader)
+            elif headers.get("Content-Length") is not None:
+                data = await reader.readexactly(
+                    int(headers["Content-Length"]))
+            else:
+                data = await reader.read()
+        finally:
+            writer.close()
+        return int(status), reason, headers, data
+
+    async def query(self, rs_id: str,
+                    timeout: Optional[float] = None) -> QueryResult:
+        """Get ref and alt alleles for an rs id"""
+        try:
+            data = await self.request(
+                "GET", f"/variation/human/{rs_id}"
+                       "?content-type=application/json", timeout=timeout)
+        except HTTPError as e:
+            error = json.loads(e.read() or b"{}").get("error") or ""
+            if "not found for human" in error:
+                raise NotFoundError("rsID not found for human")
+            raise e
+        return parse_variation(json.loads(data.decode("utf-8")))
+
+    async def query_batch(self, rs_ids: List[str],
+                          timeout: Optional[float] = None
+                          ) -> Dict[str, LookupResult]:
+        """Get ref and alt alleles for multiple rs ids in a single request"""
+        if len(rs_ids) > ENSEMBL_BATCH_SIZE:
+            raise ValueError(f"Cannot query more than {ENSEMBL_BATCH_SIZE} "
+                             f"rsIDs in a single request")
+        body = json.dumps({"ids": list(rs_ids)}).encode("utf-8")
+        data = await self.request("POST", "/variation/human", body,
+                                  timeout=timeout)
+        return parse_variations(rs_ids, json.loads(data.decode("utf-8")))
+
+    async def _get_ensembl(self, rs_ids: List[str]
+                           ) -> Optional[Dict[str, LookupResult]]:
+        """
+        Like RSLookup._get_ensembl_batch
+        :return: the results, or None if no request was done
+        """
+        lookup = self.lookup
+        for attempt in range(lookup.request_tries):
+            delay = lookup._backoff_delay(attempt)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            timeout = lookup._timeout()
+            if timeout is None:
+                if attempt == 0:
+                    return None
+                break
+            started = time.perf_counter()
+            try:
+                if len(rs_ids) == 1:
+                    results = {rs_ids[0]: await self.query(rs_ids[0],
+                                                           timeout)}
+                else:
+                    results = await self.query_batch(rs_ids, timeout)
+            except NotFoundError:
+                results = {rs_ids[0]: MissingResult(MissingReason.not_found,
+                                                    time.time())}
+            except UnmappedError:
+                results = {rs_ids[0]: MissingResult(MissingReason.unmapped,
+                                                    time.time())}
+            except (HTTPError, URLError, RuntimeError, ValueError) as e:
+                lookup._record(attempt, started, e)
+                continue
+            lookup._record(attempt, started)
+            return results
+        error = MissingResult(MissingReason.error, time.time())
+        return {rs_id: error for rs_id in rs_ids}
+
+    async def resolve_many(self, rs_ids: Iterable[str]) -> int:
+        """
+        Retrieve all unknown rs ids from ensembl concurrently, in batches of
+        the `batch_size` of the lookup table. As `RSLookup.prefetch`.
+
+        :param rs_ids: rs ids that are going to be looked up
+        :return: number of rs ids added to the table
+        """
+        lookup = self.lookup
+        if not lookup.ensembl_lookup:
+            return 0
+        missing = sorted(lookup.missing(rs_ids))
+        lookup.counters.miss(len(missing))
+        batch_size = max(lookup.batch_size, 1)
+        batches = [missing[i:i + batch_size]
+                   for i in range(0, len(missing), batch_size)]
+        logger.info(f"Resolving {len(missing)} rsIDs from ensembl in "
+                    f"{len(batches)} requests, {self.max_in_flight} at a "
+                    f"time.")
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        async def resolve(batch: List[str]) -> int:
+            async with semaphore:
+                results = await self._get_ensembl(batch)
+            if results is None:
+                return 0
+            added = 0
+            for rs_id in batch:
+                result = results.get(rs_id, MissingResult(
+                    MissingReason.not_found, time.time()))
+                lookup._store(rs_id, result)
+                if isinstance(result, QueryResult):
+                    added += 1
+            return added
+
+        return sum(await asyncio.gather(*(resolve(x) for x in batches)))
+
+
+async def _read_chunked(reader: asyncio.StreamReader) -> bytes:
+    chunks = []
+    while True:
+        size = int((await reader.readline()).split(b";")[0], 16)
+        if size == 0:
+            await reader.readuntil(b"\r\n")
+            return b"".join(chunks)
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+
+
+async def convert_async(reader: Reader,
+                        max_in_flight: int = 10) -> List[Variant]:
+    """
+    Convert an array file as `convert_two_pass`, without blocking the
+    event loop. The rs ids are resolved with an AsyncRSLookup, reading
+    and parsing the file is done in the default executor.
+    :param reader: instance of Reader
+    :param max_in_flight: maximum number of concurrent requests
+    :return: sorted list of variants
+    """
+    loop = asyncio.get_event_loop()
+    rs_ids = await loop.run_in_executor(None, lambda: list(reader.rs_ids()))
+    n_added = await AsyncRSLookup(reader.lookup_table,
+                                  max_in_flight).resolve_many(rs_ids)
+    logger.info(f"Resolved {n_added} rsIDs.")
+    return await loop.run_in_executor(None, sorted, reader)
@@ -9,9 +9,16 @@ aav.cli
 
 import argparse
 import logging
+import os
+import re
+import signal
+import time
+from typing import Dict, Optional
 
+from .index import open_index
 from .lookup import RSLookup
-from .readers import OpenArrayReader, autodetect_reader
+from .readers import (OpenArrayReader, autodetect_reader, convert_two_pass,
+                      merge_samples)
 
 
 def get_parser():
@@ -25,20 +32,91 @@ def get_parser():
                         help="Path to array file")
     parser.add_argument("--build", "-b", choices=["GRCh37", "GRCh38"],
                         default="GRCh37", help="Genome build")
-    parser.add_argument("--sample-name", "-s", required=True,
-                        help="Name of sample in VCF file")
+    parser.add_argument("--sample-name", "-s", required=False,
+                        help="Name of sample in VCF file. Required unless "
+                             "--all-samples is given. For OpenArray files, "
+                             "the Sample ID to convert")
+    parser.add_argument("--all-samples", action="store_true",
+                        help="Convert all samples of an OpenArray file in a "
+                             "single pass, to a multi-sample VCF file, or "
+                             "to a VCF file per sample with --output-dir")
+    parser.add_argument("--output-dir", "-o", required=False,
+                        help="Directory to write a VCF file per sample to, "
+                             "named after the Sample ID, with "
+                             "--all-samples")
     parser.add_argument("--chr-prefix", "-c", required=False,
                         help="Prefix to chromosome names")
     parser.add_argument("--lookup-table", "-l", required=False,
-                        help="Path to existing lookup table for rsIDs")
+                        help="Path to existing lookup table for rsIDs. "
+                             "Either json (optionally gzip or xz "
+                             "compressed), a binary table or an sqlite "
+                             "database, which is updated in place")
     parser.add_argument("--dump", "-d", required=False,
-                        help="Path to write generated lookup table")
+                        help="Path to write generated lookup table. Paths "
+                             "ending in .db or .sqlite are written as sqlite "
+                             "database, paths ending in .bin as binary "
+                             "table, paths ending in .gz or .xz as "
+                             "compressed json")
+    parser.add_argument("--merge-dump", action="store_true",
+                        help="Merge the generated lookup table into an "
+                             "existing table at the --dump path, instead of "
+                             "overwriting it. Safe for parallel conversions "
+                             "that dump to the same path")
+    parser.add_argument("--journal", "-j", required=False,
+                        help="Path to a journal that newly fetched rsIDs "
+                             "are appended to as they arrive. An existing "
+                             "journal is replayed on top of the lookup table")
     parser.add_argument("--encoding", default="UTF-8",
                         help="Encoding of the array file")
     parser.add_argument("--exclude-assays", nargs='+', required=False,
                         help="Assay IDs for OpenArray to ignore")
     parser.add_argument("--no-ensembl-lookup", action="store_true",
                         help="Lookup missing rsIDs on Ensembl")
+    parser.add_argument("--ensembl-server", required=False,
+                        help="Base url of the Ensembl REST server. Defaults "
+                             "to the server of the genome build")
+    parser.add_argument("--keep-alive", action="store_true",
+                        help="Reuse connections to Ensembl across requests")
+    parser.add_argument("--max-request-rate", type=float, required=False,
+                        help="Maximum number of Ensembl requests per second. "
+                             "Requests are paced to stay under this rate and "
+                             "the rate limit announced by Ensembl. Implies "
+                             "--keep-alive")
+    parser.add_argument("--lookup-server", required=False,
+                        help="Path to the Unix socket of an "
+                             "aav-lookup-server. rsIDs that are not in the "
+                             "lookup table are requested from the server "
+                             "instead of from Ensembl")
+    parser.add_argument("--lookup-workers", type=int, default=1,
+                        help="Number of concurrent Ensembl requests with "
+                             "which the missing rsIDs are looked up before "
+                             "conversion starts")
+    parser.add_argument("--missing-ttl", type=float, required=False,
+                        help="Days after which rsIDs that Ensembl could not "
+                             "find or map are looked up again. By default "
+                             "they are never looked up again")
+    parser.add_argument("--error-ttl", type=float, default=0,
+                        help="Days after which rsIDs for which the Ensembl "
+                             "lookup failed are looked up again")
+    parser.add_argument("--max-failures", type=int, default=5,
+                        help="Number of consecutive failed Ensembl requests "
+                             "after which Ensembl is considered down. Missing "
+                             "rsIDs are then skipped, until a request every "
+                             "minute succeeds")
+    parser.add_argument("--lookup-budget", type=float, required=False,
+                        help="Maximum number of seconds to spend on Ensembl "
+                             "requests. rsIDs that are missing afterwards "
+                             "are skipped")
+    parser.add_argument("--stats-json", required=False,
+                        help="Path to write statistics of the conversion "
+                             "and of the rsID lookups to, as json")
+    parser.add_argument("--processes", type=int, required=False,
+                        help="Parse the file in chunks with this number of "
+                             "processes, after looking up the missing rsIDs")
+    parser.add_argument("--index", action="store_true",
+                        help="Only read the rows of the sample, using the "
+                             "sample index next to the OpenArray file. The "
+                             "index is built if it is missing or outdated")
     parser.add_argument("--log-level", default="INFO", required=False,
                         choices=["DEBUG", "INFO", "WARNING", "ERROR"],
                         help="Set the verbosity of the logger")
@@ -46,9 +124,34 @@ def get_parser():
 
 
 def convert():
+    started = time.perf_counter()
     parser = get_parser()
     args = parser.parse_args()
     ensembl_lookup = not args.no_ensembl_lookup
+    lookup_kwargs = dict(
+        missing_ttl=None if args.missing_ttl is None
+        else args.missing_ttl * 86400,
+        error_ttl=args.error_ttl * 86400,
+        server=args.ensembl_server,
+        journal=args.journal,
+        max_failures=args.max_failures,
+        lookup_budget=args.lookup_budget
+    )
+    # The networking modules are only imported when used, to keep the
+    # start-up of short conversions fast
+    if args.lookup_server is not None:
+        from .server import LookupServerClient
+        lookup_kwargs["client"] = LookupServerClient(args.lookup_server)
+    elif args.max_request_rate is not None:
+        from .ensembl import EnsemblClient, RateLimiter
+        lookup_kwargs["client"] = EnsemblClient(
+            args.build, server=args.ensembl_server,
+            rate_limiter=RateLimiter(args.max_request_rate)
+        )
+    elif args.keep_alive:
+        from .ensembl import EnsemblClient
+        lookup_kwargs["client"] = EnsemblClient(args.build,
+                                                server=args.ensembl_server)
 
     # Set up logging
     num_level = getattr(logging, args.log_level)
@@ -57,40 +160,354 @@ def convert():
 
     reader_cls = autodetect_reader(args.path, encoding=args.encoding)
     logging.info(f"Detected array file with type: {reader_cls.__name__}")
+    if args.all_samples and reader_cls != OpenArrayReader:
+        parser.error("--all-samples is only supported for OpenArray files")
+    if not args.all_samples and args.sample_name is None:
+        parser.error("the following arguments are required: --sample-name")
+    if args.output_dir is not None and not args.all_samples:
+        parser.error("--output-dir requires --all-samples")
+    if args.processes is not None and args.all_samples:
+        parser.error("--processes is not supported with --all-samples")
+    if args.index and reader_cls != OpenArrayReader:
+        parser.error("--index is only supported for OpenArray files")
 
     if args.lookup_table is None:
-        rs_look = RSLookup(build=args.build, ensembl_lookup=ensembl_lookup)
+        rs_look = RSLookup(build=args.build, ensembl_lookup=ensembl_lookup,
+                           **lookup_kwargs)
     else:
         rs_look = RSLookup.from_path(args.lookup_table, build=args.build,
-                                     ensembl_lookup=ensembl_lookup)
+                                     ensembl_lookup=ensembl_lookup,
+                                     compact=True, **lookup_kwargs)
 
     logging.info(f"Initialized lookup table with {len(rs_look)} elements.")
 
     logging.info("Start conversion.")
 
+    reader_kwargs = dict(prefix_chr=args.chr_prefix, encoding=args.encoding)
     if reader_cls == OpenArrayReader:
-        reader = reader_cls(args.path, lookup_table=rs_look,
-                            sample=args.sample_name,
-                            prefix_chr=args.chr_prefix,
-                            encoding=args.encoding,
-                            exclude_assays=args.exclude_assays)
+        reader_kwargs.update(
+            sample=None if args.all_samples else args.sample_name,
+            exclude_assays=args.exclude_assays,
+            index=open_index(args.path, args.encoding)
+            if args.index and not args.all_samples else None)
+    reader = reader_cls(args.path, lookup_table=rs_look, **reader_kwargs)
+
+    # Missing rsIDs are requested in batches before the conversion; rows
+    # only request rsIDs themselves if that is not possible. Without
+    # Ensembl lookup there is nothing to request
+    two_pass = ensembl_lookup
+    if args.all_samples:
+        records = convert_all_samples(
+            reader, args.output_dir,
+            workers=args.lookup_workers if two_pass else None)
+        logging.info(f"Converted {sum(records.values())} records of "
+                     f"{len(records)} samples.")
     else:
-        reader = reader_cls(args.path, lookup_table=rs_look,
-                            prefix_chr=args.chr_prefix, encoding=args.encoding)
+        print(reader.vcf_header(args.sample_name), end='')
 
-    print(reader.vcf_header(args.sample_name), end='')
+        # To print a valid vcf file, the Variants have to be sorted
+        if args.processes is not None:
+            from .parallel import convert_parallel
+            reader.handle.close()
+            vcf_lines = convert_parallel(
+                reader_cls, args.path, rs_look, processes=args.processes,
+                workers=args.lookup_workers, **reader_kwargs)
+        else:
+            if two_pass:
+                variants = convert_two_pass(reader,
+                                            workers=args.lookup_workers)
+            else:
+                variants = sorted(reader)
+            vcf_lines = [x.vcf_line for x in variants]
+        for i, line in enumerate(vcf_lines, 1):
+            print(line)
 
-    # To print a valid vcf file, the Variants have to be sorted
-    variants = sorted(reader)
-    for i, record in enumerate(variants, 1):
-        print(record.vcf_line)
+        try:
+            logging.info("Converted {0} records.".format(i))
+        except UnboundLocalError:  # if there were 0 records, i is unset
+            logging.info("Converted 0 records.")
+        records = {args.sample_name: len(vcf_lines)}
 
-    try:
-        logging.info("Converted {0} records.".format(i))
-    except UnboundLocalError:  # if there were 0 records, i is unset
-        logging.info("Converted 0 records.")
+    stats = rs_look.stats()
+    logging.info(
+        f"Looked up rsIDs: {stats['hits']} hits and {stats['misses']} "
+        f"misses, {stats['requests']['successes']} successful and "
+        f"{sum(stats['requests']['failures'].values())} failed requests in "
+        f"{stats['latency']['total_seconds']:.1f} seconds.")
 
     if args.dump is not None:
         logging.info("Dumping lookup table.")
-        with open(args.dump, "w") as dhandle:
-            dhandle.write(rs_look.dumps())
+        rs_look.dump(args.dump, merge=args.merge_dump)
+    rs_look.close()
+
+    if args.stats_json is not None:
+        import json
+        with open(args.stats_json, "w") as handle:
+            json.dump({"sample": args.sample_name, "path": args.path,
+                       "seconds": time.perf_counter() - started,
+                       "records": records, "lookup": stats}, handle,
+                      indent=2)
+
+
+def sample_file_name(sample: str) -> str:
+    """File name of the VCF file of a sample, safe for any Sample ID"""
+    return re.sub(r"[^\w.-]", "_", sample) + ".vcf"
+
+
+def convert_all_samples(reader: OpenArrayReader, output_dir: Optional[str],
+                        workers: Optional[int] = None) -> Dict[str, int]:
+    """
+    Convert all samples of an OpenArray file in a single pass, sharing
+    the lookups. Writes a multi-sample VCF to stdout, or a VCF file per
+    sample to `output_dir`.
+    :param workers: look up all missing rsIDs of all samples first, with
+    this number of concurrent requests. None to look them up while reading
+    :return: number of records per sample
+    """
+    if workers is not None:
+        reader.lookup_table.prefetch(reader.rs_ids(), workers=workers)
+    by_sample = reader.split_samples()
+    if output_dir is None:
+        print(reader.vcf_header(*by_sample), end='')
+        for record in merge_samples(by_sample):
+            print(record.vcf_line)
+    else:
+        os.makedirs(output_dir, exist_ok=True)
+        for sample, variants in by_sample.items():
+            path = os.path.join(output_dir, sample_file_name(sample))
+            with open(path, "w") as handle:
+                handle.write(reader.vcf_header(sample))
+                for record in sorted(variants):
+                    handle.write(record.vcf_line + "\n")
+    return {sample: len(variants) for sample, variants in by_sample.items()}
+
+
+def get_convert_lookup_parser():
+    parser = argparse.ArgumentParser(
+        description="Convert a lookup table to another format. The format "
+                    "is determined by the extension: .db or .sqlite for "
+                    "sqlite, .bin for a binary table and json otherwise",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--input", "-i", required=True,
+                        help="Path to existing lookup table")
+    parser.add_argument("--output", "-o", required=True,
+                        help="Path to write converted lookup table")
+    return parser
+
+
+def convert_lookup():
+    args = get_convert_lookup_parser().parse_args()
+    rs_look = RSLookup.from_path(args.input, build="GRCh37",
+                                 ensembl_lookup=False)
+    rs_look.dump(args.output)
+    rs_look.close()
+
+
+def get_compact_lookup_parser():
+    parser = argparse.ArgumentParser(
+        description="Fold a lookup table journal into a lookup table",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--lookup-table", "-l", required=True,
+                        help="Path to lookup table. Created if it does not "
+                             "exist")
+    parser.add_argument("--journal", "-j", required=True,
+                        help="Path to journal. Emptied afterwards")
+    return parser
+
+
+def compact_lookup():
+    from .stores import compact_journal
+    args = get_compact_lookup_parser().parse_args()
+    replayed = compact_journal(args.lookup_table, args.journal)
+    logging.info(f"Folded {replayed} journal entries into "
+                 f"{args.lookup_table}.")
+
+
+def get_merge_lookup_parser():
+    from .stores import MERGE_POLICIES
+    parser = argparse.ArgumentParser(
+        description="Merge lookup tables into a single table. The output is "
+                    "locked while merging and replaced atomically, so "
+                    "multiple merges into the same table can run at once",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--input", "-i", nargs="+", required=True,
+                        help="Paths to lookup tables to merge")
+    parser.add_argument("--output", "-o", required=True,
+                        help="Path to lookup table to merge into. Created "
+                             "if it does not exist")
+    parser.add_argument("--on-conflict", choices=MERGE_POLICIES,
+                        default="first",
+                        help="What to do if tables have different alleles "
+                             "for an rsID: keep the first (starting with "
+                             "the output), take the last, or stop with an "
+                             "error. Found rsIDs always take precedence over "
+                             "rsIDs that could not be retrieved")
+    return parser
+
+
+def merge_lookup():
+    from .stores import merge_into, read_table
+    args = get_merge_lookup_parser().parse_args()
+    n_entries = merge_into(args.output, (read_table(x) for x in args.input),
+                           on_conflict=args.on_conflict)
+    logging.info(f"Merged {len(args.input)} tables into {args.output} with "
+                 f"{n_entries} rsIDs.")
+
+
+def get_list_samples_parser():
+    parser = argparse.ArgumentParser(
+        description="List the samples of an OpenArray file with their "
+                    "number of rows, from the sample index next to the "
+                    "file. The index is built if it is missing or outdated",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--path", "-p", required=True,
+                        help="Path to OpenArray file")
+    parser.add_argument("--encoding", default="UTF-8",
+                        help="Encoding of the OpenArray file")
+    parser.add_argument("--assays", action="store_true",
+                        help="List the assays instead of the samples")
+    return parser
+
+
+def list_samples():
+    args = get_list_samples_parser().parse_args()
+    index = open_index(args.path, args.encoding)
+    entries = index.assays if args.assays else index.samples
+    for name, ranges in entries.items():
+        print(f"{name}\t{ranges.rows}")
+
+
+def get_build_lookup_parser():
+    parser = argparse.ArgumentParser(
+        description="Build a lookup table from a dbSNP VCF file",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--dbsnp", "-v", required=True,
+                        help="Path to dbSNP VCF file, plain or gzipped")
+    parser.add_argument("--output", "-o", required=True,
+                        help="Path to write lookup table. The format is "
+                             "determined by the extension: .db or .sqlite "
+                             "for sqlite, .bin for a binary table and json "
+                             "otherwise")
+    parser.add_argument("--array", "-a", nargs="+", required=False,
+                        help="Array files. Only rsIDs in these files are "
+                             "added to the lookup table")
+    parser.add_argument("--encoding", default="UTF-8",
+                        help="Encoding of the array files")
+    parser.add_argument("--freq-source", default="1000Genomes",
+                        help="Population of the FREQ INFO field to "
+                             "determine the minor allele with, if the "
+                             "records have no CAF field")
+    return parser
+
+
+def build_lookup_table():
+    from .dbsnp import build_lookup
+    args = get_build_lookup_parser().parse_args()
+    table = build_lookup(args.dbsnp, args.array, encoding=args.encoding,
+                         freq_source=args.freq_source)
+    rs_look = RSLookup("GRCh37", table, ensembl_lookup=False)
+    rs_look.dump(args.output)
+    rs_look.close()
+    logging.info(f"Wrote {len(table)} rsIDs to {args.output}.")
+
+
+def get_import_manifest_parser():
+    parser = argparse.ArgumentParser(
+        description="Build a lookup table from an Affymetrix annotation or "
+                    "Illumina manifest csv file",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--manifest", "-m", required=True,
+                        help="Path to annotation or manifest csv file")
+    parser.add_argument("--output", "-o", required=True,
+                        help="Path to write lookup table. The format is "
+                             "determined by the extension: .db or .sqlite "
+                             "for sqlite, .bin for a binary table and json "
+                             "otherwise")
+    parser.add_argument("--reference", "-r", required=False,
+                        help="Path to fasta file of the reference genome, "
+                             "indexed with samtools faidx. Required for "
+                             "Illumina manifests")
+    parser.add_argument("--encoding", default="UTF-8",
+                        help="Encoding of the manifest")
+    return parser
+
+
+def import_manifest_table():
+    from .manifests import import_manifest
+    args = get_import_manifest_parser().parse_args()
+    table = import_manifest(args.manifest, args.reference,
+                            encoding=args.encoding)
+    rs_look = RSLookup("GRCh37", table, ensembl_lookup=False)
+    rs_look.dump(args.output)
+    rs_look.close()
+    logging.info(f"Wrote {len(table)} rsIDs to {args.output}.")
+
+
+def get_lookup_server_parser():
+    parser = argparse.ArgumentParser(
+        description="Serve a lookup table to array-as-vcf processes on a "
+                    "Unix socket. rsIDs are looked up on Ensembl once for "
+                    "all processes",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--socket", "-S", required=True,
+                        help="Path to create the Unix socket at")
+    parser.add_argument("--build", "-b", choices=["GRCh37", "GRCh38"],
+                        default="GRCh37", help="Genome build")
+    parser.add_argument("--lookup-table", "-l", required=False,
+                        help="Path to existing lookup table for rsIDs")
+    parser.add_argument("--journal", "-j", required=False,
+                        help="Path to a journal that newly fetched rsIDs "
+                             "are appended to as they arrive")
+    parser.add_argument("--dump", "-d", required=False,
+                        help="Path to write the lookup table to when the "
+                             "server stops")
+    parser.add_argument("--ensembl-server", required=False,
+                        help="Base url of the Ensembl REST server. Defaults "
+                             "to the server of the genome build")
+    parser.add_argument("--lookup-workers", type=int, default=1,
+                        help="Number of concurrent Ensembl requests per "
+                             "request to the server")
+    parser.add_argument("--log-level", default="INFO", required=False,
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        help="Set the verbosity of the logger")
+    return parser
+
+
+def lookup_server():
+    from .ensembl import EnsemblClient
+    from .server import LookupServer
+    args = get_lookup_server_parser().parse_args()
+    logging.getLogger().setLevel(getattr(logging, args.log_level))
+    lookup_kwargs = dict(
+        server=args.ensembl_server,
+        journal=args.journal,
+        client=EnsemblClient(args.build, server=args.ensembl_server)
+    )
+    if args.lookup_table is None:
+        rs_look = RSLookup(build=args.build, **lookup_kwargs)
+    else:
+        rs_look = RSLookup.from_path(args.lookup_table, build=args.build,
+                                     compact=True, **lookup_kwargs)
+    logging.info(f"Initialized lookup table with {len(rs_look)} elements.")
+
+    # Stop cleanly on SIGTERM as on ctrl-c
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    server = LookupServer(args.socket, rs_look, workers=args.lookup_workers)
+    logging.info(f"Serving lookup table on {args.socket}.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.dump is not None:
+            logging.info("Dumping lookup table.")
+            rs_look.dump(args.dump)
+        rs_look.close()
@@ -0,0 +1,131 @@
+"""
+aav.dbsnp
+~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+:license: MIT
+"""
+import gzip
+import io
+import logging
+from typing import (Container, Dict, Iterable, Iterator, List, Optional,
+                    TextIO, Tuple)
+
+from .lookup import QueryResult
+from .readers import array_rs_ids
+
+logger = logging.getLogger('RSLookup')
+
+GZIP_MAGIC = b"\x1f\x8b"
+# Population of the FREQ field that is used if present
+FREQ_SOURCE = "1000Genomes"
+
+
+def open_vcf(path: str) -> TextIO:
+    """Open a plain or (b)gzipped VCF file for reading text"""
+    with open(path, "rb") as handle:
+        magic = handle.read(2)
+    if magic == GZIP_MAGIC:
+        return io.TextIOWrapper(gzip.open(path, "rb"), encoding="utf-8")
+    return open(path, "r", encoding="utf-8")
+
+
+def parse_frequencies(info: str, source: str = FREQ_SOURCE
+                      ) -> Optional[List[Optional[float]]]:
+    """
+    Get the allele frequencies of a dbSNP INFO column, reference first.
+    Taken from CAF, or else from the population `source` of FREQ, or the
+    first population of FREQ.
+    :return: list with a frequency or None per allele, or None if the
+    record has no frequencies
+    """
+    caf = None
+    freq = None
+    for field in info.split(";"):
+        if field.startswith("CAF="):
+            caf = field[4:]
+        elif field.startswith("FREQ="):
+            freq = field[5:]
+    if caf is not None:
+        values = caf
+    elif freq is not None:
+        populations = [x.split(":", 1) for x in freq.split("|")]
+        values = dict(populations).get(source, populations[0][-1])
+    else:
+        return None
+    return [None if x == "." else float(x) for x in values.split(",")]
+
+
+def ref_is_minor(frequencies: Optional[List[Optional[float]]]
+                 ) -> Optional[bool]:
+    """
+    Whether the reference is the minor allele, the allele with the second
+    highest frequency, as for the minor_allele of ensembl.
+    :return: None if the frequencies are unknown
+    """
+    if frequencies is None or len(frequencies) < 2:
+        return None
+    known = [(f, i) for i, f in enumerate(frequencies) if f is not None]
+    if len(known) < 2:
+        return None
+    ordered = sorted(known, key=lambda x: -x[0])
+    return ordered[1][1] == 0
+
+
+def read_dbsnp(path: str, rs_ids: Optional[Container[str]] = None,
+               freq_source: str = FREQ_SOURCE
+               ) -> Iterator[Tuple[str, QueryResult]]:
+    """
+    Stream lookup entries from a dbSNP VCF file.
+    Only the first record of an rs id is used. Records without alternate
+    alleles are skipped.
+
+    :param path: path to plain or gzipped VCF file
+    :param rs_ids: Optional rs ids to restrict the entries to
+    :param freq_source: population of the FREQ field to use
+    :return: iterator of rs id and QueryResult
+    """
+    seen = set()
+    with open_vcf(path) as handle:
+        for line in handle:
+            if line.startswith("#"):
+                continue
+            # CHROM POS ID REF ALT QUAL FILTER INFO
+            fields = line.rstrip("\n").split("\t", 8)
+            ids = [x for x in fields[2].split(";")
+                   if (rs_ids is None or x in rs_ids) and x not in seen]
+            if not ids or fields[4] == ".":
+                continue
+            result = QueryResult(
+                fields[3], fields[4].split(","),
+                ref_is_minor(parse_frequencies(fields[7], freq_source))
+            )
+            for rs_id in ids:
+                seen.add(rs_id)
+                yield rs_id, result
+
+
+def build_lookup(vcf_path: str, array_paths: Optional[Iterable[str]] = None,
+                 encoding: Optional[str] = None,
+                 freq_source: str = FREQ_SOURCE) -> Dict[str, QueryResult]:
+    """
+    Build a lookup table from a dbSNP VCF file, so that no ensembl
+    requests are needed.
+
+    :param vcf_path: path to plain or gzipped dbSNP VCF file
+    :param array_paths: Optional array files to restrict the table to the
+    rs ids of
+    :param encoding: optional encoding of the array files
+    :param freq_source: population of the FREQ field to use
+    :return: dict of rs id and QueryResult, for use as `init_d` of RSLookup
+    """
+    rs_ids = None
+    if array_paths is not None:
+        rs_ids = array_rs_ids(array_paths, encoding=encoding)
+        logger.info(f"Collected {len(rs_ids)} rsIDs from array files.")
+    table = dict(read_dbsnp(vcf_path, rs_ids, freq_source))
+    if rs_ids is not None:
+        logger.info(f"Found {len(table)} of {len(rs_ids)} rsIDs in "
+                    f"{vcf_path}.")
+    return table
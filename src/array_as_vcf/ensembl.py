@@ -0,0 +1,301 @@
+"""
+aav.ensembl
+~~~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+:license: MIT
+"""
+import http.client
+import io
+import json
+import logging
+import queue
+import socket
+import threading
+import time
+import urllib.parse
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
+from urllib.error import HTTPError, URLError
+
+from .lookup import (ENSEMBL_BATCH_SIZE, LookupResult, NotFoundError,
+                     QueryResult, ensembl_server, parse_variation,
+                     parse_variations)
+
+logger = logging.getLogger('RSLookup')
+
+JSON_HEADERS = {"Content-Type": "application/json",
+                "Accept": "application/json"}
+# Ensembl allows 55000 requests per hour
+ENSEMBL_RATE = 15
+# Seconds to wait after a 429 response without a usable Retry-After header
+DEFAULT_RETRY_AFTER = 1
+
+
+class RateLimiter(object):
+    """
+    Token bucket that paces requests to stay under the rate limit of the
+    server.
+
+    The rate adapts to the X-RateLimit-Remaining and X-RateLimit-Reset
+    headers, so that the remaining requests are spread evenly over the
+    remainder of the period. A Retry-After header blocks all requests for
+    the given time.
+    """
+
+    def __init__(self, rate: float = ENSEMBL_RATE,
+                 burst: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        """
+        :param rate: maximum number of requests per second
+        :param burst: maximum number of requests that can be done without
+        pacing. Defaults to `rate`
+        :param clock: monotonic clock in seconds
+        :param sleep: function to wait a number of seconds
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = burst if burst is not None else rate
+        self.tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._blocked_until = self._updated
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until a request may be done
+        :param timeout: Optional maximum number of seconds to wait
+        :return: whether a request may be done. False, without waiting, if
+        the wait would be longer than `timeout`
+        """
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            wait = max(-(self.tokens - 1) / self.rate,
+                       self._blocked_until - now)
+            if timeout is not None and wait > timeout:
+                return False
+            self.tokens -= 1
+        if wait > 0:
+            self._sleep(wait)
+        return True
+
+    def block(self, seconds: float):
+        """Do not allow requests for a number of seconds"""
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            self._blocked_until = max(self._blocked_until, now + seconds)
+            self.tokens = min(self.tokens, 0)
+
+    def update(self, headers: Mapping[str, str]):
+        """Adapt to the rate limit headers of a response"""
+        try:
+            remaining = float(headers["X-RateLimit-Remaining"])
+            reset = float(headers["X-RateLimit-Reset"])
+        except (KeyError, TypeError, ValueError):
+            pass
+        else:
+            with self._lock:
+                self._refill(self._clock())
+                if remaining < 1:
+                    # Nothing left until the period resets
+                    self.tokens = min(self.tokens, 0)
+                    self._blocked_until = max(self._blocked_until,
+                                              self._updated + reset)
+                elif reset > 0:
+                    self.rate = min(self.max_rate, remaining / reset)
+                    self.tokens = min(self.tokens, remaining)
+        retry_after = headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                self.block(float(retry_after))
+            except ValueError:
+                self.block(DEFAULT_RETRY_AFTER)
+
+
+class EnsemblClient(object):
+    """
+    Client for the ensembl REST API that keeps its connections alive and
+    reuses them across requests, instead of connecting for every request.
+
+    Idle connections are kept in a pool. Every request takes a connection
+    from the pool, or opens a new one if none is idle, so the client can be
+    shared by multiple threads. A request on a connection that turns out
+    to be closed by the server is retried once on a new connection.
+
+    With a RateLimiter, requests are paced to stay under the rate limit
+    of the server, and requests that are rejected with status 429 are
+    retried once the server allows it.
+
+    Errors are raised as by `query_ensembl`.
+    """
+
+    def __init__(self, build: str, timeout: float = 120,
+                 server: Optional[str] = None,
+                 rate_limiter: Optional[RateLimiter] = None,
+                 rate_limited_tries: int = 5):
+        """
+        :param build: genome build of interest. Either GRCh37 or GRCh38
+        :param timeout: request timeout in seconds
+        :param server: Optional base url of the REST server
+        :param rate_limiter: Optional RateLimiter to pace requests with
+        :param rate_limited_tries: number of tries for a request that is
+        rejected because of the rate limit
+        """
+        self.build = build
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.rate_limited_tries = rate_limited_tries
+        self.server = server if server is not None else ensembl_server(build)
+        url = urllib.parse.urlsplit(self.server)
+        self._https = url.scheme == "https"
+        self._netloc = url.netloc
+        self._base_path = url.path.rstrip("/")
+        self._idle: "queue.LifoQueue[http.client.HTTPConnection]" = (
+            queue.LifoQueue())
+        # Number of connections that were opened, for inspection
+        self.connections_opened = 0
+
+    def _new_connection(self) -> http.client.HTTPConnection:
+        self.connections_opened += 1
+        if self._https:
+            return http.client.HTTPSConnection(self._netloc,
+                                               timeout=self.timeout)
+        return http.client.HTTPConnection(self._netloc, timeout=self.timeout)
+
+    def _send(self, connection: http.client.HTTPConnection, method: str,
+              path: str, body: Optional[bytes], timeout: float
+              ) -> Tuple[http.client.HTTPResponse, bytes]:
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        connection.request(method, path, body=body, headers=JSON_HEADERS)
+        response = connection.getresponse()
+        return response, response.read()
+
+    def request(self, method: str, path: str, body: Optional[bytes] = None,
+                timeout: Optional[float] = None
+                ) -> Tuple[http.client.HTTPResponse, bytes]:
+        """
+        Perform a request, and return the response with its body.
+        :param timeout: Optional timeout in seconds for the whole request,
+        including waits for the rate limit. Defaults to `self.timeout`
+        :raises: HTTPError for responses with an error status,
+        URLError if the request could not be completed in time
+        """
+        path = self._base_path + path
+        deadline = time.monotonic() + (
+            timeout if timeout is not None else self.timeout)
+        if self.rate_limiter is None:
+            return self._request(method, path, body, deadline)
+        for _ in range(self.rate_limited_tries - 1):
+            self._acquire(deadline)
+            try:
+                return self._request(method, path, body, deadline)
+            except HTTPError as e:
+                if e.code != 429:
+                    raise
+                logger.debug("Rate limited by ensembl")
+                if e.headers.get("Retry-After") is None:
+                    self.rate_limiter.block(DEFAULT_RETRY_AFTER)
+        self._acquire(deadline)
+        return self._request(method, path, body, deadline)
+
+    def _acquire(self, deadline: float):
+        """Wait for the rate limiter, but not past the deadline"""
+        if not self.rate_limiter.acquire(_remaining(deadline)):
+            raise URLError(socket.timeout("rate limit wait exceeds timeout"))
+
+    def _request(self, method: str, path: str, body: Optional[bytes],
+                 deadline: float) -> Tuple[http.client.HTTPResponse, bytes]:
+        timeout = _remaining(deadline)
+        try:
+            connection = self._idle.get_nowait()
+            reused = True
+        except queue.Empty:
+            connection = self._new_connection()
+            reused = False
+
+        try:
+            response, data = self._send(connection, method, path, body,
+                                        timeout)
+        except (http.client.HTTPException, OSError) as e:
+            connection.close()
+            if not reused:
+                raise URLError(e) from e
+            # The server may have closed an idle connection; reconnect
+            timeout = _remaining(deadline)
+            connection = self._new_connection()
+            try:
+                response, data = self._send(connection, method, path, body,
+                                            timeout)
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                raise URLError(e) from e
+
+        if response.will_close:
+            connection.close()
+        else:
+            self._idle.put(connection)
+        if self.rate_limiter is not None:
+            self.rate_limiter.update(response.headers)
+
+        if response.status >= 400:
+            raise HTTPError(self.server + path, response.status,
+                            response.reason, response.headers,
+                            io.BytesIO(data))
+        return response, data
+
+    def query(self, rs_id: str,
+              timeout: Optional[float] = None) -> QueryResult:
+        """Get ref and alt alleles for an rs id"""
+        try:
+            _, data = self.request("GET", f"/variation/human/{rs_id}"
+                                          "?content-type=application/json",
+                                   timeout=timeout)
+        except HTTPError as e:
+            error = json.loads(e.read() or b"{}").get("error") or ""
+            if "not found for human" in error:
+                raise NotFoundError("rsID not found for human")
+            raise e
+        return parse_variation(json.loads(data.decode("utf-8")))
+
+    def query_batch(self, rs_ids: List[str],
+                    timeout: Optional[float] = None
+                    ) -> Dict[str, LookupResult]:
+        """Get ref and alt alleles for multiple rs ids in a single request"""
+        if len(rs_ids) > ENSEMBL_BATCH_SIZE:
+            raise ValueError(f"Cannot query more than {ENSEMBL_BATCH_SIZE} "
+                             f"rsIDs in a single request")
+        body = json.dumps({"ids": list(rs_ids)}).encode("utf-8")
+        _, data = self.request("POST", "/variation/human", body,
+                               timeout=timeout)
+        return parse_variations(rs_ids, json.loads(data.decode("utf-8")))
+
+    def close(self):
+        """Close all idle connections"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def _remaining(deadline: float) -> float:
+    """
+    Seconds left until a `time.monotonic` deadline
+    :raises: URLError if the deadline has passed
+    """
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise URLError(socket.timeout("timed out"))
+    return remaining
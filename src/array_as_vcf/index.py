@@ -0,0 +1,189 @@
+"""
+aav.index
+~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+:license: MIT
+"""
+import logging
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger('ArrayReader')
+
+INDEX_SUFFIX = ".samples.json"
+INDEX_VERSION = 1
+# Number of header lines of OpenArray files, the last one names the columns
+OPEN_ARRAY_HEADER_LINES = 18
+
+
+class RowRanges(object):
+    """Rows of a single sample or assay, as contiguous byte ranges"""
+
+    def __init__(self, rows: int = 0,
+                 ranges: Optional[List[List[int]]] = None):
+        """
+        :param rows: number of rows
+        :param ranges: list of start offset, end offset and line number of
+        the first row, per range
+        """
+        self.rows = rows
+        self.ranges = ranges if ranges is not None else []
+
+    def add(self, start: int, end: int, line_no: int):
+        """Add a row, extending the last range if it is adjacent"""
+        self.rows += 1
+        if self.ranges and self.ranges[-1][1] == start:
+            self.ranges[-1][1] = end
+        else:
+            self.ranges.append([start, end, line_no])
+
+    def to_json(self) -> dict:
+        return {"rows": self.rows, "ranges": self.ranges}
+
+    @classmethod
+    def from_json(cls, d: dict) -> 'RowRanges':
+        return cls(d["rows"], d["ranges"])
+
+
+class SampleIndex(object):
+    """
+    Sidecar index of an OpenArray file, with the byte ranges and number of
+    rows of every Sample ID and Assay ID. Readers can seek to the rows of
+    a sample instead of scanning the whole file.
+
+    Offsets are in bytes of the encoded file, so the encoding must encode
+    tabs and newlines as single bytes, as UTF-8 and windows-1252 do.
+    The index records the size and modification time of the file, and is
+    not current anymore once either changes.
+    """
+
+    def __init__(self, size: int, mtime_ns: int,
+                 samples: Dict[str, RowRanges], assays: Dict[str, RowRanges]):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.samples = samples
+        self.assays = assays
+
+    @classmethod
+    def build(cls, path: str, encoding: Optional[str] = None,
+              n_header_lines: int = OPEN_ARRAY_HEADER_LINES
+              ) -> 'SampleIndex':
+        """
+        Index the data rows of an OpenArray file. Rows with too few
+        columns, such as empty lines, are skipped as by OpenArrayReader.
+        :raises: ValueError if the Sample ID or Assay ID column is missing
+        """
+        stat = os.stat(path)
+        encoding = encoding or "utf-8"
+        with open(path, "rb") as handle:
+            for _ in range(n_header_lines - 1):
+                handle.readline()
+            header_line = handle.readline()
+            header = header_line.decode(encoding).strip().split("\t")
+            try:
+                sample_idx = header.index("Sample ID")
+                assay_idx = header.index("Assay ID")
+            except ValueError:
+                raise ValueError(f"{path} has no Sample ID and Assay ID "
+                                 f"columns to index")
+            # Rows are indexed by the encoded values, which are only
+            # decoded once per sample and assay
+            by_sample: Dict[bytes, RowRanges] = {}
+            by_assay: Dict[bytes, RowRanges] = {}
+            n_fields = max(sample_idx, assay_idx) + 1
+            offset = handle.tell()
+            for line_no, raw_line in enumerate(handle, n_header_lines + 1):
+                start = offset
+                offset += len(raw_line)
+                if raw_line.count(b"\t") < 7:
+                    continue
+                fields = raw_line.split(b"\t", n_fields)
+                sample_ranges = by_sample.get(fields[sample_idx])
+                if sample_ranges is None:
+                    sample_ranges = by_sample[fields[sample_idx]] = RowRanges()
+                sample_ranges.add(start, offset, line_no)
+                assay_ranges = by_assay.get(fields[assay_idx])
+                if assay_ranges is None:
+                    assay_ranges = by_assay[fields[assay_idx]] = RowRanges()
+                assay_ranges.add(start, offset, line_no)
+        samples = {k.decode(encoding): v for k, v in by_sample.items()}
+        assays = {k.decode(encoding): v for k, v in by_assay.items()}
+        return cls(stat.st_size, stat.st_mtime_ns, samples, assays)
+
+    def is_current(self, path: str) -> bool:
+        """Whether the indexed file has not changed since indexing"""
+        stat = os.stat(path)
+        return (stat.st_size == self.size and
+                stat.st_mtime_ns == self.mtime_ns)
+
+    def save(self, path: str):
+        import json
+        with open(path, "w") as handle:
+            json.dump({
+                "version": INDEX_VERSION,
+                "size": self.size,
+                "mtime_ns": self.mtime_ns,
+                "samples": {k: v.to_json() for k, v in self.samples.items()},
+                "assays": {k: v.to_json() for k, v in self.assays.items()},
+            }, handle)
+
+    @classmethod
+    def load(cls, path: str) -> 'SampleIndex':
+        """:raises: ValueError for indexes of another version"""
+        import json
+        with open(path) as handle:
+            d = json.load(handle)
+        if d.get("version") != INDEX_VERSION:
+            raise ValueError(f"Index {path} has unsupported version "
+                             f"{d.get('version')}")
+        samples = {k: RowRanges.from_json(v)
+                   for k, v in d["samples"].items()}
+        assays = {k: RowRanges.from_json(v) for k, v in d["assays"].items()}
+        return cls(d["size"], d["mtime_ns"], samples, assays)
+
+
+def index_path(path: str) -> str:
+    """Path of the sidecar index of a file"""
+    return path + INDEX_SUFFIX
+
+
+def open_index(path: str, encoding: Optional[str] = None) -> SampleIndex:
+    """
+    Load the sidecar index of an OpenArray file, or build it if it does not
+    exist or is not current. A built index is saved next to the file if
+    possible.
+    """
+    sidecar = index_path(path)
+    if os.path.exists(sidecar):
+        try:
+            index = SampleIndex.load(sidecar)
+        except (ValueError, KeyError) as e:
+            logger.warning(f"Ignoring invalid index {sidecar}: {e}")
+        else:
+            if index.is_current(path):
+                return index
+            logger.info(f"Index {sidecar} is outdated.")
+    logger.info(f"Indexing samples of {path}.")
+    index = SampleIndex.build(path, encoding)
+    try:
+        index.save(sidecar)
+    except OSError as e:
+        logger.warning(f"Could not save index {sidecar}: {e}")
+    return index
+
+
+def read_ranges(path: str, ranges: List[List[int]],
+                encoding: Optional[str] = None) -> Iterator[Tuple[int, str]]:
+    """
+    Read the rows in byte ranges of a file
+    :return: iterator of line number and row, without line ending
+    """
+    encoding = encoding or "utf-8"
+    with open(path, "rb") as handle:
+        for start, end, line_no in ranges:
+            handle.seek(start)
+            chunk = handle.read(end - start).decode(encoding)
+            for i, line in enumerate(chunk.splitlines(), line_no):
+                yield i, line
@@ -6,11 +6,32 @@ aav.lookup
 :copyright: (c) 2018 Leiden University Medical Center
 :license: MIT
 """
-import json
-import urllib.request
-from typing import Dict, List, NamedTuple, Optional
+import enum
+import logging
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import (Callable, Dict, Iterable, Iterator, List, Mapping,
+                    NamedTuple, Optional, Set, TextIO, Tuple, Union)
 from urllib.error import HTTPError, URLError
 
+logger = logging.getLogger('RSLookup')
+
+# Maximum number of ids ensembl accepts in a single POST request
+ENSEMBL_BATCH_SIZE = 200
+# Maximum delay in seconds between tries of a request
+MAX_BACKOFF = 30
+# Upper bounds in seconds of the buckets of the request latency histogram
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float("inf"))
+# Compressed json lookup tables
+GZIP_MAGIC = b"\x1f\x8b"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+GZIP_LEVEL = 6
+COMPRESSED_EXTENSIONS = {".gz": "gz", ".xz": "xz"}
+
 
 class QueryResult(NamedTuple):
     ref: str
@@ -35,8 +56,50 @@ class QueryResult(NamedTuple):
         return cls(ref, alts, ref_is_minor)
 
 
-def serialize_query_results(results: Dict[str, Optional[QueryResult]]) -> str:
+class MissingReason(enum.Enum):
+    not_found = "not_found"
+    unmapped = "unmapped"
+    error = "error"
+
+
+class MissingResult(NamedTuple):
+    """An rs id that could not be retrieved from ensembl"""
+    reason: MissingReason
+    timestamp: float
+
+    def serialize(self) -> str:
+        return f"!{self.reason.value}:{int(self.timestamp)}"
+
+    @classmethod
+    def deserialize(cls, string: str):
+        items = string[1:].split(":")
+        if not string.startswith("!") or len(items) != 2:
+            raise ValueError(f"Cannot deserialize string {string}")
+        reason, timestamp = items
+        return cls(MissingReason(reason), float(timestamp))
+
+
+LookupResult = Union[QueryResult, MissingResult]
+
+
+def deserialize_result(string: str) -> LookupResult:
+    """Deserialize a QueryResult, or a MissingResult"""
+    if string.startswith("!"):
+        return MissingResult.deserialize(string)
+    return QueryResult.deserialize(string)
+
+
+class NotFoundError(RuntimeError):
+    """rsID is not known to ensembl"""
+
+
+class UnmappedError(RuntimeError):
+    """rsID does not map to the genome"""
+
+
+def serialize_query_results(results: Dict[str, Optional[LookupResult]]) -> str:  # noqa
     """Serialize as json"""
+    import json
     serialized_dict = dict()
     for k, v in results.items():
         if v is not None:
@@ -46,54 +109,169 @@ def serialize_query_results(results: Dict[str, Optional[QueryResult]]) -> str:
     return json.dumps(serialized_dict)
 
 
-def deserialize_query_results(json_str: str) -> Dict[str, Optional[QueryResult]]:  # noqa
+def deserialize_query_results(json_str: str) -> Dict[str, Optional[LookupResult]]:  # noqa
     """Deserialize from json"""
+    import json
     d = json.loads(json_str)
     deserialized_dict = dict()
     for k, v in d.items():
         if v is not None:
-            deserialized_dict[k] = QueryResult.deserialize(v)
+            deserialized_dict[k] = deserialize_result(v)
         else:
             deserialized_dict[k] = None
     return deserialized_dict
 
 
-def query_ensembl(rs_id: str, build: str,
-                  timeout: float = 120) -> QueryResult:
+_STRING = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+# A single member of a json lookup table, with the following separator
+_ENTRY = re.compile(
+    rf"\s*({_STRING})\s*:\s*({_STRING}|null)\s*([,}}])")
+_START = re.compile(r"\s*{\s*(}?)")
+
+
+def _json_string(literal: str) -> str:
+    if "\\" in literal:
+        import json
+        return json.loads(literal)
+    return literal[1:-1]
+
+
+def iter_json_table(handle: TextIO, chunk_size: int = 1 << 16
+                    ) -> Iterator[Tuple[str, Optional[str]]]:
     """
-    Get ref and alt alleles for an rs id from ensembl
+    Iterate over the serialized entries of a json lookup table, reading
+    the file handle in chunks instead of loading the document at once.
+    :param handle: text handle positioned at the start of the table
+    :param chunk_size: number of characters to read at a time
+    :return: iterator of rs id and serialized result or None
+    :raises: ValueError if the document is not a json object of strings or
+    nulls
+    """
+    buf = handle.read(chunk_size)
+    eof = not buf
+    while not eof and buf.strip() in ("", "{"):
+        chunk = handle.read(chunk_size)
+        eof = not chunk
+        buf += chunk
+    start = _START.match(buf)
+    if start is None:
+        raise ValueError(f"Invalid lookup table at {buf[:40]!r}")
+    pos = start.end()
+    closed = bool(start.group(1))
+    while not closed:
+        # Entries can span chunks, so only the complete ones are consumed
+        for m in _ENTRY.finditer(buf, pos):
+            if m.start() != pos:
+                break
+            pos = m.end()
+            key, value, separator = m.groups()
+            yield _json_string(key), (
+                _json_string(value) if value != "null" else None)
+            if separator == "}":
+                closed = True
+                break
+        if closed:
+            break
+        if eof:
+            raise ValueError(f"Invalid lookup table at "
+                             f"{buf[pos:pos + 40]!r}")
+        chunk = handle.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + chunk
+        pos = 0
+    if buf[pos:].strip() or handle.read(chunk_size).strip():
+        raise ValueError("Extra data after lookup table")
 
-    :param rs_id: The rsID to query
-    :param build: genome build of interest. Either Grch37 or GRCh38
-    :param timeout: request timeout in seconds (default = 120)
+
+def read_query_results(handle: TextIO
+                       ) -> Iterator[Tuple[str, Optional[LookupResult]]]:
+    """Deserialize a json lookup table entry by entry from a file handle"""
+    for rs_id, serialized in iter_json_table(handle):
+        if serialized is not None:
+            yield rs_id, deserialize_result(serialized)
+        else:
+            yield rs_id, None
+
+
+def write_query_results(results: Mapping[str, Optional[LookupResult]],
+                        handle: TextIO):
+    """
+    Serialize as json entry by entry to a file handle, without building the
+    document in memory. The output is identical to that of
+    `serialize_query_results`.
+    """
+    from json.encoder import encode_basestring_ascii as encode
+    separator = "{"
+    for rs_id, result in results.items():
+        handle.write(f"{separator}{encode(rs_id)}: " + (
+            encode(result.serialize()) if result is not None else "null"))
+        separator = ", "
+    handle.write("}" if separator == ", " else "{}")
+
+
+def table_compression(path: str) -> Optional[str]:
     """
+    Get the compression of a json lookup table, "gz" or "xz", from the
+    magic bytes of an existing file or else from the extension of the path.
+    :return: the compression, or None for plain tables
+    """
+    if os.path.isfile(path) and os.path.getsize(path) > 0:
+        with open(path, "rb") as handle:
+            magic = handle.read(len(XZ_MAGIC))
+        if magic.startswith(GZIP_MAGIC):
+            return "gz"
+        return "xz" if magic == XZ_MAGIC else None
+    return COMPRESSED_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+
 
+def open_table(path: str, mode: str = "r") -> TextIO:
+    """
+    Open a json lookup table as text, decompressing or compressing it on
+    the fly if it is gzip or xz compressed. Tables are written compressed
+    if the path ends in .gz or .xz.
+    :param mode: "r" or "w"
+    """
+    if mode == "r":
+        compression = table_compression(path)
+    else:
+        compression = COMPRESSED_EXTENSIONS.get(
+            os.path.splitext(path)[1].lower())
+    if compression == "gz":
+        import gzip
+        return gzip.open(path, mode + "t", compresslevel=GZIP_LEVEL,
+                         encoding="utf-8")
+    if compression == "xz":
+        import lzma
+        return lzma.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode)
+
+
+def ensembl_server(build: str) -> str:
+    """
+    Get the ensembl REST server for a genome build
+
+    :param build: genome build of interest. Either GRCh37 or GRCh38
+    :raises: NotImplementedError for unknown builds
+    """
     if build.upper() == "GRCH38":
-        url_prefix = "https://"
+        return "https://rest.ensembl.org"
     elif build.upper() == "GRCH37":
-        url_prefix = "https://grch37."
+        return "https://grch37.rest.ensembl.org"
     else:
         raise NotImplementedError
 
-    url = "{0}rest.ensembl.org/variation/human/{1}?{2}".format(
-        url_prefix,
-        rs_id,
-        "content-type=application/json"
-    )
-    try:
-        with urllib.request.urlopen(url, timeout=timeout) as f:
-            response = f.read().decode("utf-8")
-    except HTTPError as e:
-        if not 200 <= e.status < 300:
-            error = json.loads(e.read()).get('error')
-            if "not found for human" in error:
-                raise RuntimeError("rsID not found for human")
-            raise e
-    j = json.loads(response)
+
+def parse_variation(j: dict) -> QueryResult:
+    """
+    Get ref and alt alleles from an ensembl variation record
+
+    :param j: the decoded json record of a single variation
+    :raises: UnmappedError if the variation does not map to the genome
+    """
     try:
         allele_string = j.get("mappings", [{}])[0].get("allele_string", "")
     except IndexError:  # mapping may be `mapping: []` when it does not map to genome # noqa
-        raise RuntimeError("rsID does not map to genome")
+        raise UnmappedError("rsID does not map to genome")
 
     minor_allele = j.get("minor_allele")
 
@@ -111,6 +289,257 @@ def query_ensembl(rs_id: str, build: str,
         return QueryResult(ref, [], ref_is_minor)
 
 
+def parse_variations(rs_ids: Iterable[str],
+                     response: dict) -> Dict[str, LookupResult]:
+    """
+    Get ref and alt alleles from the response of a batch variation request
+
+    :param rs_ids: the requested rs ids
+    :param response: the decoded json response, keyed by rs id
+    :return: QueryResult or MissingResult per requested rs id
+    """
+    now = time.time()
+    results = dict()
+    for rs_id in rs_ids:
+        if rs_id not in response:
+            results[rs_id] = MissingResult(MissingReason.not_found, now)
+            continue
+        try:
+            results[rs_id] = parse_variation(response[rs_id])
+        except UnmappedError:
+            results[rs_id] = MissingResult(MissingReason.unmapped, now)
+    return results
+
+
+def query_ensembl(rs_id: str, build: str,
+                  timeout: float = 120,
+                  server: Optional[str] = None) -> QueryResult:
+    """
+    Get ref and alt alleles for an rs id from ensembl
+
+    :param rs_id: The rsID to query
+    :param build: genome build of interest. Either Grch37 or GRCh38
+    :param timeout: request timeout in seconds (default = 120)
+    :param server: base url of the REST server. Defaults to the ensembl
+    server for `build`
+    """
+    import json
+    import urllib.request
+    if server is None:
+        server = ensembl_server(build)
+
+    url = "{0}/variation/human/{1}?{2}".format(
+        server,
+        rs_id,
+        "content-type=application/json"
+    )
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as f:
+            response = f.read().decode("utf-8")
+    except HTTPError as e:
+        if not 200 <= e.status < 300:
+            error = json.loads(e.read()).get('error')
+            if "not found for human" in error:
+                raise NotFoundError("rsID not found for human")
+            raise e
+    return parse_variation(json.loads(response))
+
+
+def query_ensembl_batch(rs_ids: List[str], build: str,
+                        timeout: float = 120,
+                        server: Optional[str] = None
+                        ) -> Dict[str, LookupResult]:
+    """
+    Get ref and alt alleles for multiple rs ids from ensembl in a single
+    request. rs ids that are not found, or that do not map to the genome,
+    get a MissingResult.
+
+    :param rs_ids: The rsIDs to query. At most ENSEMBL_BATCH_SIZE
+    :param build: genome build of interest. Either Grch37 or GRCh38
+    :param timeout: request timeout in seconds (default = 120)
+    :param server: base url of the REST server. Defaults to the ensembl
+    server for `build`
+    """
+    if len(rs_ids) > ENSEMBL_BATCH_SIZE:
+        raise ValueError(f"Cannot query more than {ENSEMBL_BATCH_SIZE} "
+                         f"rsIDs in a single request")
+    import json
+    import urllib.request
+    if server is None:
+        server = ensembl_server(build)
+
+    request = urllib.request.Request(
+        "{0}/variation/human".format(server),
+        data=json.dumps({"ids": list(rs_ids)}).encode("utf-8"),
+        headers={"Content-Type": "application/json",
+                 "Accept": "application/json"},
+        method="POST"
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as f:
+        response = json.loads(f.read().decode("utf-8"))
+    return parse_variations(rs_ids, response)
+
+
+class CircuitBreaker(object):
+    """
+    Stops requests to a failing server.
+
+    The breaker opens after `max_failures` consecutive failures, and denies
+    all requests. After `reset_timeout` seconds, a single probe request is
+    allowed through (half-open). If it succeeds the breaker closes again,
+    otherwise it stays open for another `reset_timeout` seconds.
+    """
+
+    def __init__(self, max_failures: int = 5, reset_timeout: float = 60,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        :param max_failures: number of consecutive failures that open the
+        breaker
+        :param reset_timeout: seconds after which an open breaker allows a
+        probe request
+        :param clock: monotonic clock in seconds
+        """
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        """Whether a request may be done"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if (self._probing or
+                    self._clock() - self._opened_at < self.reset_timeout):
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Ensembl recovered, resuming requests.")
+            self.failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or (self._opened_at is None and
+                                 self.failures >= self.max_failures):
+                if self._opened_at is None:
+                    logger.warning(
+                        f"{self.failures} consecutive Ensembl requests "
+                        f"failed, pausing requests for "
+                        f"{self.reset_timeout} seconds.")
+                self._opened_at = self._clock()
+                self._probing = False
+
+
+def failure_reason(error: Exception) -> str:
+    """
+    Classify a failed request: "http_<status>", "timeout", "connection"
+    or "error"
+    """
+    import socket
+    if isinstance(error, HTTPError):
+        return f"http_{error.code}"
+    reason = getattr(error, "reason", error)
+    if isinstance(reason, (socket.timeout, TimeoutError)):
+        return "timeout"
+    if isinstance(error, URLError):
+        return "connection"
+    return "error"
+
+
+class LookupStats(object):
+    """
+    Counters of an RSLookup, safe to update from multiple threads.
+
+    Hits are lookups answered from the table, misses are rs ids that
+    required a request. Requests are counted per try, with a latency
+    histogram over all tries and the failures per `failure_reason`.
+    Results are the fetched entries per outcome.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.successes = 0
+        self.failures: Dict[str, int] = {}
+        self.retries = 0
+        self.results = {"found": 0, **{x.value: 0 for x in MissingReason}}
+        self.latency_total = 0.0
+        self.latency_counts = [0] * len(LATENCY_BUCKETS)
+        self.backoff_total = 0.0
+
+    def hit(self, n: int = 1):
+        with self._lock:
+            self.hits += n
+
+    def miss(self, n: int = 1):
+        with self._lock:
+            self.misses += n
+
+    def request(self, duration: float, retry: bool,
+                error: Optional[Exception] = None):
+        """Record a single try of a request"""
+        bucket = next(i for i, bound in enumerate(LATENCY_BUCKETS)
+                      if duration <= bound)
+        with self._lock:
+            self.latency_total += duration
+            self.latency_counts[bucket] += 1
+            if retry:
+                self.retries += 1
+            if error is None:
+                self.successes += 1
+            else:
+                reason = failure_reason(error)
+                self.failures[reason] = self.failures.get(reason, 0) + 1
+
+    def backoff(self, delay: float):
+        with self._lock:
+            self.backoff_total += delay
+
+    def result(self, result: LookupResult):
+        outcome = ("found" if not isinstance(result, MissingResult)
+                   else result.reason.value)
+        with self._lock:
+            self.results[outcome] += 1
+
+    def as_dict(self) -> dict:
+        """All counters, as a json serializable dict"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "requests": {
+                    "successes": self.successes,
+                    "failures": dict(self.failures),
+                    "retries": self.retries,
+                },
+                "results": dict(self.results),
+                "latency": {
+                    "count": sum(self.latency_counts),
+                    "total_seconds": self.latency_total,
+                    "histogram": {
+                        str(bound) if bound != float("inf") else "+Inf": n
+                        for bound, n in zip(LATENCY_BUCKETS,
+                                            self.latency_counts)},
+                },
+                "backoff_seconds": self.backoff_total,
+            }
+
+
 class RSLookup(object):
     """
     Object to look up ref and alt positions for rs ids
@@ -124,49 +553,370 @@ class RSLookup(object):
                  init_d: dict = None,
                  request_timeout: float = 120,
                  request_tries: int = 1,
-                 ensembl_lookup: bool = True):
+                 ensembl_lookup: bool = True,
+                 server: Optional[str] = None,
+                 batch_size: int = ENSEMBL_BATCH_SIZE,
+                 journal: Optional[str] = None,
+                 missing_ttl: Optional[float] = None,
+                 error_ttl: Optional[float] = 0,
+                 client=None,
+                 retry_backoff: float = 0.5,
+                 max_failures: Optional[int] = 5,
+                 breaker_reset: float = 60,
+                 lookup_budget: Optional[float] = None):
         """
         Create lookup table.
         :param build: genome build. Either GRCH37 or GRCH38
-        :param init_d: Optional dict with known rs ids
+        :param init_d: Optional dict, or other mutable mapping such as
+        SQLiteStore, with known rs ids
         :param request_timeout: timeout in seconds for requests
         :param request_tries: number of tries for a timed-out request
+        :param server: Optional base url of the ensembl REST server
+        :param batch_size: number of rs ids per request when prefetching
+        :param journal: Optional path to a journal that changes to the
+        table are appended to. An existing journal is replayed.
+        :param missing_ttl: seconds after which rs ids that were not found
+        or did not map are requested again. None to never request them again
+        :param error_ttl: seconds after which rs ids that failed with an
+        error are requested again. rs ids are never requested twice by
+        the same lookup table
+        :param client: Optional EnsemblClient to perform requests with,
+        instead of opening a new connection for every request. Clients are
+        called as `query(rs_id, timeout)` and `query_batch(rs_ids, timeout)`
+        :param retry_backoff: base delay in seconds between tries. The delay
+        is drawn at random, up to twice the previous maximum
+        :param max_failures: number of consecutive failed requests after
+        which ensembl is considered down, and missing rs ids are treated as
+        with `ensembl_lookup` disabled. None to never stop requesting
+        :param breaker_reset: seconds after which a single request is done
+        to check whether ensembl has recovered
+        :param lookup_budget: Optional total number of seconds to spend on
+        requests, counted from the first request. When it is spent, missing
+        rs ids are treated as with `ensembl_lookup` disabled
         """
         self.build = build
         self.request_tries = request_tries
         self.request_timeout = request_timeout
         self.ensembl_lookup = ensembl_lookup
-        if init_d:
+        self.server = server
+        self.batch_size = min(batch_size, ENSEMBL_BATCH_SIZE)
+        self.missing_ttl = missing_ttl
+        self.error_ttl = error_ttl
+        self.client = client
+        self.retry_backoff = retry_backoff
+        self.breaker = (CircuitBreaker(max_failures, breaker_reset)
+                        if max_failures is not None else None)
+        self.lookup_budget = lookup_budget
+        self.counters = LookupStats()
+        self.__deadline: Optional[float] = None
+        self.__budget_spent = False
+        if init_d is not None:
             self.__rsids = init_d
         else:
             self.__rsids = {}
+        if journal is not None:
+            from .stores import JournalStore
+            self.__rsids = JournalStore(journal, self.__rsids)
+        # rs ids that could not be retrieved by this lookup table
+        self.__failed = set()
 
     def __getitem__(self, rs_id: str) -> Optional[QueryResult]:
-        if rs_id not in self.__rsids and self.ensembl_lookup:
-            self.__rsids[rs_id] = self._get_ensembl(rs_id)
+        if not self._needs_request(rs_id):
+            self.counters.hit()
+        else:
+            self.counters.miss()
+            if self.ensembl_lookup:
+                fetched = self._get_ensembl(rs_id)
+                if fetched is not None:
+                    self._store(rs_id, fetched)
 
+        result = self.__rsids[rs_id]
+        if isinstance(result, MissingResult):
+            raise KeyError(f"Failed to retrieve {rs_id} from ensembl: "
+                           f"{result.reason.value}")
+        return result
+
+    def _needs_request(self, rs_id: str) -> bool:
+        if rs_id in self.__failed:
+            return False
+        try:
+            result = self.__rsids[rs_id]
+        except KeyError:
+            return True
+        if not isinstance(result, MissingResult):
+            return False
+        if result.reason == MissingReason.error:
+            ttl = self.error_ttl
+        else:
+            ttl = self.missing_ttl
+        return ttl is not None and time.time() - result.timestamp >= ttl
+
+    def _store(self, rs_id: str, result: LookupResult):
+        """Store a fetched result"""
+        self.counters.result(result)
+        if isinstance(result, MissingResult):
+            logger.debug(f"Failed to retrieve {rs_id}: {result.reason.value}")
+            self.__failed.add(rs_id)
+        self.__rsids[rs_id] = result
+
+    def missing(self, rs_ids: Iterable[str]) -> Set[str]:
+        """Get the distinct rs ids that would require a request to ensembl"""
+        return {rs_id for rs_id in rs_ids if self._needs_request(rs_id)}
+
+    def prefetch(self, rs_ids: Iterable[str], workers: int = 1) -> int:
+        """
+        Retrieve all unknown rs ids from ensembl concurrently, so that
+        subsequent lookups do not have to wait on the network.
+        rs ids are requested in batches of `batch_size`.
+        rs ids that cannot be retrieved are stored as MissingResult, and
+        raise a KeyError on access.
+
+        :param rs_ids: rs ids that are going to be looked up
+        :param workers: maximum number of concurrent requests
+        :return: number of rs ids added to the table
+        """
+        if not self.ensembl_lookup:
+            return 0
+        missing = sorted(self.missing(rs_ids))
+        self.counters.miss(len(missing))
+        added = 0
+        for rs_id, result in self.fetch(missing, workers):
+            self._store(rs_id, result)
+            if isinstance(result, QueryResult):
+                added += 1
+        return added
+
+    def fetch(self, rs_ids: List[str], workers: int = 1
+              ) -> Iterator[Tuple[str, LookupResult]]:
+        """
+        Request rs ids from ensembl concurrently, in batches of
+        `batch_size`, without storing them in the table.
+        rs ids are not requested if ensembl is considered down or the
+        lookup budget is spent.
+
+        :param rs_ids: distinct rs ids to request
+        :param workers: maximum number of concurrent requests
+        :return: iterator of rs id and result, in order of arrival
+        """
+        batch_size = max(self.batch_size, 1)
+        batches = [rs_ids[i:i + batch_size]
+                   for i in range(0, len(rs_ids), batch_size)]
+        logger.info(f"Requesting {len(rs_ids)} rsIDs from ensembl in "
+                    f"{len(batches)} requests with {workers} workers.")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self._get_ensembl_batch, batch): batch
+                       for batch in batches}
+            for future in as_completed(futures):
+                results = future.result()
+                if results is None:
+                    continue
+                for rs_id in futures[future]:
+                    yield rs_id, results.get(rs_id, MissingResult(
+                        MissingReason.not_found, time.time()))
+
+    def cached(self, rs_id: str) -> Optional[LookupResult]:
+        """
+        Get the entry of the table for an rs id, including MissingResult
+        entries, without requesting it.
+        :raises: KeyError if the rs id is not in the table
+        """
         return self.__rsids[rs_id]
 
-    def _get_ensembl(self, rs_id) -> QueryResult:
-        for _ in range(self.request_tries):
+    def stats(self) -> dict:
+        """
+        Get the counters of the lookup table: cache hits and misses,
+        successful and failed requests per reason, retries, the number of
+        fetched entries per outcome, and a histogram of request latencies
+        in seconds. See `LookupStats`.
+        """
+        return self.counters.as_dict()
+
+    def _remaining_budget(self) -> Optional[float]:
+        """Seconds left of the lookup budget, or None without a budget"""
+        if self.lookup_budget is None:
+            return None
+        now = time.monotonic()
+        if self.__deadline is None:
+            self.__deadline = now + self.lookup_budget
+        return self.__deadline - now
+
+    def _timeout(self) -> Optional[float]:
+        """
+        Timeout for the next request, or None if no request may be done
+        because ensembl is down or the lookup budget is spent
+        """
+        remaining = self._remaining_budget()
+        if remaining is not None and remaining <= 0:
+            if not self.__budget_spent:
+                self.__budget_spent = True
+                logger.warning("Lookup budget spent, no longer requesting "
+                               "rsIDs from ensembl.")
+            return None
+        if self.breaker is not None and not self.breaker.allow():
+            return None
+        if remaining is None:
+            return self.request_timeout
+        return min(self.request_timeout, remaining)
+
+    def _record(self, attempt: int, started: float,
+                error: Optional[Exception] = None):
+        """
+        Record a try of a request that started at `started`, a
+        `time.perf_counter` value
+        """
+        self.counters.request(time.perf_counter() - started, attempt > 0,
+                              error)
+        success = error is None
+        if self.breaker is not None:
+            if success:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+    def _backoff_delay(self, attempt: int) -> float:
+        """Delay before a retry, with exponential backoff and full jitter"""
+        if attempt == 0 or self.retry_backoff <= 0:
+            return 0
+        delay = random.uniform(
+            0, min(self.retry_backoff * 2 ** (attempt - 1), MAX_BACKOFF))
+        remaining = self._remaining_budget()
+        if remaining is not None:
+            delay = max(min(delay, remaining), 0)
+        self.counters.backoff(delay)
+        return delay
+
+    def _backoff(self, attempt: int):
+        delay = self._backoff_delay(attempt)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _get_ensembl(self, rs_id) -> Optional[LookupResult]:
+        """
+        :return: the result, or None if no request was done
+        """
+        for attempt in range(self.request_tries):
+            self._backoff(attempt)
+            timeout = self._timeout()
+            if timeout is None:
+                if attempt == 0:
+                    return None
+                break
+            started = time.perf_counter()
             try:
-                return query_ensembl(rs_id, self.build, self.request_timeout)
-            except (HTTPError, URLError, RuntimeError):
+                if self.client is not None:
+                    result = self.client.query(rs_id, timeout)
+                else:
+                    result = query_ensembl(rs_id, self.build, timeout,
+                                           self.server)
+            except NotFoundError:
+                result = MissingResult(MissingReason.not_found, time.time())
+            except UnmappedError:
+                result = MissingResult(MissingReason.unmapped, time.time())
+            except (HTTPError, URLError, OSError, ValueError,
+                    RuntimeError) as e:
+                # Read timeouts are raised as socket.timeout, which is not
+                # wrapped in a URLError by urllib
+                self._record(attempt, started, e)
                 continue
-        raise KeyError(f"Failed to retrieve {rs_id} from ensembl")
+            self._record(attempt, started)
+            return result
+        return MissingResult(MissingReason.error, time.time())
+
+    def _get_ensembl_batch(self, rs_ids: List[str]
+                           ) -> Optional[Dict[str, LookupResult]]:
+        """
+        :return: the results, or None if no request was done
+        """
+        if len(rs_ids) == 1:
+            result = self._get_ensembl(rs_ids[0])
+            return {rs_ids[0]: result} if result is not None else None
+        for attempt in range(self.request_tries):
+            self._backoff(attempt)
+            timeout = self._timeout()
+            if timeout is None:
+                if attempt == 0:
+                    return None
+                break
+            started = time.perf_counter()
+            try:
+                if self.client is not None:
+                    results = self.client.query_batch(rs_ids, timeout)
+                else:
+                    results = query_ensembl_batch(rs_ids, self.build,
+                                                  timeout, self.server)
+            except (HTTPError, URLError, OSError, ValueError) as e:
+                self._record(attempt, started, e)
+                continue
+            self._record(attempt, started)
+            return results
+        error = MissingResult(MissingReason.error, time.time())
+        return {rs_id: error for rs_id in rs_ids}
 
     def dumps(self) -> str:
         """Dump table to json-formatted string"""
         return serialize_query_results(self.__rsids)
 
+    def dump(self, path: str, merge: bool = False):
+        """
+        Write table to path. Paths with an sqlite (.db, .sqlite) or binary
+        (.bin) extension, or pointing to an existing table of those types,
+        are written in that format. Otherwise the table is written as json,
+        compressed if the path ends in .gz or .xz.
+        :param merge: merge the table into an existing table at path under
+        a file lock, instead of overwriting it. See `stores.merge_into`. An
+        sqlite table that this table was loaded from is only flushed
+        """
+        from .stores import JournalStore, SQLiteStore, merge_into, write_store
+        if merge:
+            store = self.__rsids
+            if isinstance(store, JournalStore):
+                store = store.store
+            if isinstance(store, SQLiteStore):
+                # The merge locks the database, which would block writing
+                # the buffered entries
+                store.flush()
+                if os.path.abspath(store.path) == os.path.abspath(path):
+                    return  # entries are already upserted in place
+            merge_into(path, [self.__rsids.items()])
+        elif not write_store(self.__rsids, path):
+            with open_table(path, "w") as handle:
+                write_query_results(self.__rsids, handle)
+
+    def close(self):
+        """
+        Write pending changes of the underlying store, if any, and close
+        the connections of the client
+        """
+        if hasattr(self.__rsids, "close"):
+            self.__rsids.close()
+        if self.client is not None:
+            self.client.close()
+
     def __len__(self):
         return len(self.__rsids)
 
     @classmethod
     def from_path(cls, path: str, build: str, request_timeout: float = 120,
-                  request_tries: int = 1, ensembl_lookup: bool = True):
-        with open(path, 'r') as handle:
-            js = handle.read()
-        init_d = deserialize_query_results(js)
-        return cls(build, init_d, request_timeout=request_timeout,
-                   request_tries=request_tries, ensembl_lookup=ensembl_lookup)
+                  request_tries: int = 1, ensembl_lookup: bool = True,
+                  lazy: bool = False, compact: bool = False, **kwargs):
+        """
+        Create lookup table from a json, binary or sqlite table. json
+        tables are read entry by entry, and may be gzip or xz compressed.
+        :param lazy: only deserialize entries of a json table on first
+        access
+        :param compact: store entries of a json table in an InternedStore.
+        Takes precedence over `lazy`
+        """
+        from .stores import InternedStore, LazyStore, open_store
+        store = open_store(path)
+        if store is None:
+            with open_table(path, "r") as handle:
+                if compact:
+                    store = InternedStore(iter_json_table(handle))
+                elif lazy:
+                    store = LazyStore(dict(iter_json_table(handle)))
+                else:
+                    store = dict(read_query_results(handle))
+        return cls(build, store, request_timeout=request_timeout,
+                   request_tries=request_tries, ensembl_lookup=ensembl_lookup,
+                   **kwargs)
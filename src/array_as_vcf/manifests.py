@@ -0,0 +1,241 @@
+"""
+aav.manifests
+~~~~~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+:license: MIT
+"""
+import csv
+import logging
+from typing import Dict, Iterator, List, Optional, TextIO, Tuple
+
+from .lookup import QueryResult
+
+logger = logging.getLogger('RSLookup')
+
+COMPLEMENT = {"A": "T", "C": "G", "G": "C", "T": "A"}
+
+
+def complement(allele: str) -> str:
+    """Complement of a single base allele, or the allele itself if unknown"""
+    return COMPLEMENT.get(allele, allele)
+
+
+class ReferenceGenome(object):
+    """
+    Reads single bases from a fasta file indexed with `samtools faidx`,
+    without loading it.
+    """
+
+    def __init__(self, path: str, index_path: Optional[str] = None):
+        """
+        :param path: path to fasta file
+        :param index_path: path to the fai index. Defaults to `path`.fai
+        """
+        self.path = path
+        # name -> (length, offset, bases per line, bytes per line)
+        self.index: Dict[str, Tuple[int, int, int, int]] = {}
+        with open(index_path or path + ".fai") as handle:
+            for line in handle:
+                name, length, offset, line_bases, line_width = (
+                    line.split("\t")[:5])
+                self.index[name] = (int(length), int(offset),
+                                    int(line_bases), int(line_width))
+        self.handle = open(path, "rb")
+
+    def _name(self, chrom: str) -> Optional[str]:
+        if chrom.startswith("chr"):
+            chrom = chrom[3:]
+        if chrom == "23":
+            chrom = "X"
+        elif chrom == "24":
+            chrom = "Y"
+        for name in (chrom, "chr" + chrom):
+            if name in self.index:
+                return name
+        if chrom in ("M", "MT"):
+            for name in ("MT", "chrM"):
+                if name in self.index:
+                    return name
+        return None
+
+    def base(self, chrom: str, pos: int) -> Optional[str]:
+        """
+        Get the upper case reference base at a 1-based position, or None if
+        the position is not in the reference
+        """
+        name = self._name(chrom)
+        if name is None:
+            return None
+        length, offset, line_bases, line_width = self.index[name]
+        if not 0 < pos <= length:
+            return None
+        self.handle.seek(offset + (pos - 1) // line_bases * line_width +
+                         (pos - 1) % line_bases)
+        return self.handle.read(1).decode("ascii").upper()
+
+    def close(self):
+        self.handle.close()
+
+
+def orient(alleles: List[str], ref_base: Optional[str],
+           strand: Optional[str]) -> Optional[List[str]]:
+    """
+    Get alleles on the plus strand, either from the strand of the manifest
+    or by matching them to the reference base.
+    :return: plus strand alleles, or None if the strand cannot be determined
+    """
+    if strand == "+":
+        return alleles
+    if strand == "-":
+        return [complement(x) for x in alleles]
+    if ref_base is None:
+        return None
+    complemented = [complement(x) for x in alleles]
+    if ref_base in alleles and ref_base not in complemented:
+        return alleles
+    if ref_base in complemented and ref_base not in alleles:
+        return complemented
+    # A/T and C/G SNPs match the reference on both strands
+    return None
+
+
+def _skip_comments(handle: TextIO, prefix: str) -> Iterator[str]:
+    for line in handle:
+        if not line.startswith(prefix):
+            yield line
+
+
+def read_affy_annotation(path: str,
+                         reference: Optional[ReferenceGenome] = None,
+                         encoding: Optional[str] = None
+                         ) -> Iterator[Tuple[str, QueryResult]]:
+    """
+    Get lookup entries from an Affymetrix annotation csv file.
+
+    Allele A and B are reported on the strand of the `Strand` column. The
+    reference allele is taken from the `Ref Allele` column of Axiom
+    annotation files, or else from the reference genome. Probes without a
+    reference allele are skipped. The reference is minor if it is the
+    allele of the `Minor Allele` column.
+
+    :param path: path to annotation csv file
+    :param reference: Optional reference genome of the annotation build
+    :param encoding: optional encoding of the file
+    :return: iterator of rs id and QueryResult
+    """
+    skipped = 0
+    with open(path, newline="", encoding=encoding) as handle:
+        for row in csv.DictReader(_skip_comments(handle, "#")):
+            rs_id = row["dbSNP RS ID"]
+            if not rs_id.startswith("rs"):
+                continue
+            strand = row.get("Strand")
+            alleles = orient([row["Allele A"], row["Allele B"]], None, strand)
+            ref = row.get("Ref Allele")
+            if ref is None or ref in ("", "---"):
+                ref = None
+                if reference is not None:
+                    try:
+                        ref = reference.base(row["Chromosome"],
+                                             int(row["Physical Position"]))
+                    except ValueError:  # position is ---
+                        ref = None
+            if alleles is None or ref not in alleles:
+                skipped += 1
+                continue
+            minor = row.get("Minor Allele", "")
+            if strand == "-":
+                minor = complement(minor)
+            ref_is_minor = ref == minor if minor in alleles else None
+            yield rs_id, QueryResult(ref, [x for x in alleles if x != ref],
+                                     ref_is_minor)
+    if skipped > 0:
+        logger.warning(f"Skipped {skipped} probes without reference allele "
+                       f"in {path}.")
+
+
+def read_illumina_manifest(path: str, reference: ReferenceGenome,
+                           encoding: Optional[str] = None
+                           ) -> Iterator[Tuple[str, QueryResult]]:
+    """
+    Get lookup entries from the [Assay] section of an Illumina manifest
+    csv file, keyed by the `Name` column.
+
+    Illumina manifests do not contain the reference allele, so it is taken
+    from the reference genome. They do not contain allele frequencies
+    either; instead the reference is marked as minor if it is the B allele.
+    This is how the Lumi readers interpret it: AA is called homozygous
+    reference, unless the reference is minor.
+
+    The alleles of the `SNP` column are oriented with the `RefStrand`
+    column if present, or else by matching them to the reference genome.
+    A/T and C/G probes without `RefStrand` are skipped.
+
+    :param path: path to manifest csv file
+    :param reference: reference genome of the manifest build
+    :param encoding: optional encoding of the file
+    :return: iterator of name and QueryResult
+    """
+    skipped = 0
+    with open(path, newline="", encoding=encoding) as handle:
+        for line in handle:
+            if line.startswith("[Assay]"):
+                break
+        for row in csv.DictReader(handle):
+            if row["IlmnID"].startswith("[Controls]"):
+                break
+            alleles = row["SNP"].strip("[]").split("/")
+            try:
+                ref_base = reference.base(row["Chr"], int(row["MapInfo"]))
+            except ValueError:
+                ref_base = None
+            alleles = orient(alleles, ref_base, row.get("RefStrand"))
+            if alleles is None or ref_base not in alleles:
+                skipped += 1
+                continue
+            yield row["Name"], QueryResult(
+                ref_base, [x for x in alleles if x != ref_base],
+                ref_base != alleles[0])
+    if skipped > 0:
+        logger.warning(f"Skipped {skipped} probes that could not be matched "
+                       f"to the reference genome in {path}.")
+
+
+def is_illumina_manifest(path: str, encoding: Optional[str] = None) -> bool:
+    """Illumina manifests start with a [Heading] section"""
+    with open(path, encoding=encoding) as handle:
+        return handle.readline().startswith("[Heading]")
+
+
+def import_manifest(path: str, reference_path: Optional[str] = None,
+                    encoding: Optional[str] = None
+                    ) -> Dict[str, QueryResult]:
+    """
+    Build a lookup table from an Affymetrix annotation or Illumina manifest
+    csv file.
+
+    :param path: path to annotation or manifest file
+    :param reference_path: Optional path to faidx-indexed fasta file of the
+    reference genome. Required for Illumina manifests
+    :param encoding: optional encoding of the file
+    :return: dict of rs id and QueryResult, for use as `init_d` of RSLookup
+    :raises: ValueError for an Illumina manifest without reference genome
+    """
+    illumina = is_illumina_manifest(path, encoding)
+    if illumina and reference_path is None:
+        raise ValueError("Illumina manifests do not contain the reference "
+                         "allele, a reference genome is required")
+    reference = (ReferenceGenome(reference_path)
+                 if reference_path is not None else None)
+    try:
+        if illumina:
+            table = dict(read_illumina_manifest(path, reference, encoding))
+        else:
+            table = dict(read_affy_annotation(path, reference, encoding))
+    finally:
+        if reference is not None:
+            reference.close()
+    logger.info(f"Imported {len(table)} probes from {path}.")
+    return table
@@ -0,0 +1,149 @@
+"""
+aav.parallel
+~~~~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+:license: MIT
+"""
+import io
+import logging
+import operator
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple, Type
+
+from .lookup import LookupResult, RSLookup
+from .readers import Reader
+
+logger = logging.getLogger('ArrayReader')
+
+# Size of the chunks that are parsed by worker processes, in bytes
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# VCF line with its sort key of chromosome and position
+Record = Tuple[Tuple[str, int], str]
+
+_sort_key = operator.itemgetter(0)
+
+# State of a worker process, set by _init_worker
+_worker: dict = {}
+
+
+def data_offset(path: str, n_header_lines: int) -> int:
+    """Byte offset of the first line after the header lines of a file"""
+    with open(path, "rb") as handle:
+        for _ in range(n_header_lines):
+            handle.readline()
+        return handle.tell()
+
+
+def chunk_ranges(path: str, start: int, chunk_size: int
+                 ) -> List[Tuple[int, int]]:
+    """
+    Split a file from `start` into byte ranges of about `chunk_size` bytes,
+    that end at the end of a line
+    :return: list of start and end offsets
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, "rb") as handle:
+        while start < size:
+            end = start + max(chunk_size, 1)
+            if end >= size:
+                end = size
+            else:
+                handle.seek(end - 1)
+                handle.readline()
+                end = handle.tell()
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _init_worker(reader_cls: Type[Reader], path: str, reader_kwargs: dict,
+                 build: str, table: Dict[str, Optional[LookupResult]]):
+    _worker["reader_cls"] = reader_cls
+    _worker["path"] = path
+    _worker["reader_kwargs"] = reader_kwargs
+    _worker["lookup"] = RSLookup(build, table, ensembl_lookup=False)
+
+
+def _convert_chunk(start: int, end: int) -> Tuple[List[Record], int, int]:
+    """
+    Convert the lines in a byte range of the file in a worker process
+    :return: sorted records, and the number of lookup hits and misses
+    """
+    lookup = _worker["lookup"]
+    reader = _worker["reader_cls"](_worker["path"], lookup_table=lookup,
+                                   **_worker["reader_kwargs"])
+    with open(reader.path, "rb") as handle:
+        handle.seek(start)
+        data = handle.read(end - start)
+    reader.read_lines(io.TextIOWrapper(io.BytesIO(data),
+                                       encoding=reader.encoding))
+    hits, misses = lookup.counters.hits, lookup.counters.misses
+    records = [((v.chrom, v.pos), v.vcf_line) for v in reader]
+    records.sort(key=_sort_key)
+    return (records, lookup.counters.hits - hits,
+            lookup.counters.misses - misses)
+
+
+def convert_parallel(reader_cls: Type[Reader], path: str,
+                     lookup_table: RSLookup,
+                     processes: Optional[int] = None, workers: int = 1,
+                     chunk_size: int = CHUNK_SIZE,
+                     **reader_kwargs) -> List[str]:
+    """
+    Convert an array file in parallel. The rs ids of the file are resolved
+    first, as by `convert_two_pass`. The data lines are then split into
+    chunks that are parsed by readers in a pool of processes, which share
+    a read-only copy of the resolved entries of the lookup table.
+    :param reader_cls: Reader class of the file
+    :param lookup_table: lookup table to resolve rs ids with
+    :param processes: number of processes, the number of CPUs by default
+    :param workers: number of concurrent requests to resolve rs ids with
+    :param chunk_size: approximate size of the chunks in bytes
+    :param reader_kwargs: other arguments of the reader, such as `sample`
+    :return: VCF lines of the variants, sorted as by `convert_two_pass`
+    """
+    start = time.monotonic()
+    reader = reader_cls(path, lookup_table=lookup_table, **reader_kwargs)
+    reader.handle.close()
+    rs_ids = set(reader.rs_ids())
+    n_added = lookup_table.prefetch(rs_ids, workers=workers)
+    table = {}
+    for rs_id in rs_ids:
+        try:
+            table[rs_id] = lookup_table.cached(rs_id)
+        except KeyError:
+            continue
+    resolved = time.monotonic()
+    logger.info(f"Resolved {n_added} rsIDs in {resolved - start:.2f}s.")
+
+    processes = processes or os.cpu_count() or 1
+    offset = data_offset(path, reader.n_header_lines)
+    # Every process gets at least one chunk
+    size = os.path.getsize(path) - offset
+    chunk_size = min(chunk_size, -(-size // processes))
+    ranges = chunk_ranges(path, offset, chunk_size)
+
+    records: List[Record] = []
+    with ProcessPoolExecutor(
+            max_workers=processes, initializer=_init_worker,
+            initargs=(reader_cls, path, reader_kwargs, lookup_table.build,
+                      table)) as executor:
+        results = executor.map(_convert_chunk, [x for x, _ in ranges],
+                               [x for _, x in ranges])
+        for chunk_records, hits, misses in results:
+            records.extend(chunk_records)
+            lookup_table.counters.hit(hits)
+            lookup_table.counters.miss(misses)
+    # Concatenated sorted runs are merged by the sort, which is stable so
+    # that equal positions stay in file order
+    records.sort(key=_sort_key)
+    logger.info(f"Parsed {len(records)} records in {len(ranges)} chunks "
+                f"with {processes} processes in "
+                f"{time.monotonic() - resolved:.2f}s.")
+    return [line for _, line in records]
@@ -9,19 +9,33 @@ aav.readers
 import functools
 import logging
 import math
-from typing import List, Optional, Set, Tuple, Type
+import operator
+import time
+from typing import (Callable, Dict, Iterable, Iterator, List, Optional, Set,
+                    Tuple, Type)
 
+from .index import SampleIndex, read_ranges
 from .lookup import RSLookup
 from .utils import comma_float, empty_string
 from .variation import (GT_FORMAT, Genotype, InfoField, InfoFieldNumber,
-                        InfoFieldType, InfoHeaderLine, VCF_v_4_2, Variant,
-                        chrom_header, date_header, program_header)
-
-GRCH37_LOOKUP = RSLookup("GRCh37")
-GRCH38_LOOKUP = RSLookup("GRCh38")
+                        InfoFieldType, InfoHeaderLine, MultiSampleVariant,
+                        VCF_v_4_2, Variant, chrom_header, date_header,
+                        program_header)
 
 logger = logging.getLogger('ArrayReader')
 
+# Default lookup tables per build, created on first access of
+# GRCH37_LOOKUP or GRCH38_LOOKUP
+_DEFAULT_LOOKUPS = {"GRCH37_LOOKUP": "GRCh37", "GRCH38_LOOKUP": "GRCh38"}
+
+
+def __getattr__(name: str) -> RSLookup:
+    if name not in _DEFAULT_LOOKUPS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    lookup = RSLookup(_DEFAULT_LOOKUPS[name])
+    globals()[name] = lookup
+    return lookup
+
 
 class Reader(object):
     """
@@ -32,6 +46,8 @@ class Reader(object):
     def __init__(self, path: str, n_header_lines: int = 0,
                  encoding: Optional[str] = None):
         self.path = path
+        self.encoding = encoding
+        self.n_header_lines = n_header_lines
         self.handle = open(path, mode="r", encoding=encoding)
         self.header_lines = []
 
@@ -48,20 +64,49 @@ class Reader(object):
     def __iter__(self):
         return self
 
-    def vcf_header(self, sample_name: str) -> str:
+    def get_rs_id(self, line: List[str]) -> str:
+        raise NotImplementedError
+
+    def read_lines(self, lines: Iterable[str]):
+        """
+        Parse the given data lines, e.g. a chunk of the file, instead of
+        the remainder of the file. The file handle is closed.
+        """
+        self.handle.close()
+        self.handle = iter(lines)
+
+    def rs_ids(self) -> Iterator[str]:
+        """
+        Iterate over the rs ids in the file, without looking them up.
+        Uses a separate handle, so the reader itself is not advanced.
+        """
+        with open(self.path, mode="r", encoding=self.encoding) as handle:
+            for _ in range(self.n_header_lines):
+                next(handle)
+            for raw_line in handle:
+                yield self.get_rs_id(raw_line.strip('\n').split("\t"))
+
+    def vcf_header(self, *sample_names: str) -> str:
         s = functools.reduce(
             lambda x, y: x + str(y) + "\n", self.header_fields, "")
-        return s + chrom_header(sample_name) + '\n'
+        return s + chrom_header(*sample_names) + '\n'
 
 
 class OpenArrayReader(Reader):
-    def __init__(self, path: str, lookup_table: RSLookup, sample: str,
-                 qual: int = 100, prefix_chr: Optional[str] = None,
+    def __init__(self, path: str, lookup_table: RSLookup,
+                 sample: Optional[str], qual: int = 100,
+                 prefix_chr: Optional[str] = None,
                  encoding: Optional[str] = None,
-                 exclude_assays: Optional[Set[str]] = None):
+                 exclude_assays: Optional[Set[str]] = None,
+                 index: Optional[SampleIndex] = None):
+        """
+        :param index: sample index of the file, to read only the rows of
+        the selected sample
+        """
         super().__init__(path, n_header_lines=18, encoding=encoding)
         self.qual = qual
         self.sample = sample
+        self.index = index
         self.lookup_table = lookup_table
         self.prefix_chr = prefix_chr
         self.linecount = 18  # n_header_lines
@@ -81,110 +126,229 @@ class OpenArrayReader(Reader):
         ]
 
         self._header_splitted = self.header_lines[-1].strip().split("\t")
+        try:
+            self.column_idx = self._column_map(self._header_splitted)
+        except ValueError:
+            self.handle.close()
+            raise
+        # Rows are selected by assay and sample before the other fields
+        # are read
+        self._get_selection = self._getter("Assay ID", "Sample ID")
+        self._get_fields = self._getter(
+            "Assay Name", "Assay ID", "Gene Symbol", "NCBI SNP Reference",
+            "Call", "Chromosome #", "Position")
+        self._get_ids = self._getter("Assay ID", "Sample ID",
+                                     "NCBI SNP Reference")
+        self._row_iter = self._rows()
+
+    # Columns read from the rows
+    columns = ("Assay Name", "Assay ID", "Gene Symbol", "NCBI SNP Reference",
+               "Sample ID", "Call", "Chromosome #", "Position")
+
+    def _column_map(self, header: List[str]) -> Dict[str, int]:
+        """
+        Get the index of every column in `columns`
+        :raises: ValueError if columns are missing from the header
+        """
+        missing = [x for x in self.columns if x not in header]
+        if missing:
+            raise ValueError(f"{self.path} is missing OpenArray columns: "
+                             f"{', '.join(missing)}")
+        return {x: header.index(x) for x in self.columns}
+
+    def _getter(self, *columns: str) -> Callable[[List[str]], Tuple[str, ...]]:
+        """Get a function that extracts the columns from a split row"""
+        return operator.itemgetter(*(self.column_idx[x] for x in columns))
 
     @property
     def chromsome_col_idx(self) -> int:
-        return self._header_splitted.index("Chromosome #")
+        return self.column_idx["Chromosome #"]
 
     @property
     def position_col_idx(self) -> int:
-        return self._header_splitted.index("Position")
+        return self.column_idx["Position"]
 
     @property
     def sample_col_idx(self) -> int:
-        return self._header_splitted.index("Sample ID")
+        return self.column_idx["Sample ID"]
 
     @property
     def rsid_col_idx(self) -> int:
-        return self._header_splitted.index("NCBI SNP Reference")
+        return self.column_idx["NCBI SNP Reference"]
 
     @property
     def assay_name_col_idx(self) -> int:
-        return self._header_splitted.index("Assay Name")
+        return self.column_idx["Assay Name"]
 
     @property
     def assay_id_col_idx(self) -> int:
-        return self._header_splitted.index("Assay ID")
+        return self.column_idx["Assay ID"]
 
     @property
     def gene_symbol_col_idx(self) -> int:
-        return self._header_splitted.index("Gene Symbol")
+        return self.column_idx["Gene Symbol"]
 
     @property
     def call_col_idx(self) -> int:
-        return self._header_splitted.index("Call")
-
-    def __next__(self):
-        for raw_line in self.handle:
-            self.linecount += 1
+        return self.column_idx["Call"]
+
+    def read_lines(self, lines: Iterable[str]):
+        """
+        Parse the given data lines instead of the remainder of the file.
+        The sample index is not used for them.
+        """
+        super().read_lines(lines)
+        self.index = None
+        self._row_iter = self._rows()
+
+    def _sample_ranges(self) -> Optional[List[List[int]]]:
+        """Byte ranges of the selected sample, if they are indexed"""
+        if self.index is None or self.sample is None:
+            return None
+        ranges = self.index.samples.get(self.sample)
+        return ranges.ranges if ranges is not None else []
+
+    def _lines(self) -> Iterator[Tuple[int, str]]:
+        """
+        Iterate over the remaining lines, or only over those of the selected
+        sample if the file is indexed
+        :return: iterator of line number and line
+        """
+        ranges = self._sample_ranges()
+        if ranges is not None:
+            return read_ranges(self.path, ranges, self.encoding)
+        return enumerate(self.handle, self.linecount + 1)
+
+    def _rows(self) -> Iterator[Tuple[str, List[str]]]:
+        """
+        Iterate over the remaining rows of the file that are not excluded
+        :return: iterator of sample id and split row
+        """
+        for self.linecount, raw_line in self._lines():
             if empty_string(raw_line):
-                raise StopIteration  # end of initial list
+                return  # end of initial list
             line = raw_line.strip('\n').split("\t")
             if len(line) < 8:  # may occur if assay design is dumped in file
                 logger.debug(f"Skipping line {self.linecount}, to few columns")
                 continue
-            assay_id = line[self.assay_id_col_idx]
+            assay_id, line_sample = self._get_selection(line)
             if assay_id in self.exclude_assays:
-                logger.debug("Skipping excluded assay {assay_id}")
+                logger.debug(f"Skipping excluded assay {assay_id}")
                 continue
-            line_sample = line[self.sample_col_idx]
+            yield line_sample, line
+
+    def __next__(self):
+        for line_sample, line in self._row_iter:
             if line_sample != self.sample:
                 logger.debug(f"Skipping line {self.linecount}, wrong sample "
                              f"({line_sample} is not {self.sample})")
                 continue
-            rs_id = line[self.rsid_col_idx].strip()  # may have spaces :cry:
-            try:
-                raw_chrom = line[self.chromsome_col_idx]
-            except IndexError:  # sometimes the entire row is truncated
-                logger.debug((f"Skipping line {self.linecount}, entire row "
-                              "truncated"))
+            variant = self._variant(line)
+            if variant is not None:
+                return variant
+        raise StopIteration
+
+    def split_samples(self) -> Dict[str, List[Variant]]:
+        """
+        Convert the remaining rows of the file in a single pass, routing
+        them by their Sample ID. Only the selected sample is kept if a
+        sample is selected.
+        :return: unsorted variants per sample, in order of appearance of
+        the samples
+        """
+        by_sample: Dict[str, List[Variant]] = {}
+        for line_sample, line in self._row_iter:
+            if self.sample is not None and line_sample != self.sample:
                 continue
-            pos = line[self.position_col_idx]
+            variants = by_sample.setdefault(line_sample, [])
+            variant = self._variant(line)
+            if variant is not None:
+                variants.append(variant)
+        return by_sample
+
+    def _variant(self, line: List[str]) -> Optional[Variant]:
+        """Convert a row, or get None if it has to be skipped"""
+        try:
+            (assay_name, assay_id, raw_gene_symbol, rs_id, call, raw_chrom,
+             pos) = self._get_fields(line)
+        except IndexError:  # sometimes the entire row is truncated
+            logger.debug((f"Skipping line {self.linecount}, entire row "
+                          "truncated"))
+            return None
+        rs_id = rs_id.strip()  # may have spaces :cry:
+
+        # Skip if fields we need are missing
+        if empty_string(raw_chrom):
+            logger.debug((f"Skipping line {self.linecount}, missing "
+                          "chromosome"))
+            return None
+        if empty_string(pos):
+            logger.debug((f"Skipping line {self.linecount}, missing "
+                          "position"))
+            return None
+        if empty_string(rs_id):
+            logger.debug((f"Skipping line {self.linecount}, missing "
+                          "rs_id"))
+            return None
+
+        # Also skip if the rs_id is not in the lookup_table
+        try:
+            q_res = self.lookup_table[rs_id]
+        except KeyError:
+            logger.debug(f"Skipping {rs_id}, transcript not found")
+            return None
+        else:
+            ref = q_res.ref
+            genotype, alt = self.get_genotype_and_alt(call, ref, q_res.alt)
+
+        infos = [
+            InfoField("Assay_Name", assay_name, InfoFieldNumber.one),
+            InfoField("Assay_ID", assay_id, InfoFieldNumber.one)
+        ]
 
-            # Skip if fields we need are missing
-            if empty_string(raw_chrom):
-                logger.debug((f"Skipping line {self.linecount}, missing "
-                              "chromosome"))
+        if not empty_string(raw_gene_symbol):
+            infos.append(InfoField("Gene_Symbol",
+                                   raw_gene_symbol.split(";"),
+                                   InfoFieldNumber.unknown))
+
+        chrom = self.get_chrom(raw_chrom)
+        return Variant(chrom=chrom, pos=int(pos), id=rs_id, ref=ref,
+                       alt=alt, info_fields=infos, qual=self.qual,
+                       genotype=genotype)
+
+    def rs_ids(self) -> Iterator[str]:
+        """
+        Iterate over the rs ids of the selected sample, or of all samples
+        if no sample is selected
+        """
+        ranges = self._sample_ranges()
+        if ranges is not None:
+            lines = read_ranges(self.path, ranges, self.encoding)
+            yield from self._row_rs_ids(line for _, line in lines)
+            return
+        with open(self.path, mode="r", encoding=self.encoding) as handle:
+            for _ in range(self.n_header_lines):
+                next(handle)
+            yield from self._row_rs_ids(handle)
+
+    def _row_rs_ids(self, raw_lines: Iterable[str]) -> Iterator[str]:
+        for raw_line in raw_lines:
+            if empty_string(raw_line):
+                break
+            line = raw_line.strip('\n').split("\t")
+            if len(line) < 8:
                 continue
-            if empty_string(pos):
-                logger.debug((f"Skipping line {self.linecount}, missing "
-                              "position"))
+            try:
+                assay_id, line_sample, rs_id = self._get_ids(line)
+            except IndexError:
                 continue
-            if empty_string(rs_id):
-                logger.debug((f"Skipping line {self.linecount}, missing "
-                              "rs_id"))
+            if assay_id in self.exclude_assays:
                 continue
-
-            # Also skip if the rs_id is not in the lookup_table
-            try:
-                q_res = self.lookup_table[rs_id]
-            except KeyError:
-                logger.debug(f"Skipping {rs_id}, transcript not found")
+            if self.sample is not None and line_sample != self.sample:
                 continue
-            else:
-                call = line[self.call_col_idx]
-                ref = q_res.ref
-                genotype, alt = self.get_genotype_and_alt(call, ref, q_res.alt)
-
-            assay_name = line[self.assay_name_col_idx]
-            raw_gene_symbol = line[self.gene_symbol_col_idx]
-
-            infos = [
-                InfoField("Assay_Name", assay_name, InfoFieldNumber.one),
-                InfoField("Assay_ID", assay_id, InfoFieldNumber.one)
-            ]
-
-            if not empty_string(raw_gene_symbol):
-                infos.append(InfoField("Gene_Symbol",
-                                       raw_gene_symbol.split(";"),
-                                       InfoFieldNumber.unknown))
-
-            chrom = self.get_chrom(raw_chrom)
-            return Variant(chrom=chrom, pos=int(pos), id=rs_id, ref=ref,
-                           alt=alt, info_fields=infos, qual=self.qual,
-                           genotype=genotype)
-        else:
-            raise StopIteration
+            rs_id = rs_id.strip()
+            if not empty_string(rs_id):
+                yield rs_id
 
     def get_chrom(self, chrom: str) -> str:
         if self.prefix_chr is None:
@@ -256,7 +420,7 @@ class AffyReader(Reader):
             line = raw_line.strip('\n').split("\t")
             chrom = self.get_chrom(line[3])
             pos = int(line[4])
-            rs_id = line[2]
+            rs_id = self.get_rs_id(line)
             try:
                 q_res = self.lookup_table[rs_id]
             except KeyError:
@@ -297,6 +461,9 @@ class AffyReader(Reader):
             return Genotype.unknown
         return Genotype.unknown
 
+    def get_rs_id(self, line: List[str]) -> str:
+        return line[2]
+
     def get_chrom(self, val):
         """23 = X"""
         if val == "23":
@@ -339,7 +506,7 @@ class CytoScanReader(Reader):
             line = raw_line.strip('\n').split("\t")
             chrom = self.get_chrom(line[7])
             pos = int(line[8])
-            rs_id = line[6]
+            rs_id = self.get_rs_id(line)
 
             try:
                 q_res = self.lookup_table[rs_id]
@@ -382,6 +549,9 @@ class CytoScanReader(Reader):
         else:
             return Genotype.unknown
 
+    def get_rs_id(self, line: List[str]) -> str:
+        return line[6]
+
     def get_chrom(self, chrom: str) -> str:
         if self.prefix_chr is None:
             return chrom
@@ -536,3 +706,92 @@ def autodetect_reader(path: str,
                 raise NotImplementedError("Could not detect type of array")
 
     raise NotImplementedError
+
+
+def array_rs_ids(paths: Iterable[str],
+                 encoding: Optional[str] = None) -> Set[str]:
+    """
+    Collect the distinct rs ids of array files, of all samples
+    :param paths: paths to array files of any detected type
+    :param encoding: optional encoding of the files
+    :return: set of rs ids
+    """
+    offline = RSLookup("GRCh37", ensembl_lookup=False)
+    rs_ids = set()
+    for path in paths:
+        reader_cls = autodetect_reader(path, encoding=encoding)
+        if reader_cls == OpenArrayReader:
+            reader = reader_cls(path, lookup_table=offline, sample=None,
+                                encoding=encoding)
+        else:
+            reader = reader_cls(path, lookup_table=offline,
+                                encoding=encoding)
+        rs_ids.update(reader.rs_ids())
+        reader.handle.close()
+    return rs_ids
+
+
+def merge_samples(by_sample: Dict[str, List[Variant]]
+                  ) -> List[MultiSampleVariant]:
+    """
+    Merge the variants of multiple samples into multi-sample variants, one
+    per position and rs id. The alt alleles are those called in any sample,
+    or the alt alleles of the lookup table if no sample has one. Samples
+    without a variant at a position get an unknown genotype.
+    :param by_sample: variants per sample, as from
+    `OpenArrayReader.split_samples`
+    :return: sorted multi-sample variants, with genotypes in the order of
+    `by_sample`
+    """
+    samples = list(by_sample)
+    merged: Dict[Tuple[str, int, str, str], Dict[str, Variant]] = {}
+    for sample, variants in by_sample.items():
+        for variant in variants:
+            key = (variant.chrom, variant.pos, variant.id, variant.ref)
+            merged.setdefault(key, {})[sample] = variant
+
+    results = []
+    for (chrom, pos, rs_id, ref), variants in merged.items():
+        called = [v.alt for v in variants.values()
+                  if v.genotype in (Genotype.het, Genotype.hom_alt)]
+        alts = list(dict.fromkeys(called))
+        if not alts:
+            alts = next((list(v.alt) for v in variants.values()
+                         if v.genotype == Genotype.hom_ref), ["."])
+        genotypes = []
+        for sample in samples:
+            variant = variants.get(sample)
+            if variant is None or variant.genotype == Genotype.unknown:
+                genotypes.append(Genotype.unknown.value)
+            elif variant.genotype == Genotype.hom_ref:
+                genotypes.append(Genotype.hom_ref.value)
+            else:
+                idx = alts.index(variant.alt) + 1
+                first = 0 if variant.genotype == Genotype.het else idx
+                genotypes.append(f"{first}/{idx}")
+        first = next(iter(variants.values()))
+        results.append(MultiSampleVariant(
+            chrom=chrom, pos=pos, id=rs_id, ref=ref, alt=alts,
+            qual=first.qual, info_fields=first.info_fields,
+            genotypes=genotypes))
+    return sorted(results)
+
+
+def convert_two_pass(reader: Reader, workers: int = 1) -> List[Variant]:
+    """
+    Convert an array file in two passes. The first pass collects the
+    distinct rs ids of the file and resolves all unknown ones in bulk,
+    the second pass parses the file with a fully warm lookup table.
+    :param reader: instance of Reader
+    :param workers: number of concurrent requests in the first pass
+    :return: sorted list of variants
+    """
+    start = time.monotonic()
+    n_added = reader.lookup_table.prefetch(reader.rs_ids(), workers=workers)
+    resolved = time.monotonic()
+    logger.info(f"Resolved {n_added} rsIDs in {resolved - start:.2f}s.")
+
+    variants = sorted(reader)
+    logger.info(f"Parsed {len(variants)} records in "
+                f"{time.monotonic() - resolved:.2f}s.")
+    return variants
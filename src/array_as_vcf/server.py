@@ -0,0 +1,240 @@
+"""
+aav.server
+~~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+:license: MIT
+"""
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+from urllib.error import URLError
+
+from .lookup import (LookupResult, MissingReason, MissingResult,
+                     NotFoundError, QueryResult, RSLookup, UnmappedError,
+                     deserialize_result)
+
+logger = logging.getLogger('RSLookup')
+
+
+class LookupServer(socketserver.ThreadingUnixStreamServer):
+    """
+    Serves a single lookup table to multiple processes on a Unix socket.
+
+    Every connection sends requests of the form `{"ids": [...]}`, one json
+    object per line, and receives `{"results": {...}}` with the serialized
+    entry of every rs id that could be resolved. rs ids that are not in the
+    table are requested from ensembl by the lookup table of the server.
+    Concurrent requests for the same rs id wait on a single request.
+
+    New entries are persisted by the lookup table, e.g. to its journal.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, lookup: RSLookup, workers: int = 1):
+        """
+        :param socket_path: path to create the Unix socket at
+        :param lookup: lookup table to serve
+        :param workers: maximum number of concurrent ensembl requests per
+        client request
+        """
+        self.lookup = lookup
+        self.workers = workers
+        # Serializes access to the table; requests are done without it
+        self._lock = threading.Lock()
+        # rs ids that are being requested, with an event that is set when
+        # they are stored
+        self._pending: Dict[str, threading.Event] = {}
+        # Number of rs ids that were requested from ensembl, for inspection
+        self.fetched = 0
+        super().__init__(socket_path, LookupRequestHandler)
+
+    def resolve(self, rs_ids: Iterable[str]
+                ) -> Dict[str, Optional[LookupResult]]:
+        """
+        Get the entries for rs ids, requesting the missing ones
+        :return: entry per rs id, for the rs ids that could be resolved
+        """
+        rs_ids = set(rs_ids)
+        with self._lock:
+            missing = (self.lookup.missing(rs_ids)
+                       if self.lookup.ensembl_lookup else set())
+            waits = {self._pending[x] for x in missing if x in self._pending}
+            mine = sorted(x for x in missing if x not in self._pending)
+            done = threading.Event()
+            for rs_id in mine:
+                self._pending[rs_id] = done
+        try:
+            if mine:
+                for rs_id, result in self.lookup.fetch(mine, self.workers):
+                    with self._lock:
+                        self.lookup._store(rs_id, result)
+                        self.fetched += 1
+        finally:
+            with self._lock:
+                for rs_id in mine:
+                    del self._pending[rs_id]
+            done.set()
+        for event in waits:
+            event.wait()
+
+        results = {}
+        with self._lock:
+            for rs_id in rs_ids:
+                try:
+                    results[rs_id] = self.lookup.cached(rs_id)
+                except KeyError:
+                    continue
+        return results
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class LookupRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                rs_ids = json.loads(line.decode("utf-8"))["ids"]
+                results = self.server.resolve(rs_ids)
+                response = {"results": {
+                    k: v.serialize() if v is not None else None
+                    for k, v in results.items()}}
+            except (ValueError, KeyError, TypeError) as e:
+                response = {"error": f"Invalid request: {e}"}
+            except Exception as e:
+                # Answer, so that the client does not wait for a response
+                logger.exception("Failed to resolve request")
+                response = {"error": f"Failed to resolve request: {e}"}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class LookupServerClient(object):
+    """
+    Client for a LookupServer, to be used as the `client` of an RSLookup.
+    rs ids that are not in the table of the RSLookup are then requested
+    from the server instead of from ensembl.
+
+    Connections are kept open and reused, as by EnsemblClient.
+    rs ids that the server could not resolve raise URLError, as if the
+    request failed.
+    """
+
+    def __init__(self, socket_path: str, timeout: Optional[float] = 120):
+        """
+        :param socket_path: path to the Unix socket of the server
+        :param timeout: default timeout in seconds for requests, None to
+        wait for the server indefinitely
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._idle: "queue.LifoQueue[socket.socket]" = queue.LifoQueue()
+
+    def _connect(self, timeout: Optional[float]) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def request(self, rs_ids: List[str], timeout: Optional[float] = None
+                ) -> Dict[str, Optional[str]]:
+        """
+        Get the serialized entries for rs ids from the server
+        :param timeout: Optional timeout in seconds for the request.
+        Defaults to `self.timeout`
+        :raises: URLError if the request could not be completed
+        """
+        if timeout is None:
+            timeout = self.timeout
+        try:
+            sock = self._idle.get_nowait()
+        except queue.Empty:
+            sock = None
+        message = json.dumps({"ids": list(rs_ids)}).encode("utf-8") + b"\n"
+        try:
+            if sock is None:
+                sock = self._connect(timeout)
+            else:
+                sock.settimeout(timeout)
+            sock.sendall(message)
+            response = json.loads(_read_line(sock).decode("utf-8"))
+        except (OSError, ValueError) as e:
+            if sock is not None:
+                sock.close()
+            raise URLError(e) from e
+        self._idle.put(sock)
+        if "error" in response:
+            raise URLError(response["error"])
+        return response["results"]
+
+    def query(self, rs_id: str,
+              timeout: Optional[float] = None) -> Optional[QueryResult]:
+        """Get ref and alt alleles for an rs id"""
+        results = self.request([rs_id], timeout)
+        if rs_id not in results:
+            raise URLError(f"{rs_id} could not be resolved by the server")
+        serialized = results[rs_id]
+        if serialized is None:
+            return None
+        result = deserialize_result(serialized)
+        if isinstance(result, MissingResult):
+            if result.reason == MissingReason.not_found:
+                raise NotFoundError("rsID not found for human")
+            if result.reason == MissingReason.unmapped:
+                raise UnmappedError("rsID does not map to genome")
+            raise URLError(f"{rs_id} could not be retrieved by the server")
+        return result
+
+    def query_batch(self, rs_ids: List[str],
+                    timeout: Optional[float] = None
+                    ) -> Dict[str, Optional[LookupResult]]:
+        """
+        Get ref and alt alleles for multiple rs ids in a single request.
+        rs ids that the server could not resolve get a MissingResult with
+        reason error.
+        """
+        serialized = self.request(rs_ids, timeout)
+        error = MissingResult(MissingReason.error, time.time())
+        results = {}
+        for rs_id in rs_ids:
+            if rs_id not in serialized:
+                results[rs_id] = error
+            elif serialized[rs_id] is None:
+                results[rs_id] = None
+            else:
+                results[rs_id] = deserialize_result(serialized[rs_id])
+        return results
+
+    def close(self):
+        """Close all idle connections"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def _read_line(sock: socket.socket) -> bytes:
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("Connection closed by server")
+        chunks.append(chunk)
+        if chunk.endswith(b"\n"):
+            return b"".join(chunks)
@@ -0,0 +1,752 @@
+"""
+aav.stores
+~~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+:license: MIT
+"""
+import array
+import contextlib
+import itertools
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+from typing import (Dict, Iterable, Iterator, List, Mapping,
+                    MutableMapping, Optional, Tuple, Union)
+
+from .lookup import (LookupResult, QueryResult, deserialize_result,
+                     open_table, read_query_results, write_query_results)
+
+logger = logging.getLogger('RSLookup')
+
+SQLITE_EXTENSIONS = {".db", ".sqlite", ".sqlite3"}
+SQLITE_MAGIC = b"SQLite format 3\x00"
+
+
+class LazyStore(MutableMapping[str, Optional[LookupResult]]):
+    """
+    Lookup table that keeps serialized results, and only deserializes them
+    on first access. Deserialized results are cached.
+    """
+
+    def __init__(self, serialized: Dict[str, Union[str, LookupResult, None]]):
+        """
+        :param serialized: dict of rs ids to serialized results, as
+        produced by `serialize_query_results`
+        """
+        self._results = serialized
+
+    def __getitem__(self, rs_id: str) -> Optional[LookupResult]:
+        result = self._results[rs_id]
+        if isinstance(result, str):
+            result = deserialize_result(result)
+            self._results[rs_id] = result
+        return result
+
+    def __setitem__(self, rs_id: str, value: Optional[LookupResult]):
+        self._results[rs_id] = value
+
+    def __delitem__(self, rs_id: str):
+        del self._results[rs_id]
+
+    def __contains__(self, rs_id) -> bool:
+        return rs_id in self._results
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._results)
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def items(self) -> Iterator[Tuple[str, Optional[LookupResult]]]:
+        # Results are not cached here, as that would deserialize everything
+        for rs_id, result in self._results.items():
+            if isinstance(result, str):
+                result = deserialize_result(result)
+            yield rs_id, result
+
+
+class InternedStore(MutableMapping[str, Optional[LookupResult]]):
+    """
+    Compact in-memory lookup table.
+
+    Entries are keyed by the integer rs number, and identical results are
+    stored only once. Results are therefore shared between rs ids, and
+    must not be modified. Keys that are not rs ids are stored as is.
+    """
+
+    def __init__(self, results: Union[
+            Mapping[str, Union[str, LookupResult, None]],
+            Iterable[Tuple[str, Union[str, LookupResult, None]]],
+            None] = None):
+        """
+        :param results: Optional mapping or iterable of pairs of rs ids to
+        results or serialized results
+        """
+        self._value_ids: Dict[Optional[str], int] = {None: 0}
+        self._values: List[Optional[LookupResult]] = [None]
+        self._rs_numbers: Dict[int, int] = {}
+        self._others: Dict[str, int] = {}
+        if isinstance(results, Mapping):
+            results = results.items()
+        if results is not None:
+            for rs_id, result in results:
+                self._set(rs_id, result)
+
+    def _intern(self, result: Union[str, LookupResult, None]) -> int:
+        serialized = (result if result is None or isinstance(result, str)
+                      else result.serialize())
+        value_id = self._value_ids.get(serialized)
+        if value_id is None:
+            value_id = len(self._values)
+            if isinstance(result, str):
+                result = deserialize_result(result)
+            self._values.append(result)
+            self._value_ids[serialized] = value_id
+        return value_id
+
+    def _set(self, rs_id: str, result: Union[str, LookupResult, None]):
+        number = rs_number(rs_id)
+        # Only canonical rs ids can be reconstructed from their number
+        if number is not None and rs_id == f"rs{number}":
+            self._rs_numbers[number] = self._intern(result)
+        else:
+            self._others[rs_id] = self._intern(result)
+
+    def _value_id(self, rs_id: str) -> int:
+        number = rs_number(rs_id)
+        if number is not None and rs_id == f"rs{number}":
+            return self._rs_numbers[number]
+        return self._others[rs_id]
+
+    def __getitem__(self, rs_id: str) -> Optional[LookupResult]:
+        try:
+            return self._values[self._value_id(rs_id)]
+        except KeyError:
+            raise KeyError(rs_id)
+
+    def __setitem__(self, rs_id: str, value: Optional[LookupResult]):
+        self._set(rs_id, value)
+
+    def __delitem__(self, rs_id: str):
+        number = rs_number(rs_id)
+        if number is not None and rs_id == f"rs{number}":
+            del self._rs_numbers[number]
+        else:
+            del self._others[rs_id]
+
+    def __iter__(self) -> Iterator[str]:
+        for number in self._rs_numbers:
+            yield f"rs{number}"
+        yield from self._others
+
+    def __len__(self) -> int:
+        return len(self._rs_numbers) + len(self._others)
+
+    def items(self) -> Iterator[Tuple[str, Optional[LookupResult]]]:
+        for number, value_id in self._rs_numbers.items():
+            yield f"rs{number}", self._values[value_id]
+        for rs_id, value_id in self._others.items():
+            yield rs_id, self._values[value_id]
+
+
+def is_sqlite(path: str) -> bool:
+    """Check whether a path points to an (upcoming) sqlite lookup table"""
+    if os.path.isfile(path) and os.path.getsize(path) > 0:
+        with open(path, "rb") as handle:
+            return handle.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+    return os.path.splitext(path)[1].lower() in SQLITE_EXTENSIONS
+
+
+class SQLiteStore(MutableMapping[str, Optional[LookupResult]]):
+    """
+    Lookup table stored in an sqlite database.
+
+    Items are looked up with indexed queries, so only the rs ids that are
+    actually accessed are loaded in memory. New items are buffered and
+    inserted in batches. The store may be used from other threads than the
+    one that opened it, as long as access is serialized.
+    """
+
+    def __init__(self, path: str, batch_size: int = 10000):
+        """
+        Open or create a lookup table
+        :param path: path to the sqlite database
+        :param batch_size: number of new items that are buffered before
+        they are written to the database
+        """
+        import sqlite3
+        self.path = path
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS rsids "
+            "(rs_id TEXT PRIMARY KEY, result TEXT) WITHOUT ROWID"
+        )
+        self.connection.commit()
+        self._pending: Dict[str, Optional[LookupResult]] = {}
+
+    def __getitem__(self, rs_id: str) -> Optional[LookupResult]:
+        if rs_id in self._pending:
+            return self._pending[rs_id]
+        row = self.connection.execute(
+            "SELECT result FROM rsids WHERE rs_id = ?", (rs_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(rs_id)
+        return None if row[0] is None else deserialize_result(row[0])
+
+    def __setitem__(self, rs_id: str, value: Optional[LookupResult]):
+        self._pending[rs_id] = value
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def __delitem__(self, rs_id: str):
+        self.flush()
+        cursor = self.connection.execute(
+            "DELETE FROM rsids WHERE rs_id = ?", (rs_id,))
+        self.connection.commit()
+        if cursor.rowcount == 0:
+            raise KeyError(rs_id)
+
+    def __iter__(self) -> Iterator[str]:
+        self.flush()
+        for (rs_id,) in self.connection.execute("SELECT rs_id FROM rsids"):
+            yield rs_id
+
+    def __len__(self) -> int:
+        self.flush()
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM rsids").fetchone()[0]
+
+    def items(self) -> Iterator[Tuple[str, Optional[LookupResult]]]:
+        self.flush()
+        for rs_id, result in self.connection.execute(
+                "SELECT rs_id, result FROM rsids"):
+            yield rs_id, (None if result is None
+                          else deserialize_result(result))
+
+    def flush(self):
+        """Write all buffered items to the database"""
+        if not self._pending:
+            return
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO rsids (rs_id, result) VALUES (?, ?)",
+            ((k, None if v is None else v.serialize())
+             for k, v in self._pending.items())
+        )
+        self.connection.commit()
+        self._pending.clear()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+BINARY_MAGIC = b"AAVLUT01"
+BINARY_EXTENSIONS = {".bin"}
+# magic, number of entries, number of distinct values
+_BINARY_HEADER = struct.Struct("<8sQQ")
+_NO_VALUE = 0xFFFFFFFF
+
+
+def is_binary_table(path: str) -> bool:
+    """Check whether a path points to an (upcoming) binary lookup table"""
+    if os.path.isfile(path) and os.path.getsize(path) > 0:
+        with open(path, "rb") as handle:
+            return handle.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+    return os.path.splitext(path)[1].lower() in BINARY_EXTENSIONS
+
+
+def rs_number(rs_id: str) -> Optional[int]:
+    """Get the numeric part of an rs id, or None if it is not an rs id"""
+    if rs_id[:2].lower() != "rs" or not rs_id[2:].isdigit():
+        return None
+    return int(rs_id[2:])
+
+
+def write_binary_table(results: Iterable[Tuple[str, Optional[LookupResult]]],
+                       path: str) -> int:
+    """
+    Write lookup results as a binary table.
+
+    The table consists of a header, the sorted rs numbers as 64 bit
+    integers, a 32 bit value index per rs number, and the offsets and
+    contents of the distinct serialized values. Keys that are not rs ids
+    can not be stored and are skipped.
+
+    :param results: iterable of (rs id, result) tuples
+    :param path: path to write the table to
+    :return: number of written entries
+    """
+    value_ids: Dict[Optional[str], int] = {}
+    # rs number and value index are packed in a single integer for sorting
+    packed = array.array("Q")
+    for rs_id, result in results:
+        number = rs_number(rs_id)
+        if number is None or number >= 2 ** 32:
+            logger.warning(f"Cannot store {rs_id} in binary table")
+            continue
+        value = None if result is None else result.serialize()
+        if value is None:
+            value_id = _NO_VALUE
+        else:
+            value_id = value_ids.setdefault(value, len(value_ids))
+        packed.append(number << 32 | value_id)
+    packed = array.array("Q", sorted(packed))
+
+    keys = array.array("Q")
+    records = array.array("I")
+    previous = None
+    for item in packed:
+        number = item >> 32
+        if number == previous:  # e.g. rs01 and rs1
+            records[-1] = item & _NO_VALUE
+            continue
+        keys.append(number)
+        records.append(item & _NO_VALUE)
+        previous = number
+
+    values = [v.encode("utf-8") for v in value_ids]
+    offsets = array.array("Q", [0])
+    for v in values:
+        offsets.append(offsets[-1] + len(v))
+    if sys.byteorder != "little":
+        for arr in (keys, records, offsets):
+            arr.byteswap()
+
+    with open(path, "wb") as handle:
+        handle.write(_BINARY_HEADER.pack(BINARY_MAGIC, len(keys),
+                                         len(values)))
+        keys.tofile(handle)
+        records.tofile(handle)
+        if len(records) % 2:  # keep offsets 8-byte aligned
+            handle.write(b"\x00" * 4)
+        offsets.tofile(handle)
+        for v in values:
+            handle.write(v)
+    return len(keys)
+
+
+class BinaryStore(MutableMapping[str, Optional[LookupResult]]):
+    """
+    Read-only lookup table in the binary format of `write_binary_table`.
+
+    The file is memory-mapped and searched with binary search, so opening
+    it does not require any parsing, and its pages are shared between
+    processes. Items that are set are kept in memory only.
+    """
+
+    def __init__(self, path: str):
+        import mmap
+        self.path = path
+        with open(path, "rb") as handle:
+            self._mmap = mmap.mmap(handle.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        magic, self._n_entries, self._n_values = _BINARY_HEADER.unpack_from(
+            self._mmap, 0)
+        if magic != BINARY_MAGIC:
+            raise ValueError(f"{path} is not a binary lookup table")
+        self._keys_offset = _BINARY_HEADER.size
+        self._records_offset = self._keys_offset + 8 * self._n_entries
+        self._value_offsets_offset = (
+            self._records_offset + 4 * (self._n_entries + self._n_entries % 2)
+        )
+        self._values_offset = (self._value_offsets_offset +
+                               8 * (self._n_values + 1))
+        self._values: Dict[int, LookupResult] = {}
+        self._added: Dict[str, Optional[LookupResult]] = {}
+
+    def _key(self, index: int) -> int:
+        return struct.unpack_from("<Q", self._mmap,
+                                  self._keys_offset + 8 * index)[0]
+
+    def _find(self, number: int) -> Optional[int]:
+        low, high = 0, self._n_entries
+        while low < high:
+            mid = (low + high) // 2
+            if self._key(mid) < number:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self._n_entries and self._key(low) == number:
+            return low
+        return None
+
+    def _value(self, index: int) -> Optional[LookupResult]:
+        value_id = struct.unpack_from("<I", self._mmap,
+                                      self._records_offset + 4 * index)[0]
+        if value_id == _NO_VALUE:
+            return None
+        if value_id not in self._values:
+            start, end = struct.unpack_from(
+                "<QQ", self._mmap, self._value_offsets_offset + 8 * value_id)
+            raw = self._mmap[self._values_offset + start:
+                             self._values_offset + end]
+            self._values[value_id] = deserialize_result(
+                raw.decode("utf-8"))
+        return self._values[value_id]
+
+    def _index(self, rs_id: str) -> Optional[int]:
+        number = rs_number(rs_id)
+        return None if number is None else self._find(number)
+
+    def __getitem__(self, rs_id: str) -> Optional[LookupResult]:
+        if rs_id in self._added:
+            return self._added[rs_id]
+        index = self._index(rs_id)
+        if index is None:
+            raise KeyError(rs_id)
+        return self._value(index)
+
+    def __setitem__(self, rs_id: str, value: Optional[LookupResult]):
+        self._added[rs_id] = value
+
+    def __delitem__(self, rs_id: str):
+        raise TypeError("Cannot delete items from a binary lookup table")
+
+    def __iter__(self) -> Iterator[str]:
+        for rs_id, _ in self.items():
+            yield rs_id
+
+    def __len__(self) -> int:
+        return self._n_entries + sum(1 for k in self._added
+                                     if self._index(k) is None)
+
+    def items(self) -> Iterator[Tuple[str, Optional[LookupResult]]]:
+        for index in range(self._n_entries):
+            rs_id = f"rs{self._key(index)}"
+            if rs_id not in self._added:
+                yield rs_id, self._value(index)
+        yield from self._added.items()
+
+    def close(self):
+        self._mmap.close()
+
+
+def replay_journal(path: str,
+                   store: MutableMapping[str, Optional[LookupResult]]) -> int:
+    """
+    Apply the changes in a journal to a store. Corrupt lines, such as the
+    last line of an interrupted write, are skipped.
+    :return: number of replayed lines
+    """
+    if not os.path.exists(path):
+        return 0
+    n_lines = 0
+    with open(path, "r") as handle:
+        for line in handle:
+            try:
+                rs_id, *value = json.loads(line)
+            except (ValueError, TypeError):
+                logger.warning(f"Skipping corrupt line in {path}")
+                continue
+            if not value:
+                store.pop(rs_id, None)
+            elif value[0] is None:
+                store[rs_id] = None
+            else:
+                store[rs_id] = deserialize_result(value[0])
+            n_lines += 1
+    return n_lines
+
+
+class JournalStore(MutableMapping[str, Optional[LookupResult]]):
+    """
+    Lookup table that appends every change to a journal file, so that
+    fetched results are not lost when a run is interrupted, and a run only
+    writes its new entries. The journal is replayed into the wrapped store
+    on creation, and can be folded into a snapshot with `compact_journal`.
+    """
+
+    def __init__(self, path: str, store: Optional[
+            MutableMapping[str, Optional[LookupResult]]] = None):
+        """
+        :param path: path to the journal. Created if it does not exist.
+        :param store: Optional store to replay the journal into
+        """
+        self.path = path
+        self.store = store if store is not None else {}
+        with file_lock(path):
+            self.replayed = replay_journal(path, self.store)
+            self._handle = open(path, "a")
+            if self._handle.tell() > 0 and not self._ends_with_newline():
+                self._handle.write("\n")  # line of an interrupted write
+                self._handle.flush()
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.path, "rb") as handle:
+            handle.seek(-1, os.SEEK_END)
+            return handle.read(1) == b"\n"
+
+    def _append(self, entry: list):
+        # compact_journal holds the lock from replaying to emptying the
+        # journal, so entries are not appended in between
+        with file_lock(self.path):
+            self._handle.write(json.dumps(entry) + "\n")
+            self._handle.flush()
+
+    def __getitem__(self, rs_id: str) -> Optional[LookupResult]:
+        return self.store[rs_id]
+
+    def __setitem__(self, rs_id: str, value: Optional[LookupResult]):
+        self.store[rs_id] = value
+        self._append([rs_id, None if value is None else value.serialize()])
+
+    def __delitem__(self, rs_id: str):
+        del self.store[rs_id]
+        self._append([rs_id])
+
+    def __contains__(self, rs_id) -> bool:
+        return rs_id in self.store
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.store)
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def items(self) -> Iterator[Tuple[str, Optional[LookupResult]]]:
+        return iter(self.store.items())
+
+    def close(self):
+        self._handle.close()
+        if hasattr(self.store, "close"):
+            self.store.close()
+
+
+def open_store(path: str
+               ) -> Optional[MutableMapping[str, Optional[LookupResult]]]:
+    """
+    Open a binary or sqlite lookup table.
+    :return: the store, or None if path is not a binary or sqlite table
+    """
+    if is_binary_table(path):
+        return BinaryStore(path)
+    if is_sqlite(path):
+        return SQLiteStore(path)
+    return None
+
+
+def write_store(results: Mapping[str, Optional[LookupResult]],
+                path: str) -> bool:
+    """
+    Write lookup results as binary or sqlite table, based on the path.
+    An sqlite store that is already backed by path is only flushed.
+    :return: False if path is not a binary or sqlite table
+    """
+    if isinstance(results, JournalStore):
+        results = results.store
+    if is_binary_table(path):
+        # Write to a new file, as the existing one may be memory-mapped
+        tmp_path = path + ".tmp"
+        write_binary_table(results.items(), tmp_path)
+        os.replace(tmp_path, path)
+        return True
+    if is_sqlite(path):
+        if (isinstance(results, SQLiteStore) and
+                os.path.abspath(results.path) == os.path.abspath(path)):
+            results.flush()
+        else:
+            store = SQLiteStore(path)
+            store.update(results.items())
+            store.close()
+        return True
+    return False
+
+
+def compact_journal(snapshot_path: str, journal_path: str) -> int:
+    """
+    Fold the changes in a journal into a snapshot lookup table, and empty
+    the journal. The snapshot is created if it does not exist, and is
+    replaced atomically. The journal is locked while compacting, so entries
+    that running conversions append are kept in the journal.
+    :return: number of replayed journal lines
+    """
+    with file_lock(journal_path):
+        store = (open_store(snapshot_path)
+                 if os.path.exists(snapshot_path) else None)
+        if store is None:
+            store = InternedStore()
+            if os.path.exists(snapshot_path):
+                store.update(read_table(snapshot_path))
+        try:
+            replayed = replay_journal(journal_path, store)
+            if isinstance(store, SQLiteStore):
+                # the journal has been replayed into the database itself
+                store.flush()
+            else:
+                base, ext = os.path.splitext(snapshot_path)
+                tmp_path = f"{base}.tmp{ext}"
+                if not write_store(store, tmp_path):
+                    with open_table(tmp_path, "w") as handle:
+                        write_query_results(store, handle)
+                os.replace(tmp_path, snapshot_path)
+        finally:
+            if hasattr(store, "close"):
+                store.close()
+        open(journal_path, "w").close()
+    return replayed
+
+
+# How to merge two different QueryResults for the same rs id: keep the
+# first, take the last, or raise a ValueError
+MERGE_POLICIES = ("first", "last", "error")
+
+# POSIX record locks are held per process, threads are serialized by this
+_thread_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """
+    Hold an exclusive lock on `path`.lock while in the context, across
+    processes and threads. POSIX record locks are used, which also work on
+    NFS.
+    """
+    import fcntl
+    with _thread_lock, open(path + ".lock", "a") as handle:
+        fcntl.lockf(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(handle, fcntl.LOCK_UN)
+
+
+def merge_result(rs_id: str, old: Optional[LookupResult],
+                 new: Optional[LookupResult],
+                 on_conflict: str = "first") -> Optional[LookupResult]:
+    """
+    Merge two entries for the same rs id. A QueryResult takes precedence
+    over a MissingResult, and a MissingResult over None. Of two
+    MissingResults the most recent one is kept. Two different QueryResults
+    are merged according to `on_conflict`.
+    :raises: ValueError for different QueryResults if `on_conflict` is
+    "error"
+    """
+    if old == new:
+        return old
+    if isinstance(old, QueryResult) and isinstance(new, QueryResult):
+        if on_conflict == "error":
+            raise ValueError(f"Conflicting entries for {rs_id}: "
+                             f"{old.serialize()} and {new.serialize()}")
+        return new if on_conflict == "last" else old
+    for result in (old, new):
+        if isinstance(result, QueryResult):
+            return result
+    if old is None or new is None:
+        return new if old is None else old
+    return new if new.timestamp > old.timestamp else old
+
+
+def read_table(path: str) -> Iterator[Tuple[str, Optional[LookupResult]]]:
+    """
+    Iterate over the entries of a json, binary or sqlite lookup table.
+    json tables may be gzip or xz compressed.
+    """
+    store = open_store(path)
+    if store is not None:
+        try:
+            yield from store.items()
+        finally:
+            store.close()
+        return
+    with open_table(path, "r") as handle:
+        yield from read_query_results(handle)
+
+
+def _merge_into_sqlite(path: str,
+                       entries: Iterable[Tuple[str, Optional[LookupResult]]],
+                       on_conflict: str) -> int:
+    """
+    Upsert entries into an sqlite table in a single transaction, which is
+    rolled back if merging fails
+    :return: number of entries in the table
+    """
+    import sqlite3
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS rsids "
+                "(rs_id TEXT PRIMARY KEY, result TEXT) WITHOUT ROWID"
+            )
+            for rs_id, result in entries:
+                row = connection.execute(
+                    "SELECT result FROM rsids WHERE rs_id = ?", (rs_id,)
+                ).fetchone()
+                if row is not None:
+                    old = None if row[0] is None else deserialize_result(
+                        row[0])
+                    result = merge_result(rs_id, old, result, on_conflict)
+                connection.execute(
+                    "INSERT OR REPLACE INTO rsids (rs_id, result) "
+                    "VALUES (?, ?)",
+                    (rs_id, None if result is None else result.serialize())
+                )
+            n_entries = connection.execute(
+                "SELECT COUNT(*) FROM rsids").fetchone()[0]
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+    finally:
+        connection.close()
+    return n_entries
+
+
+def merge_into(path: str,
+               tables: Iterable[Iterable[Tuple[str, Optional[LookupResult]]]],
+               on_conflict: str = "first") -> int:
+    """
+    Merge lookup tables into the table at path, which is created if it does
+    not exist. The table is locked while merging, so concurrent merges into
+    the same table do not lose each other's entries. Entries are merged with
+    `merge_result`, in order: the existing table first.
+
+    sqlite tables are updated in place, in a single transaction, so only
+    one entry at a time is held in memory. json and binary tables are not
+    merged streaming: the union of the existing table and all input tables
+    is built in memory, in an `InternedStore`, and is then written to a
+    temporary file that atomically replaces the table. Memory use is
+    therefore proportional to the number of distinct rs ids of the merged
+    table.
+
+    :param path: path to json, binary or sqlite table
+    :param tables: iterables of rs id and result, such as `read_table`
+    :param on_conflict: one of MERGE_POLICIES
+    :return: number of entries in the merged table
+    """
+    if on_conflict not in MERGE_POLICIES:
+        raise ValueError(f"Unknown conflict policy {on_conflict}")
+    with file_lock(path):
+        if is_sqlite(path) and not is_binary_table(path):
+            return _merge_into_sqlite(
+                path, itertools.chain.from_iterable(tables), on_conflict)
+
+        merged = InternedStore()
+        existing = [read_table(path)] if os.path.exists(path) else []
+        for rs_id, result in itertools.chain.from_iterable(
+                itertools.chain(existing, tables)):
+            if rs_id in merged:
+                result = merge_result(rs_id, merged[rs_id], result,
+                                      on_conflict)
+            merged[rs_id] = result
+
+        base, ext = os.path.splitext(path)
+        tmp_path = f"{base}.{os.getpid()}.tmp{ext}"
+        if not write_store(merged, tmp_path):
+            with open_table(tmp_path, "w") as handle:
+                write_query_results(merged, handle)
+            fd = os.open(tmp_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        os.replace(tmp_path, path)
+    return len(merged)
@@ -107,6 +107,21 @@ class Variant(object):
         return (self.chrom, self.pos) < (other.chrom, other.pos)
 
 
+class MultiSampleVariant(Variant):
+    """
+    Variant with a GT entry per sample. Genotypes are given as GT strings,
+    as they may refer to any of the alt alleles.
+    """
+    def __init__(self, chrom: str, pos: int, ref: str, alt: List[str],
+                 qual: float, genotypes: List[str], **kwargs):
+        super().__init__(chrom, pos, ref, alt, qual, **kwargs)
+        self.genotypes = genotypes
+
+    @property
+    def vcf_line(self) -> str:
+        return super().vcf_line + "\tGT\t" + "\t".join(self.genotypes)
+
+
 class HeaderLine(object):
 
     def __str__(self) -> str:
@@ -175,10 +190,10 @@ def date_header() -> MetaLine:
     return MetaLine("fileDate", d)
 
 
-def chrom_header(sample_name: str) -> str:
-    """Create final header line. Single sample only"""
+def chrom_header(*sample_names: str) -> str:
+    """Create final header line, with a column per sample"""
     s = "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{0}".format(
-        sample_name
+        "\t".join(sample_names)
     )
     return s
 
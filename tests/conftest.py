@@ -0,0 +1,98 @@
+"""
+conftest.py
+~~~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+
+:license: MIT
+"""
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+STAND_IN_VARIATIONS = {
+    "rs1": {"mappings": [{"allele_string": "A/G"}], "minor_allele": "G"},
+    "rs2": {"mappings": [{"allele_string": "C/T"}], "minor_allele": "C"},
+    "rs3": {"mappings": [{"allele_string": "T/A/G"}], "minor_allele": None},
+    "rs4": {"mappings": [], "minor_allele": "A"},
+}
+
+
+class EnsemblStandIn(BaseHTTPRequestHandler):
+    """Serves the variation endpoints of the ensembl REST API locally"""
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # headers and body are written separately; avoid delayed ACK stalls
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.connections += 1
+
+    def do_GET(self):
+        rs_id = self.path.split("?")[0].rsplit("/", 1)[-1]
+        self.server.requests.append(("GET", rs_id))
+        if rs_id in STAND_IN_VARIATIONS:
+            self.reply(200, STAND_IN_VARIATIONS[rs_id])
+        else:
+            self.reply(400, {"error": f"{rs_id} not found for human"})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        rs_ids = json.loads(body)["ids"]
+        self.server.requests.append(("POST", rs_ids))
+        self.reply(200, {x: STAND_IN_VARIATIONS[x] for x in rs_ids
+                         if x in STAND_IN_VARIATIONS})
+
+    def reply(self, status, content, headers=None):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def serve_stand_in():
+    """Start a local server with a (subclass of) EnsemblStandIn"""
+    servers = []
+
+    def serve(handler=EnsemblStandIn):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        server.daemon_threads = True
+        server.requests = []
+        server.connections = 0
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        server.url = f"http://127.0.0.1:{server.server_port}"
+        servers.append(server)
+        return server
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def stand_in_server(serve_stand_in):
+    return serve_stand_in()
+
+
+@pytest.fixture
+def silent_server():
+    """A server that accepts connections, but never answers"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(16)
+    yield f"http://127.0.0.1:{sock.getsockname()[1]}"
+    sock.close()
@@ -0,0 +1,185 @@
+"""
+test_aio.py
+~~~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+
+:license: MIT
+"""
+import asyncio
+import json
+from pathlib import Path
+
+from array_as_vcf.aio import AsyncRSLookup, convert_async
+from array_as_vcf.lookup import MissingReason, QueryResult, RSLookup
+from array_as_vcf.readers import AffyReader
+
+from conftest import STAND_IN_VARIATIONS
+
+import pytest
+
+_affy_path = str(Path(__file__).parent / Path("data") /
+                 Path("affy_test.txt"))
+
+
+class AsyncStandIn(object):
+    """
+    Serves the variation endpoints of the ensembl REST API on the running
+    event loop, and keeps track of the number of concurrent requests
+    """
+
+    def __init__(self, delay=0.01, chunked=False,
+                 variations=STAND_IN_VARIATIONS):
+        self.delay = delay
+        self.variations = variations
+        self.chunked = chunked
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        port = self.server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            method, path, _ = (await reader.readline()).decode().split(" ")
+            headers = {}
+            for line in (await reader.readuntil(b"\r\n\r\n")).splitlines():
+                if b":" in line:
+                    key, value = line.decode().split(":", 1)
+                    headers[key.lower()] = value.strip()
+            await asyncio.sleep(self.delay)
+            if method == "POST":
+                body = await reader.readexactly(
+                    int(headers["content-length"]))
+                rs_ids = json.loads(body)["ids"]
+                self.requests.append(("POST", rs_ids))
+                status, content = 200, {x: self.variations[x]
+                                        for x in rs_ids
+                                        if x in self.variations}
+            else:
+                rs_id = path.split("?")[0].rsplit("/", 1)[-1]
+                self.requests.append(("GET", rs_id))
+                if rs_id in self.variations:
+                    status, content = 200, self.variations[rs_id]
+                else:
+                    status = 400
+                    content = {"error": f"{rs_id} not found for human"}
+            body = json.dumps(content).encode()
+            writer.write(f"HTTP/1.1 {status} OK\r\n"
+                         f"Content-Type: application/json\r\n".encode())
+            if self.chunked:
+                half = len(body) // 2
+                writer.write(b"Transfer-Encoding: chunked\r\n\r\n")
+                for chunk in (body[:half], body[half:], b""):
+                    writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            else:
+                writer.write(b"Content-Length: %d\r\n\r\n%s"
+                             % (len(body), body))
+            await writer.drain()
+        finally:
+            self.in_flight -= 1
+            writer.close()
+
+
+@pytest.fixture
+def run():
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture
+def stand_in(run):
+    server = run(AsyncStandIn().start())
+    yield server
+    run(server.stop())
+
+
+def test_resolve_many(run, stand_in):
+    look = RSLookup("GRCh37", server=stand_in.url, batch_size=2)
+    async_look = AsyncRSLookup(look, max_in_flight=2)
+    ids = ["rs1", "rs2", "rs3", "rs4", "rs5", "rs1"]
+    assert run(async_look.resolve_many(ids)) == 3
+    assert sorted(stand_in.requests) == [
+        ("GET", "rs5"), ("POST", ["rs1", "rs2"]), ("POST", ["rs3", "rs4"])]
+    # shares the table and parsing with the lookup
+    assert look["rs2"] == QueryResult("C", ["T"], True)
+    assert look["rs3"] == QueryResult("T", ["A", "G"], None)
+    with pytest.raises(KeyError, match=MissingReason.unmapped.value):
+        look["rs4"]
+    with pytest.raises(KeyError, match=MissingReason.not_found.value):
+        look["rs5"]
+    assert len(stand_in.requests) == 3
+    # nothing left to resolve
+    assert run(async_look.resolve_many(ids)) == 0
+    assert len(stand_in.requests) == 3
+
+
+def test_resolve_many_in_flight_limit(run, stand_in):
+    look = RSLookup("GRCh37", server=stand_in.url, batch_size=1)
+    ids = [f"rs{i}" for i in range(1, 21)]
+    assert run(AsyncRSLookup(look, max_in_flight=3).resolve_many(ids)) == 3
+    assert len(stand_in.requests) == 20
+    assert 1 < stand_in.max_in_flight <= 3
+
+
+def test_resolve_many_chunked(run):
+    async def resolve():
+        server = await AsyncStandIn(chunked=True).start()
+        look = RSLookup("GRCh37", server=server.url)
+        await AsyncRSLookup(look).resolve_many(["rs1", "rs2"])
+        await server.stop()
+        return look
+
+    look = run(resolve())
+    assert look["rs1"] == QueryResult("A", ["G"], False)
+
+
+def test_resolve_many_unreachable(run):
+    look = RSLookup("GRCh37", server="http://127.0.0.1:1", max_failures=1)
+    async_look = AsyncRSLookup(look)
+    assert run(async_look.resolve_many(["rs1", "rs2"])) == 0
+    with pytest.raises(KeyError, match=MissingReason.error.value):
+        look["rs1"]
+    # the breaker is open, further ids are not requested
+    assert run(async_look.resolve_many(["rs3"])) == 0
+    assert look.missing(["rs3"]) == {"rs3"}
+
+
+def test_resolve_many_timeout(run, silent_server):
+    look = RSLookup("GRCh37", server=silent_server, request_timeout=0.2,
+                    batch_size=2)
+    assert run(AsyncRSLookup(look).resolve_many(["rs1", "rs2"])) == 0
+    assert look.stats()["requests"]["failures"] == {"timeout": 1}
+    with pytest.raises(KeyError, match=MissingReason.error.value):
+        look["rs1"]
+
+
+def test_convert_async(run):
+    rs_ids = set(AffyReader(_affy_path, RSLookup("GRCh37")).rs_ids())
+    variations = {x: {"mappings": [{"allele_string": "T/C"}],
+                      "minor_allele": "C"} for x in rs_ids if x != "rs0"}
+
+    async def convert():
+        server = await AsyncStandIn(delay=0, variations=variations).start()
+        look = RSLookup("GRCh37", server=server.url)
+        variants = await convert_async(AffyReader(_affy_path, look))
+        await server.stop()
+        return variants, server
+
+    variants, server = run(convert())
+    assert server.requests == [("POST", sorted(rs_ids))]
+    # rs0 is not known
+    assert len(variants) == 10
+    assert [x.chrom for x in variants] == ["1"] * 8 + ["X"] * 2
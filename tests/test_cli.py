@@ -0,0 +1,131 @@
+"""
+test_cli.py
+~~~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+
+:license: MIT
+"""
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict
+
+from array_as_vcf.cli import convert
+from array_as_vcf.stores import read_table
+
+DATA = Path(__file__).parent / "data"
+
+# Modules that the conversion commands should not pay for at start-up
+HEAVY_MODULES = ["urllib.request", "http.client", "ssl", "asyncio",
+                 "socketserver", "array_as_vcf.ensembl",
+                 "array_as_vcf.server", "array_as_vcf.dbsnp",
+                 "array_as_vcf.stores", "json", "sqlite3"]
+# Generous bound on the import time of the cli in seconds, which only
+# catches large regressions on slow machines
+IMPORT_BUDGET = 0.5
+
+
+def import_times(module: str) -> Dict[str, int]:
+    """
+    Import a module in a fresh interpreter with `-X importtime`
+    :return: cumulative import time in microseconds per imported module
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            times[fields[2].strip()] = int(fields[1])
+    return times
+
+
+def test_cli_import_time():
+    times = import_times("array_as_vcf.cli")
+    assert [x for x in HEAVY_MODULES if x in times] == []
+    assert times["array_as_vcf.cli"] / 1e6 < IMPORT_BUDGET
+
+
+def test_convert_stats_json(tmp_path, monkeypatch, capsys):
+    stats_path = tmp_path / "stats.json"
+    monkeypatch.setattr(sys, "argv", [
+        "aav", "-p", str(DATA / "affy_test.txt"), "-s", "sample",
+        "-l", str(DATA / "lookup_table_test.json"), "--no-ensembl-lookup",
+        "--stats-json", str(stats_path)])
+    convert()
+    assert capsys.readouterr().out.startswith("##fileformat=VCF")
+    stats = json.loads(stats_path.read_text())
+    assert stats["sample"] == "sample"
+    assert stats["seconds"] > 0
+    assert stats["lookup"]["hits"] > 0
+    assert stats["lookup"]["requests"]["successes"] == 0
+
+
+def test_convert_all_samples(tmp_path, monkeypatch, capsys):
+    args = ["aav", "-p", str(DATA / "open_array_test.txt"),
+            "-l", str(DATA / "lookup_table_test.json"), "--no-ensembl-lookup",
+            "--encoding", "windows-1252"]
+    monkeypatch.setattr(sys, "argv", args + ["-s", "e31a0a96465a"])
+    convert()
+    single = capsys.readouterr().out
+
+    monkeypatch.setattr(sys, "argv", args + [
+        "--all-samples", "--output-dir", str(tmp_path / "vcfs")])
+    convert()
+    assert capsys.readouterr().out == ""
+    assert len(list((tmp_path / "vcfs").iterdir())) == 49
+    assert (tmp_path / "vcfs" / "e31a0a96465a.vcf").read_text() == single
+
+    monkeypatch.setattr(sys, "argv", args + ["--all-samples"])
+    convert()
+    lines = capsys.readouterr().out.splitlines()
+    samples = lines[[x.startswith("#CHROM") for x in lines].index(True)]
+    assert len(samples.split("\t")) == 9 + 49
+    assert all(len(x.split("\t")) == 9 + 49 for x in lines
+               if not x.startswith("#"))
+
+
+def test_convert_processes(monkeypatch, capsys):
+    args = ["aav", "-p", str(DATA / "open_array_test.txt"),
+            "-s", "e31a0a96465a", "-l", str(DATA / "lookup_table_test.json"),
+            "--no-ensembl-lookup", "--encoding", "windows-1252"]
+    monkeypatch.setattr(sys, "argv", args)
+    convert()
+    sequential = capsys.readouterr().out
+    monkeypatch.setattr(sys, "argv", args + ["--processes", "2"])
+    convert()
+    assert capsys.readouterr().out == sequential
+
+
+def test_convert_batches_lookups(stand_in_server, monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", [
+        "aav", "-p", str(DATA / "affy_test.txt"), "-s", "sample",
+        "--ensembl-server", stand_in_server.url])
+    convert()
+    assert capsys.readouterr().out.startswith("##fileformat=VCF")
+    # all missing rsIDs of the file are requested in a single batch
+    assert [x[0] for x in stand_in_server.requests] == ["POST"]
+
+
+def test_convert_merge_dump_same_sqlite(stand_in_server, tmp_path,
+                                        monkeypatch, capsys):
+    path = str(tmp_path / "lookup.db")
+    monkeypatch.setattr(sys, "argv", [
+        "aav", "-p", str(DATA / "affy_test.txt"), "-s", "sample",
+        "-l", path, "-d", path, "--merge-dump",
+        "--ensembl-server", stand_in_server.url])
+    convert()
+    first = capsys.readouterr().out
+    n_requests = len(stand_in_server.requests)
+    assert n_requests > 0
+    assert len(dict(read_table(path))) > 0
+    # the second run is answered from the dumped table
+    convert()
+    assert capsys.readouterr().out == first
+    assert len(stand_in_server.requests) == n_requests
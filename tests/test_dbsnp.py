@@ -0,0 +1,107 @@
+"""
+test_dbsnp.py
+~~~~~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+
+:license: MIT
+"""
+import gzip
+from pathlib import Path
+
+from array_as_vcf.dbsnp import (build_lookup, parse_frequencies,
+                                read_dbsnp, ref_is_minor)
+from array_as_vcf.lookup import QueryResult, RSLookup
+from array_as_vcf.readers import AffyReader, array_rs_ids
+
+import pytest
+
+_affy_path = str(Path(__file__).parent / Path("data") /
+                 Path("affy_test.txt"))
+_open_array_path = str(Path(__file__).parent / Path("data") /
+                       Path("open_array_test.txt"))
+
+DBSNP_VCF = """\
+##fileformat=VCFv4.0
+##INFO=<ID=CAF,Number=.,Type=String,Description="Allele frequencies">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO
+1\t825852\trs2980300\tT\tC\t.\t.\tRS=2980300;CAF=0.2,0.8;COMMON=1
+1\t1170650\trs10907175\tC\tA\t.\t.\tRS=10907175;CAF=0.9,0.1
+1\t1196054\trs2887286\tC\tT\t.\t.\tRS=2887286
+1\t1308770\trs307378\tG\tT,C\t.\t.\tFREQ=GnomAD:0.1,0.6,0.3|1000Genomes:0.5,0.2,0.3
+1\t1308771\trs307378\tA\tG\t.\t.\tCAF=0.5,0.5
+1\t2000000\trs1;rs2\tA\tG\t.\t.\tCAF=0.1,0.9
+1\t2000001\trs3\tA\t.\t.\t.\tCAF=1
+"""  # noqa: E501
+
+
+@pytest.fixture(params=["plain", "gzip"])
+def dbsnp_vcf(request, tmp_path):
+    if request.param == "gzip":
+        path = tmp_path / "dbsnp.vcf.gz"
+        with gzip.open(str(path), "wt") as handle:
+            handle.write(DBSNP_VCF)
+    else:
+        path = tmp_path / "dbsnp.vcf"
+        path.write_text(DBSNP_VCF)
+    return str(path)
+
+
+def test_parse_frequencies():
+    assert parse_frequencies("RS=1;CAF=0.9,.,0.1") == [0.9, None, 0.1]
+    freq = "FREQ=GnomAD:0.1,0.9|1000Genomes:0.7,0.3"
+    assert parse_frequencies(freq) == [0.7, 0.3]
+    assert parse_frequencies(freq, source="TOPMED") == [0.1, 0.9]
+    assert parse_frequencies("RS=1;COMMON=1") is None
+
+
+def test_ref_is_minor():
+    assert ref_is_minor([0.2, 0.8]) is True
+    assert ref_is_minor([0.8, 0.2]) is False
+    # minor is the allele with the second highest frequency
+    assert ref_is_minor([0.3, 0.6, 0.1]) is True
+    assert ref_is_minor([0.1, 0.6, 0.3]) is False
+    assert ref_is_minor([0.9, None]) is None
+    assert ref_is_minor(None) is None
+
+
+def test_read_dbsnp(dbsnp_vcf):
+    table = dict(read_dbsnp(dbsnp_vcf))
+    assert table == {
+        "rs2980300": QueryResult("T", ["C"], True),
+        "rs10907175": QueryResult("C", ["A"], False),
+        "rs2887286": QueryResult("C", ["T"], None),
+        "rs307378": QueryResult("G", ["T", "C"], False),
+        "rs1": QueryResult("A", ["G"], True),
+        "rs2": QueryResult("A", ["G"], True),
+    }
+
+
+def test_read_dbsnp_filtered(dbsnp_vcf):
+    table = dict(read_dbsnp(dbsnp_vcf, {"rs2", "rs307378", "rs5"}))
+    assert sorted(table) == ["rs2", "rs307378"]
+
+
+def test_array_rs_ids():
+    assert array_rs_ids([_affy_path]) == {
+        "rs2980300", "rs10907175", "rs2887286", "rs307378", "rs0",
+        "rs12939215"}
+    # all samples of an OpenArray file
+    open_array = array_rs_ids([_open_array_path], encoding="windows-1252")
+    assert len(open_array) > 0
+    assert array_rs_ids([_affy_path, _open_array_path],
+                        encoding="windows-1252") > open_array
+
+
+def test_build_lookup(dbsnp_vcf, tmp_path):
+    table = build_lookup(dbsnp_vcf, [_affy_path])
+    assert sorted(table) == ["rs10907175", "rs2887286", "rs2980300",
+                             "rs307378"]
+    path = str(tmp_path / "lookup.json")
+    RSLookup("GRCh37", table, ensembl_lookup=False).dump(path)
+
+    look = RSLookup.from_path(path, "GRCh37", ensembl_lookup=False)
+    variants = list(AffyReader(_affy_path, look))
+    # rs2887286 has no frequencies and rs0, rs12939215 are unknown
+    assert len(variants) == 6
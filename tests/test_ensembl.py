@@ -0,0 +1,197 @@
+"""
+test_ensembl.py
+~~~~~~~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+
+:license: MIT
+"""
+import time
+from urllib.error import HTTPError, URLError
+
+from array_as_vcf.ensembl import EnsemblClient, RateLimiter
+from array_as_vcf.lookup import (MissingReason, QueryResult, RSLookup,
+                                 failure_reason)
+
+from conftest import EnsemblStandIn
+
+import pytest
+
+
+@pytest.fixture
+def client(stand_in_server):
+    client = EnsemblClient("GRCh37", timeout=5, server=stand_in_server.url)
+    yield client
+    client.close()
+
+
+def test_client_reuses_connection(client, stand_in_server):
+    for _ in range(5):
+        assert client.query("rs1") == QueryResult("A", ["G"], False)
+    assert client.connections_opened == 1
+    assert stand_in_server.connections == 1
+
+
+def test_client_errors(client, stand_in_server):
+    with pytest.raises(RuntimeError, match="not found for human"):
+        client.query("rs5")
+    with pytest.raises(RuntimeError, match="does not map"):
+        client.query("rs4")
+    # Error responses do not close the connection
+    assert client.query("rs2") == QueryResult("C", ["T"], True)
+    assert stand_in_server.connections == 1
+
+
+def test_client_batch(client):
+    results = client.query_batch(["rs1", "rs3", "rs4", "rs5"])
+    assert results["rs1"] == QueryResult("A", ["G"], False)
+    assert results["rs3"] == QueryResult("T", ["A", "G"], None)
+    assert results["rs4"].reason == MissingReason.unmapped
+    assert results["rs5"].reason == MissingReason.not_found
+
+
+def test_client_reconnects(client, stand_in_server):
+    client.query("rs1")
+    # Simulate the server closing the idle connection
+    connection = client._idle.get_nowait()
+    connection.sock.close()
+    client._idle.put(connection)
+    assert client.query("rs1") == QueryResult("A", ["G"], False)
+    assert client.connections_opened == 2
+
+
+def test_client_unreachable():
+    client = EnsemblClient("GRCh37", timeout=1, server="http://127.0.0.1:1")
+    with pytest.raises(URLError):
+        client.query("rs1")
+
+
+def test_client_timeout(silent_server):
+    client = EnsemblClient("GRCh37", timeout=120, server=silent_server)
+    started = time.monotonic()
+    with pytest.raises(URLError) as error:
+        client.query("rs1", timeout=0.2)
+    assert time.monotonic() - started < 5
+    assert failure_reason(error.value) == "timeout"
+
+
+def test_lookup_budget_with_client(silent_server):
+    client = EnsemblClient("GRCh37", timeout=120, server=silent_server,
+                           rate_limiter=RateLimiter(rate=0.1, burst=1))
+    look = RSLookup("GRCh37", client=client, lookup_budget=0.5,
+                    request_tries=3, retry_backoff=0)
+    started = time.monotonic()
+    with pytest.raises(KeyError, match="error"):
+        look["rs1"]
+    assert look.prefetch(["rs2", "rs3"]) == 0
+    # the budget bounds the requests and the waits for the rate limit
+    assert time.monotonic() - started < 5
+    client.close()
+
+
+def test_lookup_with_client(client, stand_in_server):
+    look = RSLookup("GRCh37", client=client, batch_size=2)
+    assert look.prefetch(["rs1", "rs2", "rs3", "rs4", "rs5"],
+                         workers=1) == 3
+    assert look["rs2"] == QueryResult("C", ["T"], True)
+    with pytest.raises(KeyError, match="unmapped"):
+        look["rs4"]
+    assert len(stand_in_server.requests) == 3
+    assert stand_in_server.connections == 1
+
+
+class RateLimitedStandIn(EnsemblStandIn):
+    """Rejects the first requests with 429, then announces the rate limit"""
+
+    def reply(self, status, content, headers=None):
+        if self.server.rejects > 0:
+            self.server.rejects -= 1
+            super().reply(429, {"error": "Too many requests"},
+                          {"Retry-After": "0.2"})
+        else:
+            super().reply(status, content,
+                          {"X-RateLimit-Limit": "55000",
+                           "X-RateLimit-Remaining": "10",
+                           "X-RateLimit-Reset": "2"})
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def test_rate_limiter_paces():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=2, burst=1, clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        limiter.acquire()
+    assert clock.sleeps == [0.5, 0.5]
+    clock.now += 10
+    limiter.acquire()
+    assert clock.sleeps == [0.5, 0.5]
+
+
+def test_rate_limiter_timeout():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=1, burst=1, clock=clock, sleep=clock.sleep)
+    assert limiter.acquire(timeout=0)
+    assert not limiter.acquire(timeout=0.5)
+    assert clock.sleeps == []
+    assert limiter.acquire(timeout=2)
+    assert clock.sleeps == [1]
+
+
+def test_rate_limiter_headers():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=10, burst=1, clock=clock, sleep=clock.sleep)
+    limiter.update({"X-RateLimit-Remaining": "100",
+                    "X-RateLimit-Reset": "50"})
+    assert limiter.rate == 2
+    # never faster than the configured rate
+    limiter.update({"X-RateLimit-Remaining": "1000",
+                    "X-RateLimit-Reset": "1"})
+    assert limiter.rate == 10
+    limiter.update({"Retry-After": "3"})
+    limiter.acquire()
+    assert clock.sleeps == [3]
+    limiter.update({"X-RateLimit-Remaining": "0",
+                    "X-RateLimit-Reset": "7"})
+    limiter.acquire()
+    assert clock.sleeps == [3, 7]
+
+
+def test_client_rate_limited(serve_stand_in):
+    server = serve_stand_in(RateLimitedStandIn)
+    server.rejects = 2
+    limiter = RateLimiter(rate=1000)
+    client = EnsemblClient("GRCh37", timeout=5, server=server.url,
+                           rate_limiter=limiter)
+    start = time.monotonic()
+    assert client.query("rs1") == QueryResult("A", ["G"], False)
+    assert time.monotonic() - start >= 0.4
+    assert len(server.requests) == 3
+    # adapted to the announced rate limit
+    assert limiter.rate == 5
+    client.close()
+
+
+def test_client_rate_limited_gives_up(serve_stand_in):
+    server = serve_stand_in(RateLimitedStandIn)
+    server.rejects = 10
+    client = EnsemblClient("GRCh37", timeout=5, server=server.url,
+                           rate_limiter=RateLimiter(rate=1000),
+                           rate_limited_tries=2)
+    with pytest.raises(HTTPError) as e:
+        client.query("rs1")
+    assert e.value.code == 429
+    assert len(server.requests) == 2
+    client.close()
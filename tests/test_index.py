@@ -0,0 +1,112 @@
+"""
+test_index.py
+~~~~~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+
+:license: MIT
+"""
+import os
+import shutil
+import sys
+from pathlib import Path
+
+from array_as_vcf.cli import list_samples
+from array_as_vcf.index import (SampleIndex, index_path, open_index,
+                                read_ranges)
+from array_as_vcf.lookup import RSLookup
+from array_as_vcf.readers import OpenArrayReader
+
+import pytest
+
+DATA = Path(__file__).parent / "data"
+ENCODING = "windows-1252"
+
+
+@pytest.fixture
+def open_array_path(tmp_path):
+    path = tmp_path / "open_array_test.txt"
+    shutil.copy(str(DATA / "open_array_test.txt"), str(path))
+    return str(path)
+
+
+def lookup_table():
+    return RSLookup.from_path(str(DATA / "lookup_table_test.json"),
+                              build="GRCh37", ensembl_lookup=False)
+
+
+def scan_rows(path):
+    """Sample ID and Assay ID of the data rows, by scanning the file"""
+    with open(path, encoding=ENCODING) as handle:
+        header = [next(handle) for _ in range(18)][-1].strip().split("\t")
+        for line in handle:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) >= 8:
+                yield (fields[header.index("Sample ID")],
+                       fields[header.index("Assay ID")])
+
+
+def test_build_index(open_array_path):
+    index = SampleIndex.build(open_array_path, ENCODING)
+    rows = list(scan_rows(open_array_path))
+    samples = [sample for sample, _ in rows]
+    assert len(index.samples) == 49
+    assert sum(x.rows for x in index.samples.values()) == len(rows)
+    assert sum(x.rows for x in index.assays.values()) == len(rows)
+    for sample, ranges in index.samples.items():
+        lines = list(read_ranges(open_array_path, ranges.ranges, ENCODING))
+        assert len(lines) == ranges.rows == samples.count(sample)
+        assert all(sample in line.split("\t") for _, line in lines)
+
+
+def test_indexed_reader(open_array_path):
+    index = SampleIndex.build(open_array_path, ENCODING)
+    for sample, n_variants in (("e31a0a96465a", 55), ("missing", 0)):
+        readers = [OpenArrayReader(open_array_path, lookup_table(), sample,
+                                   encoding=ENCODING, index=x)
+                   for x in (None, index)]
+        assert list(readers[0].rs_ids()) == list(readers[1].rs_ids())
+        lines = [[x.vcf_line for x in reader] for reader in readers]
+        assert lines[0] == lines[1]
+        assert len(lines[1]) == n_variants
+
+
+def test_indexed_reader_blank_line(tmp_path):
+    # Rows after an empty line are read as by the reader without index
+    lines = (DATA / "open_array_test.txt").read_bytes().splitlines()
+    path = str(tmp_path / "open_array.txt")
+    Path(path).write_bytes(b"\n".join(lines + [b""] + lines[18:]) + b"\n")
+    readers = [OpenArrayReader(path, lookup_table(), "e31a0a96465a",
+                               encoding=ENCODING, index=x)
+               for x in (None, SampleIndex.build(path, ENCODING))]
+    lines = [[x.vcf_line for x in reader] for reader in readers]
+    assert lines[0] == lines[1]
+    assert len(lines[1]) == 110
+
+
+def test_open_index(open_array_path):
+    index = open_index(open_array_path, ENCODING)
+    assert os.path.exists(index_path(open_array_path))
+    loaded = open_index(open_array_path, ENCODING)
+    assert loaded.samples.keys() == index.samples.keys()
+    assert loaded.samples["e31a0a96465a"].ranges == \
+        index.samples["e31a0a96465a"].ranges
+
+    # The index is rebuilt once the file changes
+    with open(open_array_path, "ab") as handle:
+        handle.write(b"\n")
+    assert not loaded.is_current(open_array_path)
+    assert open_index(open_array_path, ENCODING).is_current(open_array_path)
+
+
+def test_list_samples(open_array_path, monkeypatch, capsys):
+    monkeypatch.setattr(sys, "argv", [
+        "aav-list-samples", "-p", open_array_path, "--encoding", ENCODING])
+    list_samples()
+    rows = [x.split("\t") for x in capsys.readouterr().out.splitlines()]
+    assert len(rows) == 49
+    assert sum(int(x[1]) for x in rows) == len(list(scan_rows(
+        open_array_path)))
+    # Answered from the saved index
+    assert os.path.exists(index_path(open_array_path))
@@ -6,12 +6,20 @@ test_lookup.py
 :copyright: (c) 2018 Leiden University Medical Center
 :license: MIT
 """
+import io
 import json
 import os
+import socket
 from datetime import datetime
-from urllib.error import URLError
+from urllib.error import HTTPError, URLError
 
-from array_as_vcf.lookup import QueryResult, RSLookup, query_ensembl
+from array_as_vcf import lookup as lookup_module
+from array_as_vcf.lookup import (CircuitBreaker, MissingReason,
+                                 MissingResult, NotFoundError, QueryResult,
+                                 RSLookup, failure_reason, iter_json_table,
+                                 query_ensembl, query_ensembl_batch,
+                                 read_query_results, serialize_query_results,
+                                 write_query_results)
 
 import pytest
 
@@ -228,6 +236,40 @@ def test_lookup_table_dump(lookup_table):
     assert generated == original
 
 
+@pytest.mark.parametrize("results", [
+    {},
+    {"rs1": QueryResult("A", ["G"], False), "rs2": None},
+    {"rs\u00e9\"": MissingResult(MissingReason.error, 1500000000),
+     "rs3": QueryResult("T", ["A", "G"], None)},
+])
+def test_write_query_results(results):
+    handle = io.StringIO()
+    write_query_results(results, handle)
+    assert handle.getvalue() == serialize_query_results(results)
+    handle.seek(0)
+    assert dict(read_query_results(handle)) == results
+
+
+def test_iter_json_table_chunks(lookup_table):
+    with open(lookup_table) as handle:
+        original = json.load(handle)
+        handle.seek(0)
+        # chunks that split keys, values and nulls
+        assert dict(iter_json_table(handle, chunk_size=3)) == original
+    spaced = ' \n{ "rs1" :\t"A:G:F" ,\n"rs2":null }\n'
+    assert dict(iter_json_table(io.StringIO(spaced), chunk_size=2)) == {
+        "rs1": "A:G:F", "rs2": None}
+
+
+@pytest.mark.parametrize("document", [
+    "", "[]", '{"rs1": "A:G:F"', '{"rs1": 1}', '{"rs1": "A:G:F",}',
+    '{"rs1": "A:G:F"} {}', '{null: "A:G:F"}',
+])
+def test_iter_json_table_invalid(document):
+    with pytest.raises(ValueError):
+        dict(iter_json_table(io.StringIO(document), chunk_size=4))
+
+
 @pytest.mark.xfail
 def test_lookup_online():
     look = RSLookup(build="GRCh37", ensembl_lookup=True)
@@ -238,3 +280,274 @@ def test_lookup_offline():
     look = RSLookup(build="GRCh37", ensembl_lookup=False)
     with pytest.raises(KeyError):
         look['rs3934834']
+
+
+@pytest.fixture
+def fake_ensembl(monkeypatch):
+    """Replace query_ensembl, recording the queried rs ids"""
+    queried = []
+
+    def fake_query(rs_id, build, timeout=120, server=None):
+        queried.append(rs_id)
+        if rs_id == "rs0":
+            raise NotFoundError("rsID not found for human")
+        if rs_id.startswith("rs00"):
+            # as raised by urllib for read timeouts
+            raise socket.timeout("timed out")
+        return QueryResult("A", ["G"], False)
+
+    def fake_query_batch(rs_ids, build, timeout=120, server=None):
+        queried.extend(rs_ids)
+        return {x: QueryResult("A", ["G"], False) for x in rs_ids
+                if x != "rs0"}
+
+    monkeypatch.setattr(lookup_module, "query_ensembl", fake_query)
+    monkeypatch.setattr(lookup_module, "query_ensembl_batch",
+                        fake_query_batch)
+    return queried
+
+
+def test_lookup_prefetch(fake_ensembl):
+    look = RSLookup(build="GRCh37")
+    added = look.prefetch(["rs1", "rs2", "rs1", "rs3"], workers=4)
+    assert added == 3
+    assert sorted(fake_ensembl) == ["rs1", "rs2", "rs3"]
+    assert look["rs2"] == QueryResult("A", ["G"], False)
+    assert len(fake_ensembl) == 3
+
+
+def test_lookup_prefetch_skips_known(fake_ensembl, lookup_table):
+    look = RSLookup.from_path(lookup_table, "GRCh37")
+    look.prefetch(["rs776746", "rs1"], workers=2)
+    assert fake_ensembl == ["rs1"]
+
+
+def test_lookup_prefetch_failed_not_requeried(fake_ensembl):
+    look = RSLookup(build="GRCh37", request_tries=2)
+    assert look.prefetch(["rs0"], workers=2) == 0
+    assert fake_ensembl == ["rs0"]
+    with pytest.raises(KeyError, match="rs0"):
+        look["rs0"]
+    assert fake_ensembl == ["rs0"]
+
+
+def test_lookup_prefetch_offline(fake_ensembl):
+    look = RSLookup(build="GRCh37", ensembl_lookup=False)
+    assert look.prefetch(["rs1"], workers=2) == 0
+    assert fake_ensembl == []
+
+
+def test_query_ensembl_stand_in(stand_in_server):
+    assert query_ensembl("rs1", "GRCh37",
+                         server=stand_in_server.url) == QueryResult(
+        "A", ["G"], False)
+    with pytest.raises(RuntimeError, match="not found for human"):
+        query_ensembl("rs5", "GRCh37", server=stand_in_server.url)
+
+
+def test_query_ensembl_batch(stand_in_server):
+    results = query_ensembl_batch(["rs1", "rs2", "rs3", "rs4", "rs5"],
+                                  "GRCh37", server=stand_in_server.url)
+    assert results["rs1"] == QueryResult("A", ["G"], False)
+    assert results["rs2"] == QueryResult("C", ["T"], True)
+    assert results["rs3"] == QueryResult("T", ["A", "G"], None)
+    assert results["rs4"].reason == MissingReason.unmapped
+    assert results["rs5"].reason == MissingReason.not_found
+    assert stand_in_server.requests == [
+        ("POST", ["rs1", "rs2", "rs3", "rs4", "rs5"])]
+
+
+def test_query_ensembl_batch_too_large():
+    with pytest.raises(ValueError):
+        query_ensembl_batch([f"rs{i}" for i in range(201)], "GRCh37")
+
+
+def test_lookup_prefetch_batched(stand_in_server):
+    look = RSLookup(build="GRCh37", server=stand_in_server.url,
+                    batch_size=2)
+    added = look.prefetch(["rs1", "rs2", "rs3", "rs4", "rs5", "rs1"],
+                          workers=2)
+    assert added == 3
+    assert sorted(stand_in_server.requests, key=str) == [
+        ("GET", "rs5"), ("POST", ["rs1", "rs2"]), ("POST", ["rs3", "rs4"])]
+    assert look["rs3"] == QueryResult("T", ["A", "G"], None)
+    with pytest.raises(KeyError, match="rs4"):
+        look["rs4"]
+    assert len(stand_in_server.requests) == 3
+
+
+def test_missing_result_serialize():
+    missing = MissingResult(MissingReason.unmapped, 1500000000)
+    assert missing.serialize() == "!unmapped:1500000000"
+    assert MissingResult.deserialize("!unmapped:1500000000") == missing
+    with pytest.raises(ValueError):
+        MissingResult.deserialize("A:G:F")
+
+
+def test_lookup_negative_cache(fake_ensembl, tmp_path):
+    look = RSLookup(build="GRCh37", request_tries=3, retry_backoff=0)
+    for rs_id in ("rs0", "rs00"):
+        with pytest.raises(KeyError, match=rs_id):
+            look[rs_id]
+        with pytest.raises(KeyError, match=rs_id):
+            look[rs_id]
+    assert fake_ensembl == ["rs0", "rs00", "rs00", "rs00"]
+
+    dumped = json.loads(look.dumps())
+    assert dumped["rs0"].startswith("!not_found:")
+    assert dumped["rs00"].startswith("!error:")
+    path = str(tmp_path / "lookup.json")
+    look.dump(path)
+
+    # not found rsIDs are not retried, errors are by default
+    reloaded = RSLookup.from_path(path, "GRCh37")
+    with pytest.raises(KeyError, match="not_found"):
+        reloaded["rs0"]
+    with pytest.raises(KeyError, match="error"):
+        reloaded["rs00"]
+    assert fake_ensembl == ["rs0", "rs00", "rs00", "rs00", "rs00"]
+
+
+def test_lookup_negative_cache_ttl(fake_ensembl):
+    old = MissingResult(MissingReason.not_found, 1000)
+    look = RSLookup(build="GRCh37", init_d={"rs1": old, "rs2": old},
+                    missing_ttl=3600)
+    assert look.missing(["rs1", "rs2", "rs3"]) == {"rs1", "rs2", "rs3"}
+    assert look["rs1"] == QueryResult("A", ["G"], False)
+    assert fake_ensembl == ["rs1"]
+
+    look = RSLookup(build="GRCh37", init_d={"rs1": old})
+    assert look.missing(["rs1"]) == set()
+    with pytest.raises(KeyError):
+        look["rs1"]
+    assert fake_ensembl == ["rs1"]
+
+
+def test_lookup_retry_backoff(fake_ensembl, monkeypatch):
+    delays = []
+    monkeypatch.setattr(lookup_module.time, "sleep", delays.append)
+    look = RSLookup(build="GRCh37", request_tries=4, retry_backoff=1)
+    with pytest.raises(KeyError, match="rs00"):
+        look["rs00"]
+    assert fake_ensembl == ["rs00"] * 4
+    # no delay before the first try, exponentially growing bounds after
+    assert len(delays) == 3
+    for delay, bound in zip(delays, [1, 2, 4]):
+        assert 0 <= delay <= bound
+
+
+def test_lookup_stats(fake_ensembl, monkeypatch):
+    monkeypatch.setattr(lookup_module.time, "sleep", lambda x: None)
+    look = RSLookup("GRCh37", {"rs9": QueryResult("G", ["A"], True)},
+                    request_tries=3, retry_backoff=1)
+    look["rs9"]
+    look["rs1"]
+    look["rs1"]
+    with pytest.raises(KeyError):
+        look["rs0"]
+    with pytest.raises(KeyError):
+        look["rs00"]
+    assert look.prefetch(["rs1", "rs2", "rs3"]) == 2
+    stats = look.stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 3 + 2
+    assert stats["requests"] == {"successes": 3,
+                                 "failures": {"timeout": 3},
+                                 "retries": 2}
+    assert stats["results"] == {"found": 3, "not_found": 1, "unmapped": 0,
+                                "error": 1}
+    assert stats["latency"]["count"] == 6
+    assert sum(stats["latency"]["histogram"].values()) == 6
+    assert stats["latency"]["histogram"]["0.05"] == 6
+    assert stats["backoff_seconds"] <= 1 + 2
+    json.dumps(stats)
+
+
+def test_failure_reason():
+    assert failure_reason(HTTPError("url", 503, "down", {}, None)) == \
+        "http_503"
+    assert failure_reason(URLError(socket.timeout("timed out"))) == "timeout"
+    assert failure_reason(URLError("refused")) == "connection"
+    assert failure_reason(RuntimeError()) == "error"
+
+
+def test_lookup_read_timeout(silent_server):
+    look = RSLookup("GRCh37", request_timeout=0.2, server=silent_server,
+                    retry_backoff=0)
+    with pytest.raises(KeyError, match="error"):
+        look["rs1"]
+    look.batch_size = 2
+    assert look.prefetch(["rs2", "rs3"]) == 0
+    assert look.stats()["requests"]["failures"] == {"timeout": 2}
+    with pytest.raises(KeyError, match="error"):
+        look["rs2"]
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_circuit_breaker():
+    clock = FakeClock()
+    breaker = CircuitBreaker(max_failures=2, reset_timeout=10, clock=clock)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+    clock.now = 10
+    # a single probe while half-open
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+    clock.now = 20
+    assert breaker.allow()
+    breaker.record_success()
+    assert not breaker.is_open
+    assert breaker.allow()
+
+
+def test_lookup_circuit_breaker(fake_ensembl):
+    clock = FakeClock()
+    look = RSLookup(build="GRCh37", retry_backoff=0)
+    look.breaker = CircuitBreaker(max_failures=2, reset_timeout=10,
+                                  clock=clock)
+    for rs_id in ("rs00", "rs001"):
+        with pytest.raises(KeyError, match="error"):
+            look[rs_id]
+    # Ensembl is considered down; misses are offline misses
+    with pytest.raises(KeyError):
+        look["rs1"]
+    assert look.prefetch(["rs2", "rs3"]) == 0
+    assert look.missing(["rs1", "rs2", "rs3"]) == {"rs1", "rs2", "rs3"}
+    assert fake_ensembl == ["rs00", "rs001"]
+
+    clock.now = 10
+    assert look["rs1"] == QueryResult("A", ["G"], False)
+    assert look.prefetch(["rs2", "rs3"]) == 2
+    assert fake_ensembl == ["rs00", "rs001", "rs1", "rs2", "rs3"]
+
+
+def test_lookup_budget(fake_ensembl, monkeypatch):
+    look = RSLookup(build="GRCh37", lookup_budget=0)
+    with pytest.raises(KeyError):
+        look["rs1"]
+    assert look.prefetch(["rs1", "rs2"]) == 0
+    assert fake_ensembl == []
+    assert len(look) == 0
+
+    now = [0.0]
+    monkeypatch.setattr(lookup_module.time, "monotonic", lambda: now[0])
+    look = RSLookup(build="GRCh37", lookup_budget=5)
+    assert look["rs1"] == QueryResult("A", ["G"], False)
+    now[0] = 5
+    with pytest.raises(KeyError):
+        look["rs2"]
+    assert fake_ensembl == ["rs1"]
@@ -0,0 +1,95 @@
+"""
+test_manifests.py
+~~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+
+:license: MIT
+"""
+from array_as_vcf.lookup import QueryResult
+from array_as_vcf.manifests import (ReferenceGenome, import_manifest,
+                                    orient)
+
+import pytest
+
+SEQUENCE = "ACGTTGCA" * 20
+
+AFFY_ANNOTATION = """\
+#%chip_type=Axiom_Test
+#%genome-version=GRCh37
+"Probe Set ID","Affy SNP ID","dbSNP RS ID","Chromosome","Physical Position","Strand","Allele A","Allele B","Ref Allele","Minor Allele"
+"AX-1","Affx-1","rs1","1","1","+","A","G","---","G"
+"AX-2","Affx-2","rs2","1","2","-","G","T","---","G"
+"AX-4","Affx-4","rs4","---","---","+","A","T","T","---"
+"AX-5","Affx-5","---","1","5","+","A","T","---","A"
+"AX-6","Affx-6","rs6","1","3","+","A","C","---","A"
+"""  # noqa: E501
+
+ILLUMINA_MANIFEST = """\
+[Heading]
+Descriptor File Name,Test.bpm
+Assay Format,Infinium HD Super
+[Assay]
+IlmnID,Name,IlmnStrand,SNP,AddressA_ID,Chr,MapInfo,RefStrand
+rs1-138_T_F_1,rs1,TOP,[A/G],1,1,1,+
+rs2-138_B_R_1,rs2,BOT,[G/T],2,1,2,-
+rs7-138_T_F_1,rs7,TOP,[A/T],3,1,4,+
+rs8-138_T_R_1,rs8,TOP,[A/G],4,1,5,
+rs9-138_T_F_1,rs9,TOP,[A/T],5,1,4,
+[Controls]
+0027630314:0027630314:0027630314:0027630314,Staining,Red,DNP (High)
+"""
+
+
+@pytest.fixture
+def reference(tmp_path):
+    path = tmp_path / "ref.fa"
+    lines = [SEQUENCE[i:i + 60] for i in range(0, len(SEQUENCE), 60)]
+    path.write_text(">1 test\n" + "\n".join(lines) + "\n")
+    (tmp_path / "ref.fa.fai").write_text(f"1\t{len(SEQUENCE)}\t8\t60\t61\n")
+    return str(path)
+
+
+def test_reference_genome(reference):
+    genome = ReferenceGenome(reference)
+    for pos in (1, 60, 61, 62, 160):
+        assert genome.base("1", pos) == SEQUENCE[pos - 1]
+    assert genome.base("chr1", 2) == "C"
+    assert genome.base("1", 161) is None
+    assert genome.base("2", 1) is None
+    genome.close()
+
+
+def test_orient():
+    assert orient(["A", "G"], None, "-") == ["T", "C"]
+    assert orient(["A", "G"], "C", None) == ["T", "C"]
+    assert orient(["A", "T"], "A", None) is None
+    assert orient(["A", "G"], None, None) is None
+
+
+def test_import_affy_annotation(reference, tmp_path):
+    path = tmp_path / "annotation.csv"
+    path.write_text(AFFY_ANNOTATION)
+    assert import_manifest(str(path), reference) == {
+        "rs1": QueryResult("A", ["G"], False),
+        "rs2": QueryResult("C", ["A"], True),
+        "rs4": QueryResult("T", ["A"], None),
+    }
+    # Only the Axiom reference allele without reference genome
+    assert import_manifest(str(path)) == {
+        "rs4": QueryResult("T", ["A"], None),
+    }
+
+
+def test_import_illumina_manifest(reference, tmp_path):
+    path = tmp_path / "manifest.csv"
+    path.write_text(ILLUMINA_MANIFEST)
+    assert import_manifest(str(path), reference) == {
+        "rs1": QueryResult("A", ["G"], False),
+        "rs2": QueryResult("C", ["A"], False),
+        "rs7": QueryResult("T", ["A"], True),
+        "rs8": QueryResult("T", ["C"], False),
+    }
+    with pytest.raises(ValueError, match="reference genome"):
+        import_manifest(str(path))
@@ -0,0 +1,69 @@
+"""
+test_parallel.py
+~~~~~~~~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+
+:license: MIT
+"""
+from pathlib import Path
+
+from array_as_vcf.lookup import RSLookup
+from array_as_vcf.parallel import chunk_ranges, convert_parallel, data_offset
+from array_as_vcf.readers import AffyReader, OpenArrayReader
+
+import pytest
+
+DATA = Path(__file__).parent / "data"
+
+
+def lookup_table():
+    return RSLookup.from_path(str(DATA / "lookup_table_test.json"),
+                              build="GRCh37", ensembl_lookup=False)
+
+
+def test_chunk_ranges(tmp_path):
+    path = tmp_path / "lines.txt"
+    path.write_bytes(b"header\n" + b"".join(
+        b"line %d\n" % i for i in range(100)))
+    start = data_offset(str(path), 1)
+    assert start == len(b"header\n")
+    data = path.read_bytes()
+    for chunk_size in (1, 7, 50, 10000):
+        ranges = chunk_ranges(str(path), start, chunk_size)
+        assert ranges[0][0] == start and ranges[-1][1] == len(data)
+        for (_, end), (next_start, _) in zip(ranges, ranges[1:]):
+            assert end == next_start
+            assert data[end - 1:end] == b"\n"
+
+
+@pytest.mark.parametrize("path, reader_cls, kwargs", [
+    (DATA / "affy_test.txt", AffyReader, {}),
+    (DATA / "open_array_test.txt", OpenArrayReader,
+     {"sample": "e31a0a96465a", "encoding": "windows-1252"}),
+])
+def test_convert_parallel(path, reader_cls, kwargs):
+    expected = [x.vcf_line for x in
+                sorted(reader_cls(str(path), lookup_table(), **kwargs))]
+    assert expected
+    for chunk_size in (100, 5000):
+        lookup = lookup_table()
+        assert convert_parallel(reader_cls, str(path), lookup, processes=2,
+                                chunk_size=chunk_size, **kwargs) == expected
+        assert lookup.stats()["hits"] > 0
+
+
+def test_convert_parallel_blank_line(tmp_path):
+    # Rows after an empty line are converted as by the reader, also if
+    # they are in another chunk
+    lines = (DATA / "open_array_test.txt").read_bytes().splitlines()
+    path = tmp_path / "open_array.txt"
+    path.write_bytes(b"\n".join(lines + [b""] + lines[18:]) + b"\n")
+    kwargs = {"sample": "e31a0a96465a", "encoding": "windows-1252"}
+    expected = [x.vcf_line for x in
+                sorted(OpenArrayReader(str(path), lookup_table(), **kwargs))]
+    assert len(expected) == 110
+    assert convert_parallel(OpenArrayReader, str(path), lookup_table(),
+                            processes=2, chunk_size=1000,
+                            **kwargs) == expected
@@ -10,14 +10,16 @@ test_readers.py
 from datetime import date
 from pathlib import Path
 
-from array_as_vcf import __version__
-from array_as_vcf.lookup import RSLookup
+from array_as_vcf import __version__, readers
+from array_as_vcf import lookup as lookup_module
+from array_as_vcf.lookup import QueryResult, RSLookup
 from array_as_vcf.readers import (AffyReader, CytoScanReader,
                                   Lumi317kReader, Lumi370kReader,
                                   OpenArrayReader, Reader,
-                                  autodetect_reader)
+                                  autodetect_reader, convert_two_pass,
+                                  merge_samples)
 from array_as_vcf.variation import Genotype
-from array_as_vcf.variation import Variant
+from array_as_vcf.variation import InfoField, InfoFieldNumber, Variant
 
 import pytest
 
@@ -321,6 +323,47 @@ def test_reader_alts(reader, alts):
     assert found_alt == alts
 
 
+def test_affy_reader_rs_ids(affy_reader_no_ensembl):
+    assert list(affy_reader_no_ensembl.rs_ids()) == [
+        "rs2980300", "rs10907175", "rs2887286", "rs307378", "rs0",
+        "rs12939215"] * 2
+
+
+def test_lumi_reader_rs_ids(lumi_370_reader_no_ensembl):
+    assert list(lumi_370_reader_no_ensembl.rs_ids()) == [
+        "rs3934834", "rs3737728", "rs6687776", "rs4970405", "rs0",
+        "rs12939215"]
+
+
+def test_open_array_reader_rs_ids(open_array_reader_no_ensembl):
+    rs_ids = list(open_array_reader_no_ensembl.rs_ids())
+    variants = list(open_array_reader_no_ensembl)
+    assert set(rs_ids) == {x.id for x in variants}
+
+
+def test_rs_ids_does_not_advance_reader(cytoscan_reader_no_ensembl):
+    assert list(cytoscan_reader_no_ensembl.rs_ids()) == [
+        "rs2340582", "rs3748597", "rs6696609", "rs0", "rs12939215"]
+    assert len(list(cytoscan_reader_no_ensembl)) == 1
+
+
+def test_convert_two_pass(monkeypatch):
+    requests = []
+
+    def fake_query_batch(rs_ids, build, timeout=120, server=None):
+        requests.append(rs_ids)
+        return {x: QueryResult("T", ["C"], False) for x in rs_ids
+                if x != "rs0"}
+
+    monkeypatch.setattr(lookup_module, "query_ensembl_batch",
+                        fake_query_batch)
+    reader = AffyReader(_affy_path, grch37_lookup())
+    variants = convert_two_pass(reader, workers=2)
+    assert len(variants) == 10
+    assert [x.chrom for x in variants] == ["1"] * 8 + ["X"] * 2
+    assert requests == [sorted(set(reader.rs_ids()))]
+
+
 def test_base_reader_header():
     reader = Reader(_lumi_370_path)
     header = reader.vcf_header("sample_01")
@@ -483,3 +526,67 @@ def test_open_array_all_calls(open_array_reader_all_calls):
     """
     genotypes = [var.genotype for var in open_array_reader_all_calls]
     assert genotypes == [Genotype.unknown]*6
+
+
+def test_default_lookups_lazy():
+    assert readers.GRCH37_LOOKUP.build == "GRCh37"
+    assert readers.GRCH38_LOOKUP.build == "GRCh38"
+    assert readers.GRCH37_LOOKUP is readers.GRCH37_LOOKUP
+    with pytest.raises(AttributeError):
+        readers.GRCH39_LOOKUP
+
+
+def test_open_array_column_map(open_array_reader_no_ensembl):
+    reader = open_array_reader_no_ensembl
+    header = reader._header_splitted
+    for column, idx in reader.column_idx.items():
+        assert header[idx] == column
+    assert reader.position_col_idx == header.index("Position")
+
+
+def test_open_array_missing_columns(tmp_path):
+    with open(_open_array_path, encoding="windows-1252") as handle:
+        lines = handle.readlines()
+    lines[17] = lines[17].replace("Chromosome #", "Chr").replace(
+        "\tCall\t", "\tCalls\t")
+    path = tmp_path / "open_array.txt"
+    path.write_text("".join(lines), encoding="windows-1252")
+    with pytest.raises(ValueError, match="missing OpenArray columns: Call, "
+                                         "Chromosome #"):
+        OpenArrayReader(str(path), test_lookup_table(), "e31a0a96465a",
+                        encoding="windows-1252")
+
+
+def test_open_array_split_samples():
+    lookup = test_lookup_table()
+    reader = OpenArrayReader(_open_array_path, lookup, None,
+                             encoding="windows-1252")
+    by_sample = reader.split_samples()
+    assert len(by_sample) == 49
+    for sample in ("e31a0a96465a", "2003cfb3749d"):
+        single = OpenArrayReader(_open_array_path, lookup, sample,
+                                 encoding="windows-1252")
+        assert ([x.vcf_line for x in sorted(by_sample[sample])] ==
+                [x.vcf_line for x in sorted(single)])
+
+
+def test_merge_samples():
+    info = [InfoField("Assay_ID", "C_1", InfoFieldNumber.one)]
+
+    def variant(genotype, alt, pos=1):
+        return Variant("1", pos, "A", alt, 100, id=f"rs{pos}",
+                       info_fields=info, genotype=genotype)
+
+    merged = merge_samples({
+        "s1": [variant(Genotype.hom_ref, ["G", "T"]),
+               variant(Genotype.het, "C", pos=2)],
+        "s2": [variant(Genotype.het, "T")],
+        "s3": [variant(Genotype.hom_alt, "G"),
+               variant(Genotype.unknown, ".", pos=2)],
+    })
+    assert [x.vcf_line for x in merged] == [
+        "1\t1\trs1\tA\tT,G\t100\tPASS\tAssay_ID=C_1\tGT\t0/0\t0/1\t2/2",
+        "1\t2\trs2\tA\tC\t100\tPASS\tAssay_ID=C_1\tGT\t0/1\t./.\t./.",
+    ]
+    only_ref = merge_samples({"s1": [variant(Genotype.hom_ref, ["G"])]})
+    assert only_ref[0].alt == ["G"]
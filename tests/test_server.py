@@ -0,0 +1,141 @@
+"""
+test_server.py
+~~~~~~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+
+:license: MIT
+"""
+import json
+import socket
+import threading
+import time
+from urllib.error import URLError
+
+from array_as_vcf.ensembl import EnsemblClient
+from array_as_vcf.lookup import (MissingReason, QueryResult, RSLookup,
+                                 failure_reason)
+from array_as_vcf.server import LookupServer, LookupServerClient
+
+from conftest import EnsemblStandIn
+
+import pytest
+
+
+class SlowStandIn(EnsemblStandIn):
+    """Takes a while to answer, so that requests overlap"""
+
+    def reply(self, status, content, headers=None):
+        time.sleep(0.2)
+        super().reply(status, content, headers)
+
+
+@pytest.fixture
+def lookup_server(serve_stand_in, tmp_path):
+    upstream = serve_stand_in(SlowStandIn)
+    client = EnsemblClient("GRCh37", timeout=5, server=upstream.url)
+    journal = str(tmp_path / "journal.jsonl")
+    lookup = RSLookup("GRCh37", {"rs9": QueryResult("G", ["A"], True)},
+                      journal=journal, client=client)
+    server = LookupServer(str(tmp_path / "aav.sock"), lookup)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.upstream = upstream
+    server.journal = journal
+    yield server
+    server.shutdown()
+    server.server_close()
+    lookup.close()
+
+
+def remote_lookup(server):
+    return RSLookup("GRCh37", client=LookupServerClient(server.server_address))
+
+
+def test_server_lookup(lookup_server):
+    look = remote_lookup(lookup_server)
+    assert look["rs9"] == QueryResult("G", ["A"], True)
+    assert look["rs1"] == QueryResult("A", ["G"], False)
+    with pytest.raises(KeyError, match=MissingReason.not_found.value):
+        look["rs5"]
+    with pytest.raises(KeyError, match=MissingReason.unmapped.value):
+        look["rs4"]
+    assert look.prefetch(["rs2", "rs3", "rs4", "rs9"]) == 2
+    assert look["rs3"] == QueryResult("T", ["A", "G"], None)
+    # rs9 was known to the server, the others are requested once
+    assert len(lookup_server.upstream.requests) == 4
+    look.close()
+
+    # new entries are persisted by the server
+    with open(lookup_server.journal) as handle:
+        journaled = {json.loads(line)[0] for line in handle}
+    assert journaled == {"rs1", "rs2", "rs3", "rs4", "rs5"}
+
+
+def test_server_coalesces_requests(lookup_server):
+    results = []
+
+    def lookup():
+        results.append(remote_lookup(lookup_server)["rs2"])
+
+    threads = [threading.Thread(target=lookup) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [QueryResult("C", ["T"], True)] * 8
+    assert lookup_server.upstream.requests == [("GET", "rs2")]
+    assert lookup_server.fetched == 1
+
+
+def test_server_invalid_request(lookup_server):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(lookup_server.server_address)
+        handle = sock.makefile("rwb")
+        handle.write(b"rs1\n")
+        handle.flush()
+        assert "Invalid request" in json.loads(handle.readline())["error"]
+        # the connection can still be used
+        handle.write(b'{"ids": ["rs9"]}\n')
+        handle.flush()
+        assert json.loads(handle.readline()) == {
+            "results": {"rs9": "G:A:T"}}
+        handle.close()
+
+
+def test_server_unreachable(tmp_path):
+    client = LookupServerClient(str(tmp_path / "missing.sock"))
+    with pytest.raises(URLError):
+        client.query("rs1")
+    look = RSLookup("GRCh37", client=client, retry_backoff=0)
+    with pytest.raises(KeyError, match=MissingReason.error.value):
+        look["rs1"]
+
+
+def test_server_timeout(tmp_path):
+    # A server that accepts connections, but never answers
+    path = str(tmp_path / "silent.sock")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(path)
+        sock.listen(1)
+        client = LookupServerClient(path, timeout=120)
+        started = time.monotonic()
+        with pytest.raises(URLError) as error:
+            client.query("rs1", timeout=0.2)
+        assert time.monotonic() - started < 5
+        assert failure_reason(error.value) == "timeout"
+
+
+def test_server_resolve_error(lookup_server, monkeypatch):
+    def fetch(rs_ids, workers=1):
+        raise TimeoutError("timed out")
+        yield
+
+    monkeypatch.setattr(lookup_server.lookup, "fetch", fetch)
+    client = LookupServerClient(lookup_server.server_address, timeout=5)
+    with pytest.raises(URLError, match="Failed to resolve"):
+        client.query("rs1")
+    # the connection is answered and can still be used
+    assert client.query("rs9") == QueryResult("G", ["A"], True)
+    client.close()
@@ -0,0 +1,366 @@
+"""
+test_stores.py
+~~~~~~~~~~~~~~
+
+:copyright: (c) 2018 Sander Bollen
+:copyright: (c) 2018 Leiden University Medical Center
+
+:license: MIT
+"""
+import json
+import os
+import threading
+from pathlib import Path
+
+from array_as_vcf.lookup import (MissingReason, MissingResult, QueryResult,
+                                 RSLookup, open_table, table_compression)
+from array_as_vcf.stores import (BinaryStore, InternedStore, JournalStore,
+                                 LazyStore, SQLiteStore, compact_journal,
+                                 is_binary_table, is_sqlite, merge_into,
+                                 merge_result, read_table,
+                                 write_binary_table)
+
+import pytest
+
+_lookup_table = str(Path(__file__).parent / Path("data") /
+                    Path("lookup_table_test.json"))
+
+
+@pytest.fixture
+def sqlite_path(tmp_path):
+    return str(tmp_path / "lookup.sqlite")
+
+
+def test_sqlite_store_roundtrip(sqlite_path):
+    store = SQLiteStore(sqlite_path, batch_size=2)
+    store["rs1"] = QueryResult("A", ["G", "T"], True)
+    store["rs2"] = None
+    store["rs3"] = QueryResult("C", ["T"], None)
+    assert store["rs1"] == QueryResult("A", ["G", "T"], True)
+    assert store["rs2"] is None
+    assert "rs3" in store
+    assert "rs4" not in store
+    assert len(store) == 3
+    store.close()
+
+    reopened = SQLiteStore(sqlite_path)
+    assert dict(reopened.items()) == {
+        "rs1": QueryResult("A", ["G", "T"], True),
+        "rs2": None,
+        "rs3": QueryResult("C", ["T"], None)
+    }
+    del reopened["rs2"]
+    with pytest.raises(KeyError):
+        reopened["rs2"]
+    with pytest.raises(KeyError):
+        del reopened["rs2"]
+
+
+def test_is_sqlite(sqlite_path, tmp_path):
+    assert is_sqlite(sqlite_path)
+    assert not is_sqlite(_lookup_table)
+    # An existing database is recognized regardless of the extension
+    db_path = str(tmp_path / "lookup")
+    SQLiteStore(db_path).close()
+    assert is_sqlite(db_path)
+
+
+def test_lookup_dump_sqlite(sqlite_path):
+    json_lookup = RSLookup.from_path(_lookup_table, "GRCh37")
+    json_lookup.dump(sqlite_path)
+
+    sqlite_lookup = RSLookup.from_path(sqlite_path, "GRCh37",
+                                       ensembl_lookup=False)
+    assert len(sqlite_lookup) == len(json_lookup)
+    assert sqlite_lookup["rs1037256"] == QueryResult(
+        "G", ["A", "C", "T"], True)
+    assert json.loads(sqlite_lookup.dumps()) == json.loads(
+        json_lookup.dumps())
+
+
+def test_lookup_sqlite_in_place(sqlite_path):
+    lookup = RSLookup("GRCh37", SQLiteStore(sqlite_path),
+                      ensembl_lookup=False)
+    lookup._RSLookup__rsids["rs1"] = QueryResult("A", ["G"], False)
+    lookup.dump(sqlite_path)
+    lookup.close()
+    assert SQLiteStore(sqlite_path)["rs1"] == QueryResult("A", ["G"], False)
+
+
+@pytest.fixture
+def binary_path(tmp_path):
+    return str(tmp_path / "lookup.bin")
+
+
+def test_binary_table_roundtrip(binary_path):
+    json_lookup = RSLookup.from_path(_lookup_table, "GRCh37")
+    json_lookup.dump(binary_path)
+    assert is_binary_table(binary_path)
+
+    store = BinaryStore(binary_path)
+    assert len(store) == len(json_lookup)
+    assert store["rs3913290"] == QueryResult("C", ["T"], None)
+    assert store["rs2229546"] == QueryResult("C", ["A", "G", "T"], True)
+    for rs_id in ("rs1", "rs99999999999", "not_an_rs_id"):
+        with pytest.raises(KeyError):
+            store[rs_id]
+    assert json.loads(RSLookup("GRCh37", store).dumps()) == json.loads(
+        json_lookup.dumps())
+
+
+def test_binary_table_small(binary_path):
+    written = write_binary_table([
+        ("rs30", QueryResult("A", ["G"], False)),
+        ("rs2", None),
+        ("rs10", QueryResult("A", ["G"], False)),
+        ("AFFX-1", QueryResult("A", ["G"], False)),
+    ], binary_path)
+    assert written == 3
+    store = BinaryStore(binary_path)
+    assert list(store) == ["rs2", "rs10", "rs30"]
+    assert store["rs2"] is None
+    assert store["rs10"] is store["rs30"]
+
+
+def test_binary_table_overlay(binary_path):
+    write_binary_table([("rs1", QueryResult("A", ["G"], False))],
+                       binary_path)
+    lookup = RSLookup.from_path(binary_path, "GRCh37", ensembl_lookup=False)
+    lookup._RSLookup__rsids["rs2"] = QueryResult("C", ["T"], True)
+    assert len(lookup) == 2
+    # Rewriting the table that is currently mapped is allowed
+    lookup.dump(binary_path)
+    assert dict(BinaryStore(binary_path).items()) == {
+        "rs1": QueryResult("A", ["G"], False),
+        "rs2": QueryResult("C", ["T"], True)
+    }
+
+
+def test_lazy_store():
+    store = LazyStore({"rs1": "A:G,T:T", "rs2": None})
+    assert store._results["rs1"] == "A:G,T:T"
+    assert store["rs1"] == QueryResult("A", ["G", "T"], True)
+    assert store._results["rs1"] == QueryResult("A", ["G", "T"], True)
+    assert store["rs1"] is store["rs1"]
+    assert store["rs2"] is None
+    assert "rs3" not in store
+
+
+def test_lookup_lazy_from_path():
+    lookup = RSLookup.from_path(_lookup_table, "GRCh37", lazy=True,
+                                ensembl_lookup=False)
+    eager = RSLookup.from_path(_lookup_table, "GRCh37")
+    store = lookup._RSLookup__rsids
+    assert isinstance(store, LazyStore)
+    assert all(isinstance(v, str) for v in store._results.values())
+    assert lookup["rs776746"] == QueryResult("C", ["T"], False)
+    assert store == eager._RSLookup__rsids
+    assert lookup.dumps() == eager.dumps()
+    assert sum(not isinstance(v, str) for v in store._results.values()) == 1
+
+
+def test_interned_store():
+    store = InternedStore({"rs1": "A:G:F", "rs2": "A:G:F", "rs3": None})
+    store["rs4"] = QueryResult("A", ["G"], False)
+    store["AFFX-1"] = QueryResult("C", ["T"], True)
+    store["rs05"] = QueryResult("C", ["T"], True)
+    assert store["rs1"] == QueryResult("A", ["G"], False)
+    assert store["rs1"] is store["rs2"] is store["rs4"]
+    assert store["rs3"] is None
+    assert store["rs05"] is store["AFFX-1"]
+    assert len(store._values) == 3
+    assert list(store) == ["rs1", "rs2", "rs3", "rs4", "AFFX-1", "rs05"]
+    assert "rs5" not in store
+    del store["rs05"]
+    with pytest.raises(KeyError, match="rs05"):
+        store["rs05"]
+
+
+def test_lookup_compact_from_path():
+    lookup = RSLookup.from_path(_lookup_table, "GRCh37", compact=True)
+    eager = RSLookup.from_path(_lookup_table, "GRCh37")
+    assert isinstance(lookup._RSLookup__rsids, InternedStore)
+    assert lookup._RSLookup__rsids == eager._RSLookup__rsids
+    assert json.loads(lookup.dumps()) == json.loads(eager.dumps())
+
+
+def test_journal_store(tmp_path):
+    journal = str(tmp_path / "lookup.journal")
+    lookup = RSLookup("GRCh37", ensembl_lookup=False, journal=journal)
+    store = lookup._RSLookup__rsids
+    store["rs1"] = QueryResult("A", ["G"], False)
+    store["rs2"] = None
+    store["rs3"] = QueryResult("C", ["T"], True)
+    del store["rs3"]
+    # Entries are on disk before the store is closed
+    with open(journal) as handle:
+        assert len(handle.readlines()) == 4
+
+    replayed = RSLookup("GRCh37", ensembl_lookup=False, journal=journal)
+    assert replayed._RSLookup__rsids.replayed == 4
+    assert dict(replayed._RSLookup__rsids.items()) == {
+        "rs1": QueryResult("A", ["G"], False),
+        "rs2": None
+    }
+
+
+def test_journal_interrupted_write(tmp_path):
+    journal = tmp_path / "lookup.journal"
+    journal.write_text('["rs1", "A:G:F"]\n["rs2", "C:')
+    store = JournalStore(str(journal))
+    store["rs3"] = QueryResult("C", ["T"], True)
+    store.close()
+    assert dict(JournalStore(str(journal)).items()) == {
+        "rs1": QueryResult("A", ["G"], False),
+        "rs3": QueryResult("C", ["T"], True)
+    }
+
+
+@pytest.mark.parametrize("snapshot_name", ["lookup.json", "lookup.sqlite",
+                                           "lookup.bin"])
+def test_compact_journal(tmp_path, snapshot_name):
+    snapshot = str(tmp_path / snapshot_name)
+    journal = str(tmp_path / "lookup.journal")
+    RSLookup.from_path(_lookup_table, "GRCh37").dump(snapshot)
+    store = JournalStore(journal)
+    store["rs1"] = QueryResult("A", ["G"], False)
+    store.close()
+
+    assert compact_journal(snapshot, journal) == 1
+    assert os.path.getsize(journal) == 0
+    lookup = RSLookup.from_path(snapshot, "GRCh37", ensembl_lookup=False)
+    assert len(lookup) == 62
+    assert lookup["rs1"] == QueryResult("A", ["G"], False)
+    assert compact_journal(snapshot, journal) == 0
+
+
+def test_compact_journal_new_snapshot(tmp_path):
+    snapshot = str(tmp_path / "lookup.json")
+    journal = str(tmp_path / "lookup.journal")
+    store = JournalStore(journal)
+    store["rs1"] = QueryResult("A", ["G"], False)
+    store.close()
+    compact_journal(snapshot, journal)
+    with open(snapshot) as handle:
+        assert json.load(handle) == {"rs1": "A:G:F"}
+
+
+def test_compact_journal_concurrent_appends(tmp_path):
+    # Entries appended while compacting are kept in the journal
+    snapshot = str(tmp_path / "lookup.json")
+    journal = str(tmp_path / "lookup.journal")
+    store = JournalStore(journal)
+
+    def append():
+        for i in range(2000):
+            store[f"rs{i}"] = QueryResult("A", ["G"], False)
+
+    thread = threading.Thread(target=append)
+    thread.start()
+    while thread.is_alive():
+        compact_journal(snapshot, journal)
+    thread.join()
+    store.close()
+    compact_journal(snapshot, journal)
+    assert len(dict(read_table(snapshot))) == 2000
+
+
+def test_merge_result():
+    found = QueryResult("A", ["G"], False)
+    other = QueryResult("A", ["T"], False)
+    old_error = MissingResult(MissingReason.error, 10)
+    new_error = MissingResult(MissingReason.not_found, 20)
+    assert merge_result("rs1", old_error, found) == found
+    assert merge_result("rs1", found, None) == found
+    assert merge_result("rs1", None, old_error) == old_error
+    assert merge_result("rs1", new_error, old_error) == new_error
+    assert merge_result("rs1", old_error, new_error) == new_error
+    assert merge_result("rs1", found, other) == found
+    assert merge_result("rs1", found, other, "last") == other
+    with pytest.raises(ValueError, match="rs1"):
+        merge_result("rs1", found, other, "error")
+
+
+@pytest.mark.parametrize("name", ["lookup.json", "lookup.sqlite",
+                                  "lookup.bin"])
+def test_merge_into(tmp_path, name):
+    path = str(tmp_path / name)
+    first = {"rs1": QueryResult("A", ["G"], False),
+             "rs2": MissingResult(MissingReason.error, 10)}
+    second = {"rs2": QueryResult("C", ["T"], True),
+              "rs3": None}
+    assert merge_into(path, [first.items()]) == 2
+    assert merge_into(path, [second.items()]) == 3
+    assert dict(read_table(path)) == {
+        "rs1": QueryResult("A", ["G"], False),
+        "rs2": QueryResult("C", ["T"], True),
+        "rs3": None,
+    }
+    assert [x.name for x in tmp_path.iterdir()
+            if ".tmp" in x.name] == []
+
+
+def test_merge_into_conflict(tmp_path):
+    path = str(tmp_path / "lookup.json")
+    merge_into(path, [{"rs1": QueryResult("A", ["G"], False)}.items()])
+    conflicting = {"rs1": QueryResult("A", ["T"], False)}
+    with pytest.raises(ValueError, match="rs1"):
+        merge_into(path, [conflicting.items()], on_conflict="error")
+    assert dict(read_table(path)) == {"rs1": QueryResult("A", ["G"], False)}
+    merge_into(path, [conflicting.items()], on_conflict="last")
+    assert dict(read_table(path)) == conflicting
+    with pytest.raises(ValueError, match="policy"):
+        merge_into(path, [], on_conflict="newest")
+
+
+def test_merge_into_sqlite_in_place(sqlite_path):
+    merge_into(sqlite_path, [{"rs1": QueryResult("A", ["G"], False)}.items()])
+    inode = os.stat(sqlite_path).st_ino
+    conflicting = {"rs2": QueryResult("C", ["T"], True),
+                   "rs1": QueryResult("A", ["T"], False)}
+    with pytest.raises(ValueError, match="rs1"):
+        merge_into(sqlite_path, [conflicting.items()], on_conflict="error")
+    # The failed merge is rolled back
+    assert dict(read_table(sqlite_path)) == {
+        "rs1": QueryResult("A", ["G"], False)}
+    assert merge_into(sqlite_path, [conflicting.items()],
+                      on_conflict="last") == 2
+    assert dict(read_table(sqlite_path)) == conflicting
+    assert os.stat(sqlite_path).st_ino == inode
+
+
+def test_merge_into_concurrent(tmp_path):
+    path = str(tmp_path / "lookup.json")
+
+    def dump(i):
+        lookup = RSLookup("GRCh37", {
+            f"rs{i}{j}": QueryResult("A", ["G"], False) for j in range(50)
+        }, ensembl_lookup=False)
+        lookup.dump(path, merge=True)
+
+    threads = [threading.Thread(target=dump, args=(i,)) for i in range(1, 9)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(dict(read_table(path))) == 8 * 50
+
+
+@pytest.mark.parametrize("name", ["lookup.json.gz", "lookup.json.xz"])
+def test_compressed_table(tmp_path, name):
+    path = str(tmp_path / name)
+    lookup = RSLookup.from_path(_lookup_table, "GRCh37")
+    lookup.dump(path)
+    assert table_compression(path) == name[-2:]
+    with open_table(path) as handle:
+        assert handle.read() == lookup.dumps()
+    for kwargs in ({}, {"lazy": True}, {"compact": True}):
+        loaded = RSLookup.from_path(path, "GRCh37", **kwargs)
+        assert json.loads(loaded.dumps()) == json.loads(lookup.dumps())
+    # recognized by content, not by name
+    renamed = str(tmp_path / "lookup.json")
+    os.rename(path, renamed)
+    assert len(dict(read_table(renamed))) == len(lookup)
+    merge_into(renamed, [{"rs1": QueryResult("A", ["G"], False)}.items()])
+    assert table_compression(renamed) is None
+    assert len(RSLookup.from_path(renamed, "GRCh37")) == len(lookup) + 1